@@ -0,0 +1,216 @@
+"""Асинхронный доступ к базе на psycopg 3 для пакетов независимых запросов
+(Database.fetch_many).
+
+Цикл asyncio работает в отдельном потоке, один на все окна. Запросы пакета
+идут одновременно, каждый по своему соединению в режиме конвейера (pipeline):
+BEGIN, лимит времени, сам запрос и COMMIT уходят серверу одним сообщением.
+Пакет занимает один обмен с сервером плюс время самого долгого запроса.
+Результат — concurrent.futures.Future, окна опрашивают его через after(),
+как задачи пула потоков.
+
+Пакет из N запросов занимает N соединений одновременно. Соединения свои,
+сверх пула Database: к каждому серверу не больше его maxconn, остальные
+запросы пакета ждут свободного. Всего к серверу до 2 × maxconn соединений
+процесса — учитывать в max_connections.
+
+Запросы пишутся для psycopg2; кортеж в параметрах (`IN %s`) psycopg 3 сам
+не подставляет, такие параметры раскрывает expand_tuples.
+
+Пакет psycopg необязателен (pip install "psycopg[binary]"): модуль
+загружается из Database.async_backend, без него пакеты выполняются
+в пуле потоков."""
+import asyncio
+import logging
+import threading
+import time
+
+import psycopg
+import psycopg.errors
+from psycopg.pq import TransactionStatus
+
+from db import PLACEHOLDER_RE, Replica, estimate_bytes
+
+log = logging.getLogger(__name__)
+
+CLOSE_TIMEOUT = 5       # сколько ждать закрытия соединений при выходе, с
+
+SET_TIMEOUT = "SELECT set_config('statement_timeout', %s, true)"
+
+
+def expand_tuples(query, params):
+    """Кортеж psycopg2 подставляет списком в скобках (`IN %s`), psycopg 3
+    связывает параметры на сервере и так не умеет: %s такого параметра
+    раскрывается в (%s, %s, ...) по элементам, вложенные кортежи (составной
+    ключ) — так же. Остальные параметры и именованные (%(имя)s) не меняются."""
+    if not params or isinstance(params, dict) or not any(isinstance(p, tuple) for p in params):
+        return query, params
+    values = iter(params)
+    flat = []
+
+    def placeholders(value):
+        if isinstance(value, tuple):
+            return "(" + ", ".join(placeholders(v) for v in value) + ")"
+        flat.append(value)
+        return "%s"
+
+    def sub(m):
+        return "%%" if m.group() == "%%" else placeholders(next(values))
+
+    return PLACEHOLDER_RE.sub(sub, query), flat
+
+
+class AsyncPool:
+    """Соединения psycopg 3 с одним сервером, не больше maxconn.
+    Используется только из потока цикла."""
+
+    def __init__(self, config, maxconn):
+        self.config = config
+        self.idle = []
+        self.slots = asyncio.Semaphore(maxconn)
+
+    async def acquire(self):
+        await self.slots.acquire()
+        try:
+            while self.idle:
+                conn = self.idle.pop()
+                if not conn.closed:
+                    return conn
+            return await psycopg.AsyncConnection.connect(**self.config)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    async def release(self, conn, broken=False):
+        """Вернуть соединение; оборванное или с незавершённой транзакцией закрывается"""
+        try:
+            if broken or conn.closed or conn.info.transaction_status != TransactionStatus.IDLE:
+                await conn.close()
+            else:
+                self.idle.append(conn)
+        finally:
+            self.slots.release()
+
+    async def close(self):
+        idle, self.idle = self.idle, []
+        for conn in idle:
+            await conn.close()
+
+
+class AsyncBackend:
+    """Цикл asyncio в своём потоке и пулы psycopg 3 к тем же серверам,
+    что и у Database (основной и реплики). Замеры пишутся в статистику Database."""
+
+    def __init__(self, db):
+        self.db = db
+        self.pools = {}     # пул Database (основной или реплика) -> AsyncPool
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="aiodb", daemon=True)
+        self.thread.start()
+
+    def fetch_many(self, queries, timeout=None, replica=False, caller=None):
+        """Future со списком результатов queries в том же порядке.
+        Отмена Future отменяет запросы на сервере."""
+        return asyncio.run_coroutine_threadsafe(
+            self.gather(queries, timeout, replica, caller), self.loop)
+
+    async def gather(self, queries, timeout, replica, caller):
+        tasks = [asyncio.ensure_future(self.fetch(query, params, timeout, replica, caller))
+                 for query, params in queries]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            # Ошибка одного запроса или отмена пакета — остальные не нужны
+            for task in tasks:
+                task.cancel()
+            raise
+
+    def pool(self, source):
+        if source not in self.pools:
+            self.pools[source] = AsyncPool(source.config, source.maxconn)
+        return self.pools[source]
+
+    async def acquire(self, replica):
+        """(пул Database, AsyncPool, соединение). Выбор реплики может проверять
+        её отставание, поэтому он выполняется вне цикла. Недоступная реплика
+        исключается, запрос идёт на основной сервер."""
+        source = self.db.pool
+        if replica and self.db.replicas:
+            source = await self.loop.run_in_executor(None, self.db.read_pool)
+        try:
+            return source, self.pool(source), await self.pool(source).acquire()
+        except psycopg.OperationalError as e:
+            if not isinstance(source, Replica):
+                raise
+            source.fail(e)
+        source = self.db.pool
+        return source, self.pool(source), await self.pool(source).acquire()
+
+    async def fetch(self, query, params, timeout, replica, caller):
+        """SELECT по своему соединению; при обрыве повторяется один раз"""
+        text, args = expand_tuples(query, params)
+        for attempt in range(2):
+            source, pool, conn = await self.acquire(replica)
+            broken = False
+            try:
+                started = time.perf_counter()
+                async with conn.pipeline():
+                    if timeout:
+                        await conn.execute(SET_TIMEOUT, (str(int(timeout * 1000)),))
+                    cur = await conn.execute(text, args)
+                    await conn.commit()
+                    rows = await cur.fetchall()
+                elapsed = time.perf_counter() - started
+            except asyncio.CancelledError:
+                # Запрос мог остаться на сервере — отменяем его там
+                broken = True
+                await self.loop.run_in_executor(None, self.cancel, conn)
+                raise
+            except psycopg.errors.QueryCanceled as e:
+                await self.rollback(conn)
+                raise TimeoutError(f"Превышен лимит времени запроса: {e}")
+            except (psycopg.OperationalError, psycopg.InterfaceError) as e:
+                broken = conn.closed
+                if not broken or attempt:
+                    log.error("Ошибка fetch: %s", e)
+                    await self.rollback(conn)
+                    raise
+                if isinstance(source, Replica):
+                    source.fail(e)
+                log.warning("Соединение потеряно, повтор запроса: %s", e)
+                continue
+            except Exception as e:
+                log.error("Ошибка fetch: %s", e)
+                await self.rollback(conn)
+                raise
+            finally:
+                await pool.release(conn, broken)
+
+            self.db.measure(query, params, elapsed, len(rows), estimate_bytes(rows),
+                            explain=True, caller=caller)
+            return rows
+
+    @staticmethod
+    def cancel(conn):
+        try:
+            conn.cancel()
+        except psycopg.Error as e:
+            log.error("Ошибка cancel: %s", e)
+
+    @staticmethod
+    async def rollback(conn):
+        if not conn.closed:
+            try:
+                await conn.rollback()
+            except psycopg.Error:
+                pass
+
+    def close(self):
+        async def close_pools():
+            for pool in self.pools.values():
+                await pool.close()
+
+        try:
+            asyncio.run_coroutine_threadsafe(close_pools(), self.loop).result(CLOSE_TIMEOUT)
+        except Exception as e:
+            log.error("Ошибка закрытия соединений: %s", e)
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -1,70 +1,869 @@
 import tkinter as tk
-from tkinter import ttk, messagebox
-from datetime import date, datetime
+from tkinter import ttk, messagebox, filedialog
+from datetime import date, datetime, timedelta
+from collections import deque
+from decimal import Decimal
+from functools import partial
+import bisect
+import csv
+import io
+import itertools
+import json
+import logging
+import queue
+import re
+import select
+import threading
+import time
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+from db import (COLUMN_TYPES_QUERY, STATS, TABLE_INFO_QUERIES, Database, call_site,
+                table_info)
+from reports import (REPORTS, STOCK_SUMMARY, export_query, parse_date, parse_decimal,
+                     take_snapshots)
+from tables import (PAGE_SIZE, TableQuery, column_kind, invoice_select, items_select,
+                    like_escape, search_predicate, table_view)
 
+log = logging.getLogger(__name__)
 
-class Database:
-    def __init__(self):
+
+class BackgroundTask:
+    """Работа с БД в фоновом потоке. Результат возвращается в цикл Tk
+    через after(), окно при этом не замирает.
+    func вызывается как func(*args, on_conn=...)."""
+
+    POLL_MS = 50
+
+    def __init__(self, widget, db, func, *args, on_done=None, on_error=None):
+        self.widget = widget
+        self.db = db
+        self.on_done = on_done
+        self.on_error = on_error or (lambda e: messagebox.showerror("Ошибка", str(e)))
+        self.cancelled = False
+        self.conn = None        # соединение, на котором идёт запрос
+        self.started = time.monotonic()
+        self.caller = call_site(skip=(BackgroundTask,))   # окно и метод — для замеров
+        self.future = self.submit(func, args)
+        widget.after(self.POLL_MS, self.poll)
+
+    def submit(self, func, args):
+        return self.db.executor.submit(self.run, func, args)
+
+    def run(self, func, args):
+        if self.cancelled:
+            return None
+        self.db.local.caller = self.caller
         try:
-            self.conn = psycopg2.connect(
-                host="localhost",
-                port="5432",
-                user="postgres",
-                password="1441",
-                dbname="for_term_paper"
-            )
-            self.cur = self.conn.cursor()
-            
-        except Exception as e:
-            print("Ошибка подключения:", e)
-            messagebox.showerror("Ошибка подключения", str(e))
-            raise
+            return func(*args, on_conn=self.attach)
+        finally:
+            self.conn = None
+            self.db.local.caller = None
 
+    def attach(self, conn):
+        self.conn = conn
+        if self.cancelled:
+            raise psycopg2.extensions.QueryCanceledError("Запрос отменён")
 
-    def fetch(self, query, params=None):
+    def poll(self):
         try:
-            self.cur.execute(query, params)
-            return self.cur.fetchall()
-        except Exception as e:
-            print("Ошибка fetch:", e)
-            self.conn.rollback()
-            raise
+            if not self.widget.winfo_exists():
+                self.cancel()
+                return
+        except tk.TclError:
+            self.cancel()
+            return
+
+        if not self.future.done():
+            self.widget.after(self.POLL_MS, self.poll)
+            return
+        if self.cancelled:
+            return
 
-    def execute(self, query, params=None):
         try:
-            self.cur.execute(query, params)
-            self.conn.commit()
+            result = self.future.result()
+        except psycopg2.extensions.QueryCanceledError as e:
+            self.on_error(TimeoutError(f"Превышен лимит времени запроса: {e}"))
         except Exception as e:
-            print("Ошибка execute:", e)
-            self.conn.rollback()
-            raise
+            self.on_error(e)
+        else:
+            if self.on_done:
+                self.on_done(result)
+
+    def cancel(self):
+        """Снять задачу из очереди или отменить запрос на сервере"""
+        self.cancelled = True
+        conn = self.conn
+        if not self.future.cancel() and conn is not None:
+            try:
+                conn.cancel()
+            except psycopg2.Error as e:
+                log.error("Ошибка cancel: %s", e)
+
+    def done(self):
+        return self.future.done()
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+
+class QueryTask(BackgroundTask):
+    """SELECT в фоновом потоке; replica=True — можно читать с реплики"""
+
+    def __init__(self, widget, db, query, params=None,
+                 on_done=None, on_error=None, timeout=None, prepare=False, replica=False):
+        super().__init__(widget, db, partial(db.fetch, prepare=prepare, replica=replica),
+                         query, params, timeout, on_done=on_done, on_error=on_error)
+
+
+class BatchTask(BackgroundTask):
+    """Несколько независимых SELECT одним пакетом (Database.fetch_many):
+    on_done получает список результатов в порядке queries. Окно ждёт
+    самый долгий запрос, а не сумму всех."""
+
+    def __init__(self, widget, db, queries, on_done=None, on_error=None, timeout=None,
+                 replica=False):
+        super().__init__(widget, db, db.fetch_many, queries, timeout, replica,
+                         on_done=on_done, on_error=on_error)
+
+    def submit(self, func, args):
+        # fetch_many сам возвращает Future — поток пула не занимаем ожиданием
+        return func(*args, caller=self.caller)
+
+
+# Уведомления об изменениях (LISTEN/NOTIFY)
+LISTEN_WAKE = 1.0       # как часто поток LISTEN проверяет, не пора ли остановиться (с)
+LISTEN_RETRY = 5        # пауза перед переподключением LISTEN (с)
+CHANGES_POLL_MS = 200   # как часто окно Tk забирает уведомления из очереди
+
+
+class ChangeListener(threading.Thread):
+    """Отдельное соединение с LISTEN. Уведомления складываются в очередь
+    как (канал, текст), окно Tk забирает их через after().
+    После (пере)подключения в очередь кладётся (None, None): уведомления,
+    пришедшие без соединения, потеряны, и кэши нужно сбросить."""
+
+    def __init__(self, config, channels):
+        super().__init__(name="listen", daemon=True)
+        self.config = config
+        self.channels = channels
+        self.queue = queue.Queue()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.config)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    for channel in self.channels:
+                        cur.execute(f"LISTEN {channel}")
+                self.queue.put((None, None))
+
+                while not self.stopped.is_set():
+                    if not select.select([conn], [], [], LISTEN_WAKE)[0]:
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        note = conn.notifies.pop(0)
+                        self.queue.put((note.channel, note.payload))
+            except psycopg2.Error as e:
+                log.warning("Ошибка LISTEN, переподключение: %s", e)
+                self.stopped.wait(LISTEN_RETRY)
+            finally:
+                if conn is not None and not conn.closed:
+                    conn.close()
+
+    def stop(self):
+        self.stopped.set()
+
+    def drain(self):
+        """Все накопившиеся уведомления (вызывается из потока Tk)"""
+        notes = []
+        while True:
+            try:
+                notes.append(self.queue.get_nowait())
+            except queue.Empty:
+                return notes
+
+
+class ChangeDispatcher:
+    """Раздаёт уведомления ChangeListener подписчикам в потоке Tk.
+    За один опрос подписчик получает список уведомлений своего канала
+    (словари из JSON) или None, если LISTEN переподключался и данные
+    нужно перечитать целиком."""
+
+    def __init__(self, widget, listener):
+        self.widget = widget
+        self.listener = listener
+        self.subscribers = {}   # канал -> [callback]
+        widget.after(CHANGES_POLL_MS, self.poll)
+
+    def subscribe(self, channel, callback):
+        self.subscribers.setdefault(channel, []).append(callback)
+
+    def unsubscribe(self, channel, callback):
+        callbacks = self.subscribers.get(channel, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+    def poll(self):
+        batches = {}
+        resync = False
+        for channel, payload in self.listener.drain():
+            if channel is None:
+                resync = True
+            else:
+                batches.setdefault(channel, []).append(json.loads(payload, parse_float=Decimal))
+
+        for channel, callbacks in self.subscribers.items():
+            notes = None if resync else batches.get(channel)
+            if not resync and not notes:
+                continue
+            for callback in list(callbacks):
+                try:
+                    callback(notes)
+                except Exception as e:
+                    log.error("Ошибка обработки уведомления: %s", e)
 
-    
+        self.widget.after(CHANGES_POLL_MS, self.poll)
 
-    def get_columns(self, table_name):
-        """Получить список колонок таблицы"""
+
+INVOICE_CHANNEL = "invoice_changes"
+
+
+# Справочники в памяти
+REF_CHANNEL = "ref_changes"
+
+
+def warehouse_label(row):
+    return f"{row[0]} - {row[1]}"
+
+# Таблица -> (ключ, колонки); название всегда вторая колонка
+REF_TABLES = {
+    "warehouses": ("warehouse_id", ["warehouse_id", "name"]),
+    "positions": ("position_id", ["position_id", "name"]),
+    "products": ("product_id", ["product_id", "name", "sku", "price"]),
+}
+
+
+class RefCache:
+    """Справочники (склады, должности, товары): каждая таблица читается
+    из базы один раз за сеанс, дальше обновляется по уведомлениям ref_changes.
+    Используется только из потока Tk."""
+
+    def __init__(self, db):
+        self.db = db
+        self.tables = {}    # таблица -> {id: строка}
+        self.ordered = {}   # (таблица, колонка) -> строки, отсортированные по колонке
+        self.skus = None    # sku -> строка товара
+        # Таблицы, сброшенные по уведомлению: реплика может ещё не знать
+        # об изменении, поэтому они перечитываются с основного сервера
+        self.fresh = set()
+
+    def get(self, table):
+        """Строки таблицы как словарь id -> строка"""
+        if table not in self.tables:
+            rows = self.db.fetch(self.query(table), replica=table not in self.fresh)
+            self.fill(table, rows)
+        return self.tables[table]
+
+    def query(self, table):
+        _, cols = REF_TABLES[table]
+        return f"SELECT {', '.join(cols)} FROM {table}"
+
+    def fill(self, table, rows):
+        """Загрузить таблицу строками, прочитанными отдельно (например пакетом)"""
+        self.tables[table] = {row[0]: row for row in rows}
+        self.fresh.discard(table)
+        self.changed(table)
+
+    def batchable(self, table):
+        """Таблицы ещё нет и её можно прочитать с реплики вместе с другими запросами"""
+        return table not in self.tables and table not in self.fresh
+
+    def rows(self, table, order=1):
+        """Строки таблицы, отсортированные по колонке (по умолчанию — по названию)"""
+        key = (table, order)
+        if key not in self.ordered:
+            self.ordered[key] = sorted(self.get(table).values(), key=lambda row: row[order])
+        return self.ordered[key]
+
+    def product(self, product_id):
+        return self.get("products").get(product_id)
+
+    def product_by_sku(self, sku):
+        if self.skus is None:
+            self.skus = {row[2]: row for row in self.get("products").values()}
+        return self.skus.get(sku)
+
+    def on_changes(self, notes):
+        """Подписчик канала ref_changes"""
+        if notes is None:
+            self.invalidate()
+            return
+        for note in notes:
+            self.apply(note)
+
+    def apply(self, note):
+        """Применить уведомление {"table", "op", "row"} к загруженной таблице"""
+        table = note["table"]
+        if table not in REF_TABLES:
+            return
+
+        if note["op"] == "RELOAD":
+            self.tables.pop(table, None)
+            self.fresh.add(table)
+        elif table in self.tables:
+            key, cols = REF_TABLES[table]
+            row = note["row"]
+            if note["op"] == "DELETE":
+                self.tables[table].pop(row[key], None)
+            else:
+                self.tables[table][row[key]] = tuple(row[col] for col in cols)
+        self.changed(table)
+
+    def changed(self, table):
+        for key in [k for k in self.ordered if k[0] == table]:
+            del self.ordered[key]
+        if table == "products":
+            self.skus = None
+
+    def invalidate(self):
+        """Забыть всё: таблицы перечитаются при следующем обращении"""
+        self.tables.clear()
+        self.ordered.clear()
+        self.skus = None
+        self.fresh.update(REF_TABLES)
+
+
+# Импорт накладных из CSV
+INVOICE_TABLES = {
+    "incoming": {
+        "invoices": "incoming_invoices",
+        "items": "incoming_items",
+        "invoice_id": "incoming_id",
+        "counterparty": "supplier",
+    },
+    "outgoing": {
+        "invoices": "outgoing_invoices",
+        "items": "outgoing_items",
+        "invoice_id": "outgoing_id",
+        "counterparty": "customer",
+    },
+}
+
+# Порядок полей в файле (первая строка — заголовок)
+IMPORT_FIELDS = ["invoice_number", "invoice_date", "counterparty", "sku", "quantity", "unit_price"]
+IMPORT_MAX_ERRORS = 1000
+
+
+class InvoiceImportError(Exception):
+    """Ошибки в строках файла: список (номер строки, описание)"""
+
+    def __init__(self, errors):
+        super().__init__(f"Ошибок в файле: {len(errors)}")
+        self.errors = errors
+
+
+class CsvCopyStream:
+    """Файлоподобный объект для COPY FROM STDIN. Читает CSV построчно,
+    проверяет поля и отдаёт их вместе с номером строки; память не зависит
+    от размера файла."""
+
+    def __init__(self, fileobj, delimiter):
+        self.reader = csv.reader(fileobj, delimiter=delimiter)
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator="\n")
+        self.errors = []
+        self.lines = 0
+        self.eof = False
+        next(self.reader, None)     # заголовок
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or self.buffer.tell() < size):
+            row = next(self.reader, None)
+            if row is None:
+                self.eof = True
+                break
+            if not any(field.strip() for field in row):
+                continue
+            try:
+                values = self.parse(row)
+            except ValueError as e:
+                if len(self.errors) < IMPORT_MAX_ERRORS:
+                    self.errors.append((self.reader.line_num, str(e)))
+                continue
+            self.writer.writerow([self.reader.line_num] + values)
+            self.lines += 1
+
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+    def parse(self, row):
+        if len(row) != len(IMPORT_FIELDS):
+            raise ValueError(f"ожидается полей: {len(IMPORT_FIELDS)}, найдено: {len(row)}")
+        number, inv_date, counterparty, sku, qty, price = (f.strip() for f in row)
+        if not number or not counterparty or not sku:
+            raise ValueError("не заполнены номер накладной, контрагент или SKU")
+        inv_date = parse_date(inv_date)
+        qty = parse_decimal(qty, "количество")
+        price = parse_decimal(price, "цена")
+        if qty <= 0:
+            raise ValueError(f"количество должно быть больше 0: {qty}")
+        if price < 0:
+            raise ValueError(f"цена не может быть отрицательной: {price}")
+        return [number, inv_date.isoformat(), counterparty, sku, qty, price]
+
+
+def import_invoices_csv(db, invoice_type, warehouse_id, path, on_conn=None):
+    """Загрузка накладных из CSV одной транзакцией: файл потоком идёт в
+    временную таблицу через COPY, SKU сопоставляются одним JOIN, затем
+    одним INSERT создаются накладные и одним — их позиции.
+    Возвращает (накладных, строк). Если в файле есть ошибки, ничего не
+    записывается и выбрасывается InvoiceImportError."""
+    t = INVOICE_TABLES[invoice_type]
+
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        sample = f.readline()
+        f.seek(0)
         try:
-            query = """
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name = %s 
-                ORDER BY ordinal_position
-            """
-            self.cur.execute(query, (table_name,))
-            return [row[0] for row in self.cur.fetchall()]
-        except Exception as e:
-            print(f"Ошибка получения колонок для {table_name}:", e)
-            return []
+            delimiter = csv.Sniffer().sniff(sample, delimiters=";,\t").delimiter
+        except csv.Error:
+            delimiter = ";"
+        stream = CsvCopyStream(f, delimiter)
+
+        with db.transaction(on_conn) as cur:
+            cur.execute("""
+                CREATE TEMP TABLE import_lines (
+                    line_no INTEGER PRIMARY KEY,
+                    invoice_number TEXT NOT NULL,
+                    invoice_date DATE NOT NULL,
+                    counterparty TEXT NOT NULL,
+                    sku TEXT NOT NULL,
+                    quantity NUMERIC(12,3) NOT NULL,
+                    unit_price NUMERIC(10,2) NOT NULL
+                ) ON COMMIT DROP
+            """)
+            cur.copy_expert(
+                "COPY import_lines (line_no, " + ", ".join(IMPORT_FIELDS) + ") "
+                "FROM STDIN WITH (FORMAT csv)", stream)
+            cur.execute("ANALYZE import_lines")
+
+            # Проверки, которые можно сделать только на сервере
+            cur.execute(f"""
+                SELECT line_no, reason FROM (
+                    SELECT l.line_no, 'неизвестный SKU ' || quote_literal(l.sku) AS reason
+                    FROM import_lines l
+                    LEFT JOIN products p ON p.sku = l.sku
+                    WHERE p.product_id IS NULL
+
+                    UNION ALL
+                    SELECT l.line_no, 'накладная ' || quote_literal(l.invoice_number)
+                           || ': дата или контрагент отличаются от строки ' || f.line_no
+                    FROM import_lines l
+                    JOIN (
+                        SELECT DISTINCT ON (invoice_number) invoice_number, line_no,
+                               invoice_date, counterparty
+                        FROM import_lines
+                        ORDER BY invoice_number, line_no
+                    ) f ON f.invoice_number = l.invoice_number
+                    WHERE (l.invoice_date, l.counterparty) <> (f.invoice_date, f.counterparty)
+
+                    UNION ALL
+                    SELECT MIN(l.line_no), 'накладная ' || quote_literal(l.invoice_number)
+                           || ' уже есть на этом складе'
+                    FROM import_lines l
+                    JOIN {t["invoices"]} inv
+                      ON inv.warehouse_id = %s AND inv.invoice_number = l.invoice_number
+                    GROUP BY l.invoice_number
+                ) e
+                ORDER BY line_no
+                LIMIT %s
+            """, (warehouse_id, IMPORT_MAX_ERRORS))
+            errors = sorted(stream.errors + cur.fetchall())
+            if errors:
+                raise InvoiceImportError(errors[:IMPORT_MAX_ERRORS])
+
+            cur.execute(f"""
+                INSERT INTO {t["invoices"]} (warehouse_id, {t["counterparty"]}, invoice_number, invoice_date)
+                SELECT DISTINCT ON (invoice_number) %s, counterparty, invoice_number, invoice_date
+                FROM import_lines
+                ORDER BY invoice_number, line_no
+            """, (warehouse_id,))
+            invoices = cur.rowcount
+
+            # Все позиции одним оператором: триггеры остатков и сумм
+            # срабатывают один раз на весь файл
+            cur.execute(f"""
+                INSERT INTO {t["items"]} ({t["invoice_id"]}, product_id, quantity, unit_price, invoice_date)
+                SELECT inv.{t["invoice_id"]}, p.product_id, l.quantity, l.unit_price, l.invoice_date
+                FROM import_lines l
+                JOIN {t["invoices"]} inv
+                  ON inv.warehouse_id = %s AND inv.invoice_number = l.invoice_number
+                JOIN products p ON p.sku = l.sku
+                ORDER BY l.line_no
+            """, (warehouse_id,))
+            lines = cur.rowcount
+
+    return invoices, lines
+
+
+# Обновление Treeview по разнице с показанным
+SYNC_CHUNK = 500   # строк Treeview за один шаг между событиями Tk
+
+
+def keyed_rows(rows, key_len=1):
+    """Строки результата -> пары (iid, values); iid — первые key_len
+    колонок через "|"."""
+    return [("|".join(str(k) for k in row[:key_len]), tuple(row)) for row in rows]
+
+
+def increasing_subsequence(seq):
+    """Значения наибольшей возрастающей подпоследовательности"""
+    tails, tail_idx, prev = [], [], [None] * len(seq)
+    for i, x in enumerate(seq):
+        j = bisect.bisect_left(tails, x)
+        if j == len(tails):
+            tails.append(x)
+            tail_idx.append(i)
+        else:
+            tails[j] = x
+            tail_idx[j] = i
+        prev[i] = tail_idx[j - 1] if j else None
+
+    result = set()
+    i = tail_idx[-1] if tail_idx else None
+    while i is not None:
+        result.add(seq[i])
+        i = prev[i]
+    return result
+
+
+class TreeSync:
+    """Приводит Treeview к новому результату, меняя только то, что отличается.
+    Строки сопоставляются по iid (первичному ключу): лишние удаляются,
+    изменённые обновляются, новые вставляются, а перемещается минимум строк
+    (остаются на месте строки из наибольшей возрастающей подпоследовательности
+    старых позиций). Большие изменения применяются частями между событиями
+    Tk, поэтому окно не замирает; выделение и прокрутка сохраняются."""
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.shown = {}         # iid -> values, как они показаны
+        self.detached = set()   # строки, временно убранные незаконченной синхронизацией
+        self.ops = deque()
+        self.job = None
+        self.selection = ()
+        self.on_done = None
+        self.elapsed = 0.0      # время отрисовки текущей синхронизации (по всем частям)
+        self.rows = 0
+
+    def measure(self, what, seconds, rows):
+        """Время работы с Treeview — отдельно от времени запросов"""
+        window = type(self.tree.winfo_toplevel()).__name__
+        STATS.record("tk", f"{window}: TreeSync.{what}", seconds, rows, caller=window)
+
+    def sync(self, items, on_done=None):
+        """items — список (iid, values) в нужном порядке"""
+        started = time.perf_counter()
+        self.cancel()
+        tree = self.tree
+        self.selection = tree.selection()
+        self.on_done = on_done
+
+        # Повторяющиеся ключи (в отчётах без уникального ключа) различаем суффиксом
+        seen = {}
+        new = []
+        for iid, values in items:
+            if iid in seen:
+                seen[iid] += 1
+                iid = f"{iid}#{seen[iid]}"
+            else:
+                seen[iid] = 0
+            new.append((iid, tuple(values)))
+        new_iids = {iid for iid, _ in new}
+
+        old = tree.get_children()
+        gone = [iid for iid in old if iid not in new_iids]
+        gone += [iid for iid in self.detached if iid not in new_iids]
+        if gone:
+            tree.delete(*gone)
+            for iid in gone:
+                del self.shown[iid]
+        self.detached -= set(gone)
+
+        # Строки, которые не меняют взаимного порядка, остаются на месте,
+        # остальные отсоединяются и вставляются обратно на свои позиции
+        old_pos = {iid: i for i, iid in enumerate(old) if iid in new_iids}
+        stay = increasing_subsequence([old_pos[iid] for iid, _ in new if iid in old_pos])
+        moving = [iid for iid, i in old_pos.items() if i not in stay]
+        if moving:
+            tree.detach(*moving)
+            self.detached.update(moving)
+
+        for index, (iid, values) in enumerate(new):
+            if iid in old_pos and old_pos[iid] in stay:
+                if self.shown[iid] != values:
+                    self.ops.append(("item", index, iid, values))
+            elif iid in self.shown:
+                self.ops.append(("move", index, iid, values))
+            else:
+                self.ops.append(("insert", index, iid, values))
+        self.elapsed = time.perf_counter() - started
+        self.rows = len(new)
+        self.step()
+
+    def step(self, limit=SYNC_CHUNK):
+        started = time.perf_counter()
+        self.job = None
+        tree = self.tree
+        for _ in range(min(limit, len(self.ops))):
+            op, index, iid, values = self.ops.popleft()
+            if op == "insert":
+                tree.insert("", index, iid=iid, values=values)
+            else:
+                if op == "move":
+                    tree.move(iid, "", index)
+                    self.detached.discard(iid)
+                if self.shown[iid] != values:
+                    tree.item(iid, values=values)
+            self.shown[iid] = values
+
+        self.elapsed += time.perf_counter() - started
+        if self.ops:
+            self.job = tree.after_idle(self.step)
+            return
+
+        # Отсоединение могло снять выделение — возвращаем его
+        keep = tuple(iid for iid in self.selection if tree.exists(iid))
+        if keep and set(keep) != set(tree.selection()):
+            tree.selection_set(keep)
+        self.measure("sync", self.elapsed, self.rows)
+        if self.on_done:
+            on_done, self.on_done = self.on_done, None
+            on_done()
+
+    def cancel(self):
+        if self.job is not None:
+            self.tree.after_cancel(self.job)
+            self.job = None
+        self.ops.clear()
+
+    def finish(self):
+        """Доделать начатую синхронизацию сразу"""
+        if self.job is not None:
+            self.tree.after_cancel(self.job)
+            self.step(limit=len(self.ops))
+
+    def insert(self, items, index="end"):
+        """Вставить строки подряд с позиции index; вернуть их iid"""
+        self.finish()
+        started = time.perf_counter()
+        iids = []
+        for iid, values in items:
+            self.tree.insert("", index, iid=iid, values=values)
+            self.shown[iid] = tuple(values)
+            iids.append(iid)
+            if index != "end":
+                index += 1
+        self.measure("insert", time.perf_counter() - started, len(iids))
+        return iids
+
+    def update(self, items, position):
+        """Обновить строки по iid; новых строк position(values) даёт позицию"""
+        self.finish()
+        started = time.perf_counter()
+        for iid, values in items:
+            values = tuple(values)
+            if iid not in self.shown:
+                self.tree.insert("", position(values), iid=iid, values=values)
+            elif self.shown[iid] != values:
+                self.tree.item(iid, values=values)
+            self.shown[iid] = values
+        self.measure("update", time.perf_counter() - started, len(items))
+
+    def remove(self, iids):
+        self.finish()
+        iids = [iid for iid in iids if iid in self.shown]
+        if iids:
+            self.tree.delete(*iids)
+            for iid in iids:
+                del self.shown[iid]
+
+    def clear(self):
+        self.cancel()
+        self.tree.delete(*self.tree.get_children(), *self.detached)
+        self.shown.clear()
+        self.detached.clear()
+
+
+# Постраничная загрузка таблиц (запросы страниц — в tables.py)
+MAX_PAGES = 5          # сколько страниц держим в Treeview одновременно
+SCROLL_MARGIN = 0.05   # на каком расстоянии от края подгружать следующую страницу
+
+# Поиск в таблицах
+SEARCH_DELAY_MS = 300   # поиск при вводе запускается после паузы в наборе
+SEARCH_MIN_TEXT = 3     # короче индекс pg_trgm не помогает — при вводе не ищем
+
+
+# Пакетное изменение и удаление строк
+# Сколько ошибок по строкам показывать в отчёте
+BATCH_MAX_ERRORS = 200
+
+
+def key_condition(key_cols, keys):
+    """WHERE по набору ключей: одна колонка — = ANY(массив), составной ключ — IN"""
+    if len(key_cols) == 1:
+        return f"{key_cols[0]} = ANY(%s)", [[key[0] for key in keys]]
+    return f"({', '.join(key_cols)}) IN %s", [tuple(keys)]
+
+
+def batch_apply(db, keys, apply):
+    """Выполнить apply(cur, keys) одним запросом в одной транзакции.
+    Если пакет не прошёл, транзакция откатывается целиком, а строки
+    проверяются по одной под SAVEPOINT — чтобы назвать виновные.
+    Возвращает {ключ: ошибка}; пустой словарь — всё применено."""
+    try:
+        with db.transaction() as cur:
+            apply(cur, keys)
+        return {}
+    except psycopg2.Error as e:
+        failure = str(e).strip().splitlines()[0]
+
+    errors = {}
+    with db.connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                for key in keys:
+                    cur.execute("SAVEPOINT batch_row")
+                    try:
+                        apply(cur, [key])
+                        cur.execute("RELEASE SAVEPOINT batch_row")
+                    except psycopg2.Error as e:
+                        cur.execute("ROLLBACK TO SAVEPOINT batch_row")
+                        errors[key] = str(e).strip().splitlines()[0]
+                        if len(errors) >= BATCH_MAX_ERRORS:
+                            break
+        finally:
+            db.rollback(conn)
+    # Ошибка только на COMMIT (отложенные ограничения) — строку не назвать
+    return errors or {None: failure}
+
+
+def batch_delete(db, table, key_cols, keys):
+    def apply(cur, part):
+        condition, params = key_condition(key_cols, part)
+        cur.execute(f"DELETE FROM {table} WHERE {condition}", params)
+    return batch_apply(db, keys, apply)
+
+
+def batch_update(db, table, key_cols, column, value, keys):
+    """Одно значение поля для всех строк: один UPDATE по набору ключей"""
+    def apply(cur, part):
+        condition, params = key_condition(key_cols, part)
+        cur.execute(f"UPDATE {table} SET {column} = %s WHERE {condition}", [value] + params)
+    return batch_apply(db, keys, apply)
+
+
+def show_error_list(parent, title, header, lines, limit):
+    """Окно со списком ошибок по строкам"""
+    err_win = tk.Toplevel(parent)
+    err_win.title(title)
+    err_win.geometry("700x400")
+
+    tk.Label(err_win, text=header).pack(anchor="w", padx=5, pady=5)
+    text = tk.Text(err_win, wrap="none")
+    scrollbar = ttk.Scrollbar(err_win, orient="vertical", command=text.yview)
+    text.configure(yscrollcommand=scrollbar.set)
+    scrollbar.pack(side="right", fill="y")
+    text.pack(fill="both", expand=True, padx=5, pady=5)
+
+    for line in lines:
+        text.insert("end", line + "\n")
+    if len(lines) >= limit:
+        text.insert("end", f"... показаны первые {limit} ошибок\n")
+    text.config(state="disabled")
+    return err_win
+
+
+# Выгрузка в CSV/XLSX
+EXPORT_PROGRESS_MS = 250    # как часто окно выгрузки показывает число строк
+
+
+def start_export(parent, db, title, query, params, header):
+    """Спросить файл и выгрузить в него результат запроса; окно с числом
+    выгруженных строк и отменой. Выгрузка читает с реплики, если она есть."""
+    path = filedialog.asksaveasfilename(parent=parent, title=title, defaultextension=".csv",
+                                        filetypes=[("CSV", "*.csv"), ("Excel", "*.xlsx")])
+    if not path:
+        return
+
+    win = tk.Toplevel(parent)
+    win.title(title)
+    win.geometry("420x130")
+    status = tk.Label(win, text="Выгрузка...")
+    status.pack(anchor="w", padx=10, pady=5)
+    bar = ttk.Progressbar(win, mode="indeterminate", length=400)
+    bar.pack(padx=10, pady=5)
+    bar.start()
+    # Закрытие окна тоже отменяет выгрузку: BackgroundTask следит за окном
+    button = tk.Button(win, text="Отмена", command=win.destroy, width=15)
+    button.pack(pady=5)
+    progress = {"rows": 0}
+
+    def show_progress():
+        if task.done():
+            return
+        status.config(text=f"Выгружено строк: {progress['rows']}")
+        win.after(EXPORT_PROGRESS_MS, show_progress)
+
+    def done(rows):
+        bar.stop()
+        status.config(text=f"Готово: {rows} строк за {task.elapsed():.1f} с")
+        button.config(text="Закрыть")
+
+    def failed(e):
+        bar.stop()
+        status.config(text="Выгрузка не выполнена")
+        messagebox.showerror("Ошибка выгрузки", str(e), parent=win)
+
+    task = BackgroundTask(win, db, partial(export_query, replica=True), db, query, params,
+                          list(header), path, progress, on_done=done, on_error=failed)
+    show_progress()
 
 
 #  CRUD
 class TableManagerWindow(tk.Toplevel):
-    def __init__(self, db, table_name, columns):
+    """Окно таблицы. column_types и info (сведения для сортировки) можно
+    передать уже прочитанными, иначе окно читает их само (см. open_table)."""
+
+    def __init__(self, db, table_name, columns, column_types=None, info=None):
         super().__init__()
         self.db = db
         self.table_name = table_name
         self.columns = columns
+        self.view = table_view(table_name, columns)
+        self.loading = False
+        self.task = None
+        self.replica = True     # страницы читаются с реплики (см. load_data)
+        self.reset_pages_state()
+
+        # Поля поиска: название -> (выражение, вид)
+        if self.view["search"]:
+            fields = self.view["search"]
+        else:
+            if column_types is None:
+                column_types = db.get_column_types(table_name)
+            fields = [(col, col, column_kind(data_type)) for col, data_type in column_types]
+        self.search_fields = {name: (expr, kind) for name, expr, kind in fields}
+        if info is None:
+            info = db.get_table_info(table_name)
+        self.query = TableQuery(self.view, self.search_fields, info)
+        self.search_job = None
 
         self.title(f"Управление таблицей: {table_name}")
         self.geometry("1200x600")
@@ -74,41 +873,51 @@ class TableManagerWindow(tk.Toplevel):
         search_frame.pack(fill="x", padx=5, pady=5)
 
         tk.Label(search_frame, text="Поиск по полю:").pack(side="left")
-        self.search_col = ttk.Combobox(search_frame, values=columns[1:], width=15)
+        self.search_col = ttk.Combobox(search_frame, values=list(self.search_fields),
+                                       width=15, state="readonly")
         self.search_col.pack(side="left", padx=5)
         self.search_entry = tk.Entry(search_frame, width=20)
         self.search_entry.pack(side="left", padx=5)
         tk.Button(search_frame, text="Поиск", command=self.apply_filter).pack(side="left", padx=5)
-        tk.Button(search_frame, text="Сброс", command=self.load_data).pack(side="left", padx=5)
+        tk.Button(search_frame, text="Сброс", command=self.reset_search).pack(side="left", padx=5)
+
+        # Поиск при вводе: текст — подстрока, числа и даты — «10», «5..20», «>=2025-01-01»
+        self.search_entry.bind("<KeyRelease>", self.on_search_typed)
+        self.search_entry.bind("<Return>", lambda e: self.apply_filter())
+        self.search_col.bind("<<ComboboxSelected>>", self.on_search_typed)
 
         tk.Label(search_frame, text="Сортировка:").pack(side="left", padx=10)
-        self.sort_col = ttk.Combobox(search_frame, values=columns, width=15)
+        self.sort_col = ttk.Combobox(search_frame, values=list(self.search_fields),
+                                     width=15, state="readonly")
         self.sort_col.pack(side="left", padx=5)
-        self.sort_order = ttk.Combobox(search_frame, values=["ASC", "DESC"], width=5)
+        self.sort_order = ttk.Combobox(search_frame, values=["ASC", "DESC"], width=5, state="readonly")
         self.sort_order.current(0)
         self.sort_order.pack(side="left", padx=5)
         tk.Button(search_frame, text="Сортировать", command=self.apply_sort).pack(side="left", padx=5)
+        tk.Button(search_frame, text="+ Затем по",
+                  command=lambda: self.apply_sort(add=True)).pack(side="left", padx=5)
 
         # Таблица с прокруткой
         table_frame = tk.Frame(self)
         table_frame.pack(fill="both", expand=True, padx=5, pady=5)
 
-        scrollbar_y = ttk.Scrollbar(table_frame, orient="vertical")
+        self.scrollbar_y = ttk.Scrollbar(table_frame, orient="vertical")
         scrollbar_x = ttk.Scrollbar(table_frame, orient="horizontal")
 
         self.tree = ttk.Treeview(table_frame, columns=columns, show="headings",
-                                 yscrollcommand=scrollbar_y.set,
+                                 yscrollcommand=self.on_scroll,
                                  xscrollcommand=scrollbar_x.set)
         
-        scrollbar_y.config(command=self.tree.yview)
+        self.scrollbar_y.config(command=self.tree.yview)
         scrollbar_x.config(command=self.tree.xview)
-        scrollbar_y.pack(side="right", fill="y")
+        self.scrollbar_y.pack(side="right", fill="y")
         scrollbar_x.pack(side="bottom", fill="x")
         self.tree.pack(side="left", fill="both", expand=True)
 
         for col in columns:
             self.tree.heading(col, text=col)
             self.tree.column(col, width=120)
+        self.sync = TreeSync(self.tree)
 
         # Контекстное меню
         self.menu = tk.Menu(self, tearoff=0)
@@ -124,182 +933,227 @@ class TableManagerWindow(tk.Toplevel):
         tk.Button(btn_frame, text="Добавить", command=self.add_record, width=15).pack(side="left", padx=5)
         tk.Button(btn_frame, text="Редактировать", command=self.edit_record, width=15).pack(side="left", padx=5)
         tk.Button(btn_frame, text="Удалить", command=self.delete_record, width=15).pack(side="left", padx=5)
+        tk.Button(btn_frame, text="Экспорт", command=self.export_data, width=15).pack(side="left", padx=5)
+        tk.Button(btn_frame, text="Отмена", command=self.cancel_task, width=15).pack(side="right", padx=5)
+        self.status = tk.Label(btn_frame, text="", fg="gray")
+        self.status.pack(side="left", padx=10)
 
         self.load_data()
 
     def show_menu(self, event):
         selected = self.tree.identify_row(event.y)
         if selected:
-            self.tree.selection_set(selected)
+            # Щелчок по выделенной строке не сбрасывает множественное выделение
+            if selected not in self.tree.selection():
+                self.tree.selection_set(selected)
             self.menu.post(event.x_root, event.y_root)
 
-    # def load_data(self):
-    #     try:
-    #         query = f"SELECT * FROM {self.table_name}"
-    #         rows = self.db.fetch(query)
-    #     except Exception as e:
-    #         messagebox.showerror("Ошибка загрузки", str(e))
-    #         return
+    def load_data(self, replica=True):
+        """Загрузить первую страницу таблицы (keyset-пагинация по ключу).
+        Таблица не очищается: страница накладывается на показанные строки.
+        После своих изменений — replica=False: страницы читаются с основного
+        сервера, реплика могла ещё не получить запись."""
+        self.cancel_task()
+        self.reset_pages_state()
+        self.replica = replica
+        self.paging = True
+        self.request_page(self.show_first_page)
+
+    # Фоновые запросы окна
+    def run_task(self, query, params, on_done, title, replica=False):
+        self.cancel_task()
+        self.loading = True
+
+        def done(rows):
+            self.loading = False
+            on_done(rows)
+
+        def failed(e):
+            self.loading = False
+            messagebox.showerror(title, str(e))
+
+        self.task = QueryTask(self, self.db, query, params, on_done=done, on_error=failed,
+                              replica=replica)
+
+    def cancel_task(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.task = None
+        self.loading = False
+
+    # Постраничная загрузка
+    def reset_pages_state(self):
+        self.paging = False
+        self.pages = deque()
+        self.row_keys = {}
+        self.has_more_after = False
+        self.has_more_before = False
+
+    def show_first_page(self, rows):
+        items, self.row_keys = self.query.split(rows)
+        self.sync.sync(items)
+        if items:
+            self.pages.append([iid for iid, _ in items])
+        self.has_more_after = len(rows) == PAGE_SIZE
+
+    def request_page(self, callback, after=None, before=None):
+        query, params = self.query.page(after, before)
+
+        def done(rows):
+            if before is not None:
+                rows.reverse()
+            callback(rows)
+
+        self.run_task(query, params, done, "Ошибка загрузки", replica=self.replica)
+
+    def insert_rows(self, rows, index):
+        items, cursors = self.query.split(rows)
+        self.row_keys.update(cursors)
+        return self.sync.insert(items, index)
+
+    def drop_page(self, page):
+        self.sync.remove(page)
+        for iid in page:
+            del self.row_keys[iid]
+
+    def append_page(self, rows):
+        self.has_more_after = len(rows) == PAGE_SIZE
+        if rows:
+            self.pages.append(self.insert_rows(rows, "end"))
+
+        # Страницы далеко выше экрана выбрасываем, сохраняя позицию прокрутки
+        if len(self.pages) > MAX_PAGES:
+            top = self.top_index()
+            removed = self.pages.popleft()
+            self.drop_page(removed)
+            self.has_more_before = True
+            self.scroll_to_index(top - len(removed))
+
+    def prepend_page(self, rows):
+        self.has_more_before = len(rows) == PAGE_SIZE
+        if not rows:
+            return
+        top = self.top_index()
+        self.pages.appendleft(self.insert_rows(rows, 0))
+
+        if len(self.pages) > MAX_PAGES:
+            self.drop_page(self.pages.pop())
+            self.has_more_after = True
+        self.scroll_to_index(top + len(rows))
+
+    def top_index(self):
+        total = len(self.tree.get_children())
+        return round(float(self.tree.yview()[0]) * total)
+
+    def scroll_to_index(self, index):
+        total = len(self.tree.get_children())
+        if total:
+            self.tree.yview_moveto(max(index, 0) / total)
+
+    def on_scroll(self, first, last):
+        self.scrollbar_y.set(first, last)
+        if not self.paging or self.loading:
+            return
+        if float(last) > 1 - SCROLL_MARGIN and self.has_more_after:
+            self.load_next_page()
+        elif float(first) < SCROLL_MARGIN and self.has_more_before:
+            self.load_prev_page()
+
+    def load_next_page(self):
+        last_iid = self.pages[-1][-1]
+        self.request_page(self.append_page, after=self.row_keys[last_iid])
+
+    def load_prev_page(self):
+        first_iid = self.pages[0][0]
+        self.request_page(self.prepend_page, before=self.row_keys[first_iid])
+
+    def apply_filter(self, quiet=False):
+        """Поиск по выбранному полю с учётом его типа. Результат читается
+        страницами по ключу, как и вся таблица, с теми же соединениями."""
+        col = self.search_col.get()
+        val = self.search_entry.get().strip()
 
-    #     self.tree.delete(*self.tree.get_children())
-    #     for row in rows:
-    #         self.tree.insert("", "end", values=row)
+        if not col or not val:
+            if not quiet:
+                messagebox.showinfo("Поиск", "Выберите поле и введите значение для поиска")
+            return
 
-    def load_data(self):
+        expr, kind = self.search_fields[col]
         try:
-            if self.table_name == "staff":
-                query = """
-                    SELECT 
-                        s.staff_id,
-                        w.name AS warehouse,
-                        s.full_name,
-                        p.name AS position,
-                        s.inn,
-                        s.hired_at
-                    FROM staff s
-                    JOIN warehouses w ON w.warehouse_id = s.warehouse_id
-                    JOIN positions p ON p.position_id = s.position_id
-                    ORDER BY s.staff_id
-                """
-
-            elif self.table_name == "incoming_invoices":
-                query = """
-                    SELECT 
-                        i.incoming_id,
-                        w.name AS warehouse,
-                        i.supplier,
-                        i.invoice_number,
-                        i.invoice_date,
-                        i.total_amount
-                    FROM incoming_invoices i
-                    JOIN warehouses w ON w.warehouse_id = i.warehouse_id
-                    ORDER BY i.incoming_id
-                """
-
-            elif self.table_name == "incoming_items":
-                query = """
-                    SELECT 
-                        it.incoming_item_id,
-                        inv.invoice_number AS invoice,
-                        p.name AS product,
-                        it.quantity,
-                        it.unit_price,
-                        it.line_total
-                    FROM incoming_items it
-                    JOIN incoming_invoices inv ON inv.incoming_id = it.incoming_id
-                    JOIN products p ON p.product_id = it.product_id
-                    ORDER BY it.incoming_item_id
-                """
-
-            elif self.table_name == "outgoing_invoices":
-                query = """
-                    SELECT 
-                        o.outgoing_id,
-                        w.name AS warehouse,
-                        o.customer,
-                        o.invoice_number,
-                        o.invoice_date,
-                        o.total_amount
-                    FROM outgoing_invoices o
-                    JOIN warehouses w ON w.warehouse_id = o.warehouse_id
-                    ORDER BY o.outgoing_id
-                """
-
-            elif self.table_name == "outgoing_items":
-                query = """
-                    SELECT 
-                        ot.outgoing_item_id,
-                        inv.invoice_number AS invoice,
-                        p.name AS product,
-                        ot.quantity,
-                        ot.unit_price,
-                        ot.line_total
-                    FROM outgoing_items ot
-                    JOIN outgoing_invoices inv ON inv.outgoing_id = ot.outgoing_id
-                    JOIN products p ON p.product_id = ot.product_id
-                    ORDER BY ot.outgoing_item_id
-                """
-
-            elif self.table_name == "stock_balances":
-                query = """
-                    SELECT
-                        w.name AS warehouse,
-                        p.sku,
-                        p.name AS product,
-                        sb.qty,
-                        sb.last_updated
-                    FROM stock_balances sb
-                    JOIN warehouses w ON w.warehouse_id = sb.warehouse_id
-                    JOIN products p ON p.product_id = sb.product_id
-                    ORDER BY w.name, p.name
-                """
-
-            elif self.table_name == "products":
-                query = """
-                    SELECT product_id, sku, name, unit, price, created_at
-                    FROM products
-                """
-
-            else:
-                query = f"SELECT * FROM {self.table_name}"
-
-            rows = self.db.fetch(query)
-
-        except Exception as e:
-            messagebox.showerror("Ошибка загрузки", str(e))
+            self.query.filters = [search_predicate(expr, kind, val, col)]
+        except ValueError as e:
+            if not quiet:
+                messagebox.showwarning("Поиск", str(e))
             return
+        self.load_data()
 
-        self.tree.delete(*self.tree.get_children())
-        for row in rows:
-            self.tree.insert("", "end", values=row)
-
-
+    def on_search_typed(self, event=None):
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+        self.search_job = self.after(SEARCH_DELAY_MS, self.search_as_you_type)
 
-    def apply_filter(self):
+    def search_as_you_type(self):
+        self.search_job = None
         col = self.search_col.get()
-        val = self.search_entry.get()
-        
-        if not col or not val:
-            messagebox.showinfo("Поиск", "Выберите поле и введите значение для поиска")
+        val = self.search_entry.get().strip()
+        if not val:
+            if self.query.filters:
+                self.reset_search()
             return
-
-        query = f"SELECT * FROM {self.table_name} WHERE CAST({col} AS TEXT) ILIKE %s"
-        params = [f"%{val}%"]
-
-        try:
-            rows = self.db.fetch(query, params)
-        except Exception as e:
-            messagebox.showerror("Ошибка поиска", str(e))
+        if not col or (self.search_fields[col][1] == "text" and len(val) < SEARCH_MIN_TEXT):
             return
+        self.apply_filter(quiet=True)
 
-        self.tree.delete(*self.tree.get_children())
-        for row in rows:
-            self.tree.insert("", "end", values=row)
+    def reset_search(self):
+        self.query.filters = []
+        self.search_entry.delete(0, tk.END)
+        self.load_data()
 
-    def apply_sort(self):
-        order_col = self.sort_col.get()
-        order = self.sort_order.get() or "ASC"
+    def apply_sort(self, add=False):
+        """Сортировка вместе с поиском и страницами — одним запросом.
+        Первое поле сортировки должно идти по индексу (или таблица небольшая),
+        иначе сортируются только уже загруженные строки."""
+        name = self.sort_col.get()
+        desc = self.sort_order.get() == "DESC"
 
-        if not order_col:
+        if not name:
             messagebox.showinfo("Сортировка", "Выберите колонку для сортировки")
             return
 
-        query = f"SELECT * FROM {self.table_name} ORDER BY {order_col} {order.upper()}"
-        try:
-            rows = self.db.fetch(query)
-        except Exception as e:
-            messagebox.showerror("Ошибка сортировки", str(e))
+        sort = [s for s in self.query.sort if s[0] != name] if add else []
+        sort.append((name, desc))
+        if not self.query.sortable(sort[0][0]):
+            self.sort_loaded(sort)
             return
 
-        self.tree.delete(*self.tree.get_children())
-        for row in rows:
-            self.tree.insert("", "end", values=row)
+        self.query.sort = sort
+        self.status.config(text="Сортировка: " + ", ".join(
+            f"{n} {'↓' if d else '↑'}" for n, d in sort))
+        self.load_data()
+
+    def sort_loaded(self, sort):
+        """Сортировка загруженных строк на клиенте, без запроса"""
+        names = list(self.search_fields)
+        items = [(iid, self.sync.shown[iid]) for iid in self.tree.get_children()]
+        for name, desc in reversed(sort):
+            i = names.index(name)
+            items.sort(key=lambda item: (item[1][i] is None, item[1][i]), reverse=desc)
+
+        # Порядок страниц больше не соответствует запросу — подгрузку выключаем
+        self.cancel_task()
+        self.paging = False
+        self.sync.sync(items)
+        self.status.config(text=f"Поле «{sort[0][0]}» без индекса: отсортированы только "
+                                f"загруженные строки ({len(items)})")
 
     def edit_record(self):
         selected = self.tree.selection()
         if not selected:
             messagebox.showinfo("Редактирование", "Выберите запись для редактирования")
             return
+        if len(selected) > 1:
+            self.edit_records(selected)
+            return
         item = self.tree.item(selected[0])
         values = item['values']
         record_id = values[0]
@@ -337,7 +1191,7 @@ class TableManagerWindow(tk.Toplevel):
                 self.db.execute(query, new_values + [record_id])
                 messagebox.showinfo("Редактирование", "Запись обновлена")
                 edit_win.destroy()
-                self.load_data()
+                self.load_data(replica=False)
             except Exception as e:
                 messagebox.showerror("Ошибка", str(e))
 
@@ -348,22 +1202,84 @@ class TableManagerWindow(tk.Toplevel):
         canvas.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
 
+    def export_data(self):
+        """Выгрузить всю таблицу с текущим поиском и сортировкой, а не только загруженные страницы"""
+        query, params = self.query.export()
+        start_export(self, self.db, f"Экспорт: {self.table_name}", query, params, self.tree["columns"])
+
+    # Пакетные операции над выделенными строками
+    def key_columns(self):
+        """Колонки ключа в самой таблице (без псевдонима представления)"""
+        return [key.split(".")[-1] for key in self.view["key"]]
+
+    def selected_keys(self, selected):
+        """Ключи выделенных строк: {ключ: iid}. Ключ — хвост курсора строки."""
+        n_key = len(self.view["key"])
+        return {self.row_keys[iid][-n_key:]: iid for iid in selected}
+
+    def run_batch(self, title, keys, action):
+        """Выполнить action(ключи) -> {ключ: ошибка}. При ошибках показать их
+        по строкам и предложить применить к остальным; в конце — одно обновление."""
+        errors = action(list(keys))
+        if errors:
+            lines = [f"{keys[key] if key is not None else 'Весь пакет'}: {reason}"
+                     for key, reason in errors.items()]
+            show_error_list(self, title, "Изменения не применены. Ошибки по строкам:",
+                            lines, BATCH_MAX_ERRORS)
+            rest = [key for key in keys if key not in errors]
+            if (None not in errors and rest and len(errors) < BATCH_MAX_ERRORS
+                    and messagebox.askyesno(title, f"Применить к остальным строкам ({len(rest)})?")):
+                errors = action(rest)
+                if errors:
+                    messagebox.showerror(title, next(iter(errors.values())))
+                else:
+                    messagebox.showinfo(title, f"Обработано строк: {len(rest)}")
+        else:
+            messagebox.showinfo(title, f"Обработано строк: {len(keys)}")
+        self.load_data(replica=False)
+
+    def edit_records(self, selected):
+        """Одно значение поля для всех выделенных строк"""
+        key_cols = self.key_columns()
+        fields = [col for col in self.columns if col not in key_cols]
+        keys = self.selected_keys(selected)
+
+        edit_win = tk.Toplevel(self)
+        edit_win.title(f"Изменить записи ({len(keys)})")
+        edit_win.geometry("400x160")
+
+        tk.Label(edit_win, text="Поле").grid(row=0, column=0, padx=5, pady=5, sticky="w")
+        field = ttk.Combobox(edit_win, values=fields, width=27, state="readonly")
+        field.grid(row=0, column=1, padx=5, pady=5)
+        tk.Label(edit_win, text="Значение").grid(row=1, column=0, padx=5, pady=5, sticky="w")
+        value = tk.Entry(edit_win, width=30)
+        value.grid(row=1, column=1, padx=5, pady=5)
+
+        def save_changes():
+            column = field.get()
+            if not column:
+                messagebox.showerror("Ошибка", "Выберите поле", parent=edit_win)
+                return
+            new_value = value.get() if value.get() != '' else None
+            edit_win.destroy()
+            self.run_batch("Редактирование", keys, lambda part: batch_update(
+                self.db, self.table_name, key_cols, column, new_value, part))
+
+        tk.Button(edit_win, text="Сохранить", command=save_changes).grid(
+            row=2, column=0, columnspan=2, pady=10
+        )
+
     def delete_record(self):
         selected = self.tree.selection()
         if not selected:
             messagebox.showinfo("Удаление", "Выберите запись для удаления")
             return
-        item = self.tree.item(selected[0])
-        record_id = item['values'][0]
-        
-        if messagebox.askyesno("Удаление", "Вы действительно хотите удалить запись?"):
-            try:
-                query = f"DELETE FROM {self.table_name} WHERE {self.columns[0]}=%s"
-                self.db.execute(query, (record_id,))
-                messagebox.showinfo("Удаление", "Запись удалена")
-                self.load_data()
-            except Exception as e:
-                messagebox.showerror("Ошибка", str(e))
+        keys = self.selected_keys(selected)
+
+        if messagebox.askyesno("Удаление", f"Вы действительно хотите удалить записи ({len(keys)})?"):
+            key_cols = self.key_columns()
+            self.run_batch("Удаление", keys, lambda part: batch_delete(
+                self.db, self.table_name, key_cols, part))
 
     def add_record(self):
         add_win = tk.Toplevel(self)
@@ -421,7 +1337,7 @@ class TableManagerWindow(tk.Toplevel):
                 self.db.execute(query, new_values)
                 messagebox.showinfo("Добавление", "Запись добавлена")
                 add_win.destroy()
-                self.load_data()
+                self.load_data(replica=False)
             except Exception as e:
                 messagebox.showerror("Ошибка", str(e))
 
@@ -433,11 +1349,336 @@ class TableManagerWindow(tk.Toplevel):
         scrollbar.pack(side="right", fill="y")
 
 
+# Выбор товара с подсказками
+PICKER_LIMIT = 20       # вариантов в подсказке
+PICKER_DELAY_MS = 150   # запрос уходит после паузы в наборе
+
+# Слова названия — по индексу tsvector (префиксы слов), SKU — по началу
+# (индекс upper(sku) text_pattern_ops). Совпадения по SKU идут первыми.
+PRODUCT_SEARCH_QUERY = """
+    SELECT product_id, name, sku, price
+    FROM products
+    WHERE to_tsvector('simple', name) @@ to_tsquery('simple', %s)
+       OR upper(sku) LIKE %s
+    ORDER BY upper(sku) LIKE %s DESC,
+             ts_rank(to_tsvector('simple', name), to_tsquery('simple', %s)) DESC,
+             name
+    LIMIT %s
+"""
+
+
+def product_tsquery(text):
+    """Ввод -> tsquery с префиксами слов: «болт м8» -> «болт:* & м8:*»"""
+    return " & ".join(f"{word}:*" for word in re.findall(r"\w+", text.lower()))
+
+
+class ProductPicker(tk.Frame):
+    """Поле ввода товара с подсказками. На каждый ввод сервер возвращает
+    PICKER_LIMIT лучших совпадений, каталог целиком не загружается.
+    on_select(товар) вызывается с кортежем (id, название, sku, цена)."""
+
+    def __init__(self, master, db, on_select=None, width=40):
+        super().__init__(master)
+        self.db = db
+        self.on_select = on_select
+        self.product = None     # выбранный товар
+        self.matches = {}       # product_id -> товар из последней подсказки
+        self.shown = []         # product_id в порядке строк списка
+        self.text = ""          # текст, по которому построена подсказка
+        self.task = None
+        self.job = None
+
+        self.entry = tk.Entry(self, width=width)
+        self.entry.pack(fill="x")
+        self.listbox = tk.Listbox(self, height=8, width=width, exportselection=False)
+        self.listbox.pack(fill="both", expand=True)
+
+        self.entry.bind("<KeyRelease>", self.on_key)
+        self.entry.bind("<Down>", lambda e: self.move(1))
+        self.entry.bind("<Up>", lambda e: self.move(-1))
+        self.entry.bind("<Return>", lambda e: self.pick())
+        self.listbox.bind("<<ListboxSelect>>", lambda e: self.pick())
+
+    def on_key(self, event):
+        text = self.entry.get().strip()
+        if text == self.text:
+            return
+        self.text = text
+        self.product = None
+        if self.job is not None:
+            self.after_cancel(self.job)
+        self.job = self.after(PICKER_DELAY_MS, self.search)
+
+    def search(self):
+        self.job = None
+        if self.task is not None:
+            self.task.cancel()
+
+        query = product_tsquery(self.text)
+        if not query:
+            self.show_matches([])
+            return
+        sku = like_escape(self.text.upper()) + "%"
+        params = (query, sku, sku, query, PICKER_LIMIT)
+        self.task = QueryTask(self, self.db, PRODUCT_SEARCH_QUERY, params,
+                              on_done=self.show_matches, prepare=True, replica=True)
+
+    def show_matches(self, rows):
+        self.matches = {row[0]: row for row in rows}
+        self.shown = [row[0] for row in rows]
+        self.listbox.delete(0, tk.END)
+        for product_id, name, sku, price in rows:
+            self.listbox.insert(tk.END, f"{name} ({sku}) — {price}")
+
+    def move(self, step):
+        if not self.shown:
+            return
+        current = self.listbox.curselection()
+        index = current[0] + step if current else 0
+        index = max(0, min(index, len(self.shown) - 1))
+        self.listbox.selection_clear(0, tk.END)
+        self.listbox.selection_set(index)
+        self.listbox.see(index)
+
+    def pick(self):
+        current = self.listbox.curselection()
+        if not current and not self.shown:
+            return
+        product = self.matches[self.shown[current[0] if current else 0]]
+        self.set_product(product)
+        if self.on_select:
+            self.on_select(product)
+
+    def set_product(self, product):
+        self.product = product
+        self.text = f"{product[1]} ({product[2]})"
+        self.entry.delete(0, tk.END)
+        self.entry.insert(0, self.text)
+
+    def clear(self):
+        self.product = None
+        self.text = ""
+        self.entry.delete(0, tk.END)
+        self.show_matches([])
+
+
+# Ввод накладной целиком
+def post_invoice(db, invoice_type, warehouse_id, counterparty, number, invoice_date, lines,
+                 on_conn=None):
+    """Шапка и все строки накладной одним оператором в одной транзакции:
+    INSERT шапки в CTE и один INSERT ... VALUES на все позиции, так что
+    триггеры остатков и сумм срабатывают один раз. lines — (product_id,
+    количество, цена). Возвращает id накладной."""
+    t = INVOICE_TABLES[invoice_type]
+    with db.transaction(on_conn) as cur:
+        # execute_values подставляет только VALUES — шапку вписываем заранее
+        header = cur.mogrify("%s, %s, %s, %s", (warehouse_id, counterparty, number, invoice_date))
+        header = header.decode().replace("%", "%%")
+        rows = psycopg2.extras.execute_values(cur, f"""
+            WITH inv AS (
+                INSERT INTO {t["invoices"]} (warehouse_id, {t["counterparty"]}, invoice_number, invoice_date)
+                VALUES ({header})
+                RETURNING {t["invoice_id"]}, invoice_date
+            )
+            INSERT INTO {t["items"]} ({t["invoice_id"]}, product_id, quantity, unit_price, invoice_date)
+            SELECT inv.{t["invoice_id"]}, v.product_id, v.quantity, v.unit_price, inv.invoice_date
+            FROM inv, (VALUES %s) AS v (product_id, quantity, unit_price)
+            RETURNING {t["invoice_id"]}
+        """, lines, page_size=len(lines), fetch=True)
+    return rows[0][0]
+
+
+class InvoiceEntryWindow(tk.Toplevel):
+    """Новая накладная: шапка и таблица строк. Суммы считаются на клиенте,
+    в базу всё уходит одним запросом при проведении."""
+
+    def __init__(self, master, db, invoice_type, refs):
+        super().__init__(master)
+        self.db = db
+        self.invoice_type = invoice_type
+        self.lines = {}     # iid -> [товар, количество, цена]
+        self.counter = itertools.count(1)
+        self.task = None
+
+        self.title("Новая накладная")
+        self.geometry("900x650")
+
+        # Шапка
+        head = tk.Frame(self)
+        head.pack(fill="x", padx=5, pady=5)
+        warehouses = refs.rows("warehouses")
+        tk.Label(head, text="Склад:").grid(row=0, column=0, padx=5, pady=3, sticky="w")
+        self.warehouse = ttk.Combobox(head, width=30, state="readonly",
+                                      values=[f"{w[0]} - {w[1]}" for w in warehouses])
+        if warehouses:
+            self.warehouse.current(0)
+        self.warehouse.grid(row=0, column=1, padx=5, pady=3, sticky="w")
+        label = "Поставщик:" if invoice_type == "incoming" else "Покупатель:"
+        tk.Label(head, text=label).grid(row=0, column=2, padx=5, pady=3, sticky="w")
+        self.counterparty = tk.Entry(head, width=30)
+        self.counterparty.grid(row=0, column=3, padx=5, pady=3)
+        tk.Label(head, text="Номер:").grid(row=1, column=0, padx=5, pady=3, sticky="w")
+        self.number = tk.Entry(head, width=20)
+        self.number.grid(row=1, column=1, padx=5, pady=3, sticky="w")
+        tk.Label(head, text="Дата:").grid(row=1, column=2, padx=5, pady=3, sticky="w")
+        self.invoice_date = tk.Entry(head, width=12)
+        self.invoice_date.insert(0, date.today().strftime("%Y-%m-%d"))
+        self.invoice_date.grid(row=1, column=3, padx=5, pady=3, sticky="w")
+
+        # Строки накладной
+        cols = ["SKU", "Товар", "Количество", "Цена за единицу", "Сумма"]
+        self.tree = ttk.Treeview(self, columns=cols, show="headings", height=12)
+        for col in cols:
+            self.tree.heading(col, text=col)
+            self.tree.column(col, width=150)
+        self.tree.pack(fill="both", expand=True, padx=5, pady=5)
+        self.tree.bind("<<TreeviewSelect>>", self.on_line_select)
+
+        self.total = tk.Label(self, text="Итого: 0.00", font=("Arial", 11, "bold"))
+        self.total.pack(anchor="e", padx=10)
+
+        # Ввод строки: товар по SKU или названию, количество, цена
+        line = tk.LabelFrame(self, text="Строка", padx=5, pady=5)
+        line.pack(fill="x", padx=5, pady=5)
+        self.picker = ProductPicker(line, db, on_select=self.on_product_select, width=40)
+        self.picker.grid(row=0, column=0, rowspan=4, padx=5, sticky="n")
+        tk.Label(line, text="Количество:").grid(row=0, column=1, padx=5, sticky="w")
+        self.qty = tk.Entry(line, width=12)
+        self.qty.grid(row=0, column=2, padx=5)
+        tk.Label(line, text="Цена:").grid(row=1, column=1, padx=5, sticky="w")
+        self.price = tk.Entry(line, width=12)
+        self.price.grid(row=1, column=2, padx=5)
+        self.qty.bind("<Return>", lambda e: self.add_line())
+        self.price.bind("<Return>", lambda e: self.add_line())
+        tk.Button(line, text="Добавить строку", command=self.add_line, width=18).grid(row=0, column=3, padx=5)
+        tk.Button(line, text="Изменить строку", command=self.change_line, width=18).grid(row=1, column=3, padx=5)
+        tk.Button(line, text="Удалить строку", command=self.delete_line, width=18).grid(row=2, column=3, padx=5)
+
+        btn_frame = tk.Frame(self)
+        btn_frame.pack(fill="x", padx=5, pady=5)
+        self.post_button = tk.Button(btn_frame, text="Провести", command=self.post, width=20)
+        self.post_button.pack(side="left", padx=5)
+        tk.Button(btn_frame, text="Закрыть", command=self.destroy, width=20).pack(side="left", padx=5)
+        self.status = tk.Label(btn_frame, text="", fg="gray")
+        self.status.pack(side="left", padx=10)
+
+        self.picker.entry.focus_set()
+
+    def on_product_select(self, product):
+        self.price.delete(0, tk.END)
+        self.price.insert(0, str(product[3]))
+        self.qty.focus_set()
+
+    def read_line(self):
+        """Поля ввода -> [товар, количество, цена] или None с сообщением"""
+        if self.picker.product is None:
+            messagebox.showwarning("Ошибка", "Выберите товар", parent=self)
+            return None
+        try:
+            qty = parse_decimal(self.qty.get(), "количество")
+            price = parse_decimal(self.price.get(), "цена")
+            if qty <= 0 or price < 0:
+                raise ValueError("количество должно быть больше 0, цена — не меньше 0")
+        except ValueError as e:
+            messagebox.showwarning("Ошибка", str(e), parent=self)
+            return None
+        return [self.picker.product, qty, price]
+
+    def line_values(self, line):
+        product, qty, price = line
+        return (product[2], product[1], qty, price, f"{qty * price:.2f}")
+
+    def add_line(self):
+        line = self.read_line()
+        if line is None:
+            return
+        iid = str(next(self.counter))
+        self.lines[iid] = line
+        self.tree.insert("", "end", iid=iid, values=self.line_values(line))
+        self.tree.see(iid)
+        self.update_total()
+
+        # Следующая строка
+        self.picker.clear()
+        self.qty.delete(0, tk.END)
+        self.price.delete(0, tk.END)
+        self.picker.entry.focus_set()
+
+    def change_line(self):
+        selected = self.tree.selection()
+        if not selected:
+            return
+        line = self.read_line()
+        if line is None:
+            return
+        self.lines[selected[0]] = line
+        self.tree.item(selected[0], values=self.line_values(line))
+        self.update_total()
+
+    def delete_line(self):
+        for iid in self.tree.selection():
+            del self.lines[iid]
+            self.tree.delete(iid)
+        self.update_total()
+
+    def on_line_select(self, event=None):
+        selected = self.tree.selection()
+        if not selected:
+            return
+        product, qty, price = self.lines[selected[0]]
+        self.picker.set_product(product)
+        self.qty.delete(0, tk.END)
+        self.qty.insert(0, str(qty))
+        self.price.delete(0, tk.END)
+        self.price.insert(0, str(price))
+
+    def update_total(self):
+        total = sum((qty * price for _, qty, price in self.lines.values()), Decimal(0))
+        self.total.config(text=f"Итого: {total:.2f} ({len(self.lines)} строк)")
+
+    def post(self):
+        if not self.warehouse.get() or not self.counterparty.get().strip() or not self.number.get().strip():
+            messagebox.showwarning("Ошибка", "Заполните склад, контрагента и номер", parent=self)
+            return
+        if not self.lines:
+            messagebox.showwarning("Ошибка", "В накладной нет строк", parent=self)
+            return
+        try:
+            invoice_date = parse_date(self.invoice_date.get().strip())
+        except ValueError as e:
+            messagebox.showwarning("Ошибка", str(e), parent=self)
+            return
+
+        warehouse_id = int(self.warehouse.get().split(' - ')[0])
+        lines = [(product[0], qty, price) for product, qty, price in self.lines.values()]
+
+        def done(invoice_id):
+            # Накладная появится в списке по уведомлению invoice_changes
+            messagebox.showinfo("Успех", f"Накладная проведена, строк: {len(lines)}", parent=self)
+            self.destroy()
+
+        def failed(e):
+            self.post_button.config(state="normal")
+            self.status.config(text="")
+            messagebox.showerror("Ошибка", str(e), parent=self)
+
+        self.post_button.config(state="disabled")
+        self.status.config(text="Проведение...")
+        self.task = BackgroundTask(self, self.db, post_invoice, self.db, self.invoice_type, warehouse_id,
+                                   self.counterparty.get().strip(), self.number.get().strip(),
+                                   invoice_date, lines, on_done=done, on_error=failed)
+
+
 # Приходная/расходная накладная
+INVOICE_PERIOD_DAYS = 90   # период накладных по умолчанию
+
+
 class InvoiceItemsWindow(tk.Toplevel):
-    def __init__(self, db, invoice_type):
+    def __init__(self, db, invoice_type, refs, changes):
         super().__init__()
         self.db = db
+        self.refs = refs
+        self.changes = changes
         self.invoice_type = invoice_type  
         
         if invoice_type == 'incoming':
@@ -445,14 +1686,21 @@ class InvoiceItemsWindow(tk.Toplevel):
             self.items_table = "incoming_items"
             self.invoice_id_col = "incoming_id"
             self.item_id_col = "incoming_item_id"
+            self.counterparty_col = "supplier"
             self.title_text = "Приходные накладные и позиции"
         else:
             self.invoice_table = "outgoing_invoices"
             self.items_table = "outgoing_items"
             self.invoice_id_col = "outgoing_id"
             self.item_id_col = "outgoing_item_id"
+            self.counterparty_col = "customer"
             self.title_text = "Расходные накладные и позиции"
 
+        # Общая часть запросов накладных и позиций; условия добавляются по месту
+        self.invoice_select = invoice_select(self.invoice_table, self.invoice_id_col,
+                                             self.counterparty_col)
+        self.items_select = items_select(self.items_table, self.item_id_col)
+
         self.title(self.title_text)
         self.geometry("1400x700")
 
@@ -476,11 +1724,25 @@ class InvoiceItemsWindow(tk.Toplevel):
             self.invoice_tree.column(col, width=120)
 
         self.invoice_tree.bind("<<TreeviewSelect>>", self.load_items)
+        self.invoice_sync = TreeSync(self.invoice_tree)
 
         # Кнопки для накладных
         invoice_btn_frame = tk.Frame(self)
         invoice_btn_frame.pack(fill="x", padx=5, pady=2)
         tk.Button(invoice_btn_frame, text="Обновить накладные", command=self.load_invoices, width=20).pack(side="left", padx=5)
+        tk.Button(invoice_btn_frame, text="Отмена", command=self.cancel_tasks, width=20).pack(side="left", padx=5)
+        tk.Button(invoice_btn_frame, text="Новая накладная", command=self.new_invoice, width=20).pack(side="left", padx=5)
+        tk.Button(invoice_btn_frame, text="Импорт из CSV", command=self.import_csv, width=20).pack(side="left", padx=5)
+
+        # Период накладных: по дате отсекаются ненужные секции таблиц
+        tk.Label(invoice_btn_frame, text="Период с:").pack(side="left", padx=5)
+        self.f_date_from = tk.Entry(invoice_btn_frame, width=12)
+        self.f_date_from.insert(0, (date.today() - timedelta(days=INVOICE_PERIOD_DAYS)).strftime("%Y-%m-%d"))
+        self.f_date_from.pack(side="left")
+        tk.Label(invoice_btn_frame, text="по:").pack(side="left", padx=5)
+        self.f_date_to = tk.Entry(invoice_btn_frame, width=12)
+        self.f_date_to.insert(0, date.today().strftime("%Y-%m-%d"))
+        self.f_date_to.pack(side="left")
 
         # Нижняя часть: позиции накладной
         items_frame = tk.LabelFrame(self, text="Позиции выбранной накладной", padx=5, pady=5)
@@ -500,6 +1762,7 @@ class InvoiceItemsWindow(tk.Toplevel):
         for col in items_cols:
             self.items_tree.heading(col, text=col)
             self.items_tree.column(col, width=120)
+        self.items_sync = TreeSync(self.items_tree)
 
         # Кнопки для позиций
         items_btn_frame = tk.Frame(self)
@@ -508,85 +1771,215 @@ class InvoiceItemsWindow(tk.Toplevel):
         tk.Button(items_btn_frame, text="Редактировать позицию", command=self.edit_item, width=20).pack(side="left", padx=5)
         tk.Button(items_btn_frame, text="Удалить позицию", command=self.delete_item, width=20).pack(side="left", padx=5)
 
+        self.invoices_task = None
+        self.items_task = None
+        self.items_invoice = None   # (id, дата) накладной, чьи позиции показаны
+
+        # Изменения накладных и позиций (в т.ч. из других окон и с других
+        # рабочих мест) приходят уведомлениями; после правок ничего не перечитываем
+        self.changes.subscribe(INVOICE_CHANNEL, self.on_invoice_changes)
+        self.bind("<Destroy>", self.on_destroy)
+
         self.load_invoices()
 
-    def load_invoices(self):
-        try:
-            if self.invoice_type == 'incoming':
-                query = """
-                    SELECT i.incoming_id,
-                           w.name AS warehouse,
-                           i.supplier AS counterparty,
-                           i.invoice_number,
-                           i.invoice_date,
-                           i.total_amount
-                    FROM incoming_invoices i
-                    JOIN warehouses w ON w.warehouse_id = i.warehouse_id
-                    ORDER BY i.invoice_date DESC
-                """
-            else:
-                query = """
-                    SELECT o.outgoing_id,
-                           w.name AS warehouse,
-                           o.customer AS counterparty,
-                           o.invoice_number,
-                           o.invoice_date,
-                           o.total_amount
-                    FROM outgoing_invoices o
-                    JOIN warehouses w ON w.warehouse_id = o.warehouse_id
-                    ORDER BY o.invoice_date DESC
-                """
-            rows = self.db.fetch(query)
-        except Exception as e:
-            messagebox.showerror("Ошибка", str(e))
-            return
-        
-        self.invoice_tree.delete(*self.invoice_tree.get_children())
-        for row in rows:
-            self.invoice_tree.insert("", "end", values=row)
+    def cancel_tasks(self):
+        for task in (self.invoices_task, self.items_task):
+            if task is not None and not task.done():
+                task.cancel()
+
+    def load_invoices(self, replica=True):
+        """Список накладных за период; по уведомлениям — replica=False"""
+        if self.invoices_task is not None:
+            self.invoices_task.cancel()
+
+        query = self.invoice_select + """
+            WHERE i.invoice_date BETWEEN %s AND %s
+            ORDER BY i.invoice_date DESC
+        """
+        params = (self.f_date_from.get(), self.f_date_to.get())
+        self.invoices_task = QueryTask(self, self.db, query, params, on_done=self.show_invoices,
+                                       prepare=True, replica=replica)
+
+    def show_invoices(self, rows):
+        # Выбранная накладная остаётся выбранной, если она ещё в списке
+        self.invoice_sync.sync(keyed_rows(rows))
 
     def load_items(self, event=None):
         selected = self.invoice_tree.selection()
         if not selected:
             return
-        invoice_id = self.invoice_tree.item(selected[0])['values'][0]
-        
+        # Дата — значением из базы, а не текстом ячейки: по ней выбирается секция
+        row = self.invoice_sync.shown[selected[0]]
+        self.items_invoice = (row[0], row[4])
+
+        # При быстром переключении накладных старый запрос больше не нужен
+        if self.items_task is not None:
+            self.items_task.cancel()
+
+        query = self.items_select + f"""
+            WHERE it.{self.invoice_id_col} = %s AND it.invoice_date = %s
+            ORDER BY it.{self.item_id_col}
+        """
+        # Выполняется на каждый выбор накладной, поэтому через подготовленный запрос
+        self.items_task = QueryTask(self, self.db, query, self.items_invoice,
+                                    on_done=self.show_items, prepare=True)
+
+    def show_items(self, rows):
+        self.items_sync.sync(keyed_rows(rows))
+
+    # Живое обновление по уведомлениям invoice_changes
+    def on_invoice_changes(self, notes):
+        """Перечитываются только строки, о которых пришли уведомления.
+        notes=None — уведомления могли потеряться, перечитываем всё."""
+        tables = (self.invoice_table, self.items_table)
+        if notes is None or any(n["op"] == "RELOAD" and n["table"] in tables for n in notes):
+            self.load_invoices(replica=False)
+            if self.items_invoice is not None:
+                self.load_items()
+            return
+
+        current = str(self.items_invoice[0]) if self.items_invoice else None
+        invoice_ids, item_ids = set(), set()
+        for note in notes:
+            iid = str(note["id"])
+            if note["table"] == self.invoice_table:
+                if note["op"] != "DELETE":
+                    invoice_ids.add(note["id"])
+                else:
+                    self.invoice_sync.remove([iid])
+                    if iid == current:
+                        self.items_sync.clear()
+                        self.items_invoice = current = None
+            elif note["table"] == self.items_table:
+                if note["op"] == "DELETE":
+                    self.items_sync.remove([iid])
+                elif str(note["invoice_id"]) == current or self.items_tree.exists(iid):
+                    # Позиция добавлена в открытую накладную или ушла из неё
+                    item_ids.add(note["id"])
+
+        if invoice_ids:
+            self.refresh_invoices(sorted(invoice_ids))
+        if item_ids and self.items_invoice is not None:
+            self.refresh_items(sorted(item_ids))
+
+    def refresh_invoices(self, ids):
+        query = self.invoice_select + f"""
+            WHERE i.{self.invoice_id_col} = ANY(%s) AND i.invoice_date BETWEEN %s AND %s
+        """
+        params = (ids, self.f_date_from.get(), self.f_date_to.get())
+
+        def done(rows):
+            self.invoice_sync.update(keyed_rows(rows), self.invoice_position)
+            # Накладные, ушедшие за пределы периода, убираем
+            found = {str(row[0]) for row in rows}
+            self.invoice_sync.remove([str(i) for i in ids if str(i) not in found])
+
+        QueryTask(self, self.db, query, params, on_done=done)
+
+    def refresh_items(self, ids):
+        query = self.items_select + f"""
+            WHERE it.{self.item_id_col} = ANY(%s)
+              AND it.{self.invoice_id_col} = %s AND it.invoice_date = %s
+        """
+        params = (ids,) + tuple(self.items_invoice)
+
+        def done(rows):
+            self.items_sync.update(keyed_rows(rows), self.item_position)
+            # Позиции, перенесённые в другую накладную, убираем
+            found = {str(row[0]) for row in rows}
+            self.items_sync.remove([str(i) for i in ids if str(i) not in found])
+
+        QueryTask(self, self.db, query, params, on_done=done)
+
+    def invoice_position(self, values):
+        """Накладные отсортированы по дате по убыванию"""
+        key = str(values[4])
+        for index, iid in enumerate(self.invoice_tree.get_children()):
+            if self.invoice_tree.set(iid, "Дата") < key:
+                return index
+        return "end"
+
+    def item_position(self, values):
+        """Позиции отсортированы по ID"""
+        for index, iid in enumerate(self.items_tree.get_children()):
+            if int(iid) > values[0]:
+                return index
+        return "end"
+
+    def on_destroy(self, event):
+        if event.widget is self:
+            self.changes.unsubscribe(INVOICE_CHANNEL, self.on_invoice_changes)
+
+    def new_invoice(self):
         try:
-            if self.invoice_type == 'incoming':
-                query = """
-                    SELECT it.incoming_item_id,
-                           p.name AS product,
-                           p.sku,
-                           it.quantity,
-                           it.unit_price,
-                           it.line_total
-                    FROM incoming_items it
-                    JOIN products p ON p.product_id = it.product_id
-                    WHERE it.incoming_id = %s
-                    ORDER BY it.incoming_item_id
-                """
-            else:
-                query = """
-                    SELECT it.outgoing_item_id,
-                           p.name AS product,
-                           p.sku,
-                           it.quantity,
-                           it.unit_price,
-                           it.line_total
-                    FROM outgoing_items it
-                    JOIN products p ON p.product_id = it.product_id
-                    WHERE it.outgoing_id = %s
-                    ORDER BY it.outgoing_item_id
-                """
-            rows = self.db.fetch(query, (invoice_id,))
+            InvoiceEntryWindow(self, self.db, self.invoice_type, self.refs)
+        except Exception as e:
+            messagebox.showerror("Ошибка", str(e))
+
+    def import_csv(self):
+        imp_win = tk.Toplevel(self)
+        imp_win.title("Импорт накладных из CSV")
+        imp_win.geometry("520x220")
+
+        try:
+            warehouses = self.refs.rows("warehouses")
         except Exception as e:
             messagebox.showerror("Ошибка", str(e))
+            imp_win.destroy()
             return
-        
-        self.items_tree.delete(*self.items_tree.get_children())
-        for row in rows:
-            self.items_tree.insert("", "end", values=row)
 
+        tk.Label(imp_win, text="Склад:").grid(row=0, column=0, padx=5, pady=5, sticky="w")
+        wh_combo = ttk.Combobox(imp_win, width=40, state="readonly")
+        wh_combo['values'] = [f"{w[0]} - {w[1]}" for w in warehouses]
+        if warehouses:
+            wh_combo.current(0)
+        wh_combo.grid(row=0, column=1, columnspan=2, padx=5, pady=5, sticky="w")
+
+        tk.Label(imp_win, text="Файл:").grid(row=1, column=0, padx=5, pady=5, sticky="w")
+        path_var = tk.StringVar()
+        tk.Entry(imp_win, textvariable=path_var, width=40).grid(row=1, column=1, padx=5, pady=5)
+
+        def browse():
+            path = filedialog.askopenfilename(parent=imp_win, filetypes=[("CSV", "*.csv"), ("Все файлы", "*.*")])
+            if path:
+                path_var.set(path)
+
+        tk.Button(imp_win, text="Обзор...", command=browse).grid(row=1, column=2, padx=5, pady=5)
+        tk.Label(imp_win, text="Поля: " + "; ".join(IMPORT_FIELDS), fg="gray").grid(
+            row=2, column=0, columnspan=3, padx=5, sticky="w")
+
+        status = tk.Label(imp_win, text="")
+        status.grid(row=4, column=0, columnspan=3, padx=5, pady=5, sticky="w")
+
+        def done(result):
+            invoices, lines = result
+            status.config(text=f"Загружено накладных: {invoices}, строк: {lines} за {task.elapsed():.1f} с")
+
+        def failed(e):
+            status.config(text="Импорт не выполнен")
+            if isinstance(e, InvoiceImportError):
+                self.show_import_errors(e.errors)
+            else:
+                messagebox.showerror("Ошибка импорта", str(e))
+
+        def start():
+            if not wh_combo.get() or not path_var.get():
+                messagebox.showwarning("Импорт", "Выберите склад и файл", parent=imp_win)
+                return
+            nonlocal task
+            warehouse_id = int(wh_combo.get().split(' - ')[0])
+            status.config(text="Загрузка...")
+            task = BackgroundTask(imp_win, self.db, import_invoices_csv, self.db,
+                                  self.invoice_type, warehouse_id, path_var.get(),
+                                  on_done=done, on_error=failed)
+
+        task = None
+        tk.Button(imp_win, text="Загрузить", command=start).grid(row=3, column=0, columnspan=3, pady=10)
+
+    def show_import_errors(self, errors):
+        show_error_list(self, "Ошибки импорта", "Файл не загружен. Исправьте строки:",
+                        [f"Строка {line_no}: {reason}" for line_no, reason in errors],
+                        IMPORT_MAX_ERRORS)
 
     def add_item(self):
         selected = self.invoice_tree.selection()
@@ -597,20 +1990,17 @@ class InvoiceItemsWindow(tk.Toplevel):
 
         add_win = tk.Toplevel(self)
         add_win.title("Добавить позицию")
-        add_win.geometry("400x300")
+        add_win.geometry("460x400")
 
-        # Получаем список товаров
-        try:
-            products = self.db.fetch("SELECT product_id, name, sku, price FROM products ORDER BY name")
-        except Exception as e:
-            messagebox.showerror("Ошибка", str(e))
-            return
+        # Автозаполнение цены при выборе товара
+        def on_product_select(product):
+            price_entry.delete(0, tk.END)
+            price_entry.insert(0, str(product[3]))
 
-        tk.Label(add_win, text="Товар:").grid(row=0, column=0, padx=5, pady=5, sticky="w")
-        product_var = tk.StringVar()
-        product_combo = ttk.Combobox(add_win, textvariable=product_var, width=30, state="readonly")
-        product_combo['values'] = [f"{p[0]} - {p[1]} ({p[2]})" for p in products]
-        product_combo.grid(row=0, column=1, padx=5, pady=5)
+        tk.Label(add_win, text="Товар:").grid(row=0, column=0, padx=5, pady=5, sticky="nw")
+        picker = ProductPicker(add_win, self.db, on_select=on_product_select, width=40)
+        picker.grid(row=0, column=1, padx=5, pady=5)
+        picker.entry.focus_set()
 
         tk.Label(add_win, text="Количество:").grid(row=1, column=0, padx=5, pady=5, sticky="w")
         qty_entry = tk.Entry(add_win, width=30)
@@ -620,26 +2010,12 @@ class InvoiceItemsWindow(tk.Toplevel):
         price_entry = tk.Entry(add_win, width=30)
         price_entry.grid(row=2, column=1, padx=5, pady=5)
 
-        # Автозаполнение цены при выборе товара
-        def on_product_select(event):
-            selection = product_combo.get()
-            if selection:
-                product_id = int(selection.split(' - ')[0])
-                for p in products:
-                    if p[0] == product_id:
-                        price_entry.delete(0, tk.END)
-                        price_entry.insert(0, str(p[3]))
-                        break
-
-        product_combo.bind("<<ComboboxSelected>>", on_product_select)
-
         def save_item():
-            selection = product_combo.get()
-            if not selection:
+            if picker.product is None:
                 messagebox.showwarning("Ошибка", "Выберите товар")
                 return
             
-            product_id = int(selection.split(' - ')[0])
+            product_id = picker.product[0]
             qty = qty_entry.get()
             price = price_entry.get()
 
@@ -649,14 +2025,14 @@ class InvoiceItemsWindow(tk.Toplevel):
 
             try:
                 query = f"""
-                    INSERT INTO {self.items_table} ({self.invoice_id_col}, product_id, quantity, unit_price)
-                    VALUES (%s, %s, %s, %s)
+                    INSERT INTO {self.items_table} ({self.invoice_id_col}, product_id, quantity, unit_price, invoice_date)
+                    SELECT %s, %s, %s, %s, invoice_date
+                    FROM {self.invoice_table}
+                    WHERE {self.invoice_id_col} = %s
                 """
-                self.db.execute(query, (invoice_id, product_id, qty, price))
+                self.db.execute(query, (invoice_id, product_id, qty, price, invoice_id))
                 messagebox.showinfo("Успех", "Позиция добавлена")
                 add_win.destroy()
-                self.load_items()
-                self.load_invoices()  # Обновляем для пересчёта total_amount
             except Exception as e:
                 messagebox.showerror("Ошибка", str(e))
 
@@ -674,27 +2050,20 @@ class InvoiceItemsWindow(tk.Toplevel):
 
         edit_win = tk.Toplevel(self)
         edit_win.title("Редактировать позицию")
-        edit_win.geometry("400x300")
+        edit_win.geometry("460x400")
 
-        # Получаем список товаров
-        try:
-            products = self.db.fetch("SELECT product_id, name, sku FROM products ORDER BY name")
-        except Exception as e:
-            messagebox.showerror("Ошибка", str(e))
-            return
+        tk.Label(edit_win, text="Товар:").grid(row=0, column=0, padx=5, pady=5, sticky="nw")
+        picker = ProductPicker(edit_win, self.db, width=40)
+        picker.grid(row=0, column=1, padx=5, pady=5)
 
-        tk.Label(edit_win, text="Товар:").grid(row=0, column=0, padx=5, pady=5, sticky="w")
-        product_var = tk.StringVar()
-        product_combo = ttk.Combobox(edit_win, textvariable=product_var, width=30, state="readonly")
-        product_combo['values'] = [f"{p[0]} - {p[1]} ({p[2]})" for p in products]
-        
-        # Установить текущий товар
-        current_product_id = values[2]
-        for i, p in enumerate(products):
-            if p[0] == current_product_id:
-                product_combo.current(i)
-                break
-        product_combo.grid(row=0, column=1, padx=5, pady=5)
+        # Текущий товар (в таблице позиций показан его SKU) подставляется в фоне:
+        # окно открывается сразу, товар, уже выбранный вручную, не заменяется
+        def show_current(rows):
+            if rows and picker.product is None and not picker.text:
+                picker.set_product(rows[0])
+
+        QueryTask(edit_win, self.db, "SELECT product_id, name, sku, price FROM products WHERE sku = %s",
+                  (str(values[2]),), on_done=show_current, replica=True)
 
         tk.Label(edit_win, text="Количество:").grid(row=1, column=0, padx=5, pady=5, sticky="w")
         qty_entry = tk.Entry(edit_win, width=30)
@@ -707,12 +2076,11 @@ class InvoiceItemsWindow(tk.Toplevel):
         price_entry.grid(row=2, column=1, padx=5, pady=5)
 
         def save_changes():
-            selection = product_combo.get()
-            if not selection:
+            if picker.product is None:
                 messagebox.showwarning("Ошибка", "Выберите товар")
                 return
             
-            product_id = int(selection.split(' - ')[0])
+            product_id = picker.product[0]
             qty = qty_entry.get()
             price = price_entry.get()
 
@@ -725,8 +2093,6 @@ class InvoiceItemsWindow(tk.Toplevel):
                 self.db.execute(query, (product_id, qty, price, item_id))
                 messagebox.showinfo("Успех", "Позиция обновлена")
                 edit_win.destroy()
-                self.load_items()
-                self.load_invoices()
             except Exception as e:
                 messagebox.showerror("Ошибка", str(e))
 
@@ -746,17 +2112,16 @@ class InvoiceItemsWindow(tk.Toplevel):
                 query = f"DELETE FROM {self.items_table} WHERE {self.item_id_col}=%s"
                 self.db.execute(query, (item_id,))
                 messagebox.showinfo("Успех", "Позиция удалена")
-                self.load_items()
-                self.load_invoices()
             except Exception as e:
                 messagebox.showerror("Ошибка", str(e))
 
 
 # Отчёты с фильтрами
 class ReportWindow(tk.Toplevel):
-    def __init__(self, db):
+    def __init__(self, db, refs):
         super().__init__()
         self.db = db
+        self.refs = refs
         self.title("Отчёты")
         self.geometry("1200x700")
 
@@ -765,16 +2130,32 @@ class ReportWindow(tk.Toplevel):
         top.pack(fill="x", padx=10, pady=10)
 
         tk.Label(top, text="Выберите отчёт:", font=("Arial", 12)).pack(side="left")
+        # Запросы отчётов — в reports.py, окно только собирает параметры
+        self.report_names = list(REPORTS)
         self.report_type = ttk.Combobox(top, values=[
-            "1. Остатки на складе",
-            "2. Прибыль от реализации",
-            "3. Движение товара"
+            f"{i}. {REPORTS[name].title}" for i, name in enumerate(self.report_names, start=1)
         ], width=40, state="readonly")
         self.report_type.current(0)
         self.report_type.pack(side="left", padx=10)
+        self.report_type.bind("<<ComboboxSelected>>", self.on_report_select)
 
         tk.Button(top, text="Построить отчёт", command=self.build_report).pack(side="left", padx=10)
 
+        tk.Label(top, text="Лимит, с:").pack(side="left")
+        self.timeout_var = tk.IntVar(value=REPORTS[self.report_names[0]].timeout)
+        tk.Spinbox(top, from_=1, to=3600, textvariable=self.timeout_var, width=6).pack(side="left", padx=5)
+
+        self.cancel_btn = tk.Button(top, text="Отмена", command=self.cancel_report, state="disabled")
+        self.cancel_btn.pack(side="left", padx=10)
+        tk.Button(top, text="Экспорт", command=self.export_report).pack(side="left", padx=10)
+
+        self.status = tk.Label(top, text="")
+        self.status.pack(side="left", padx=10)
+        self.task = None
+        self.last_report = None     # (колонки, запрос, параметры) последнего отчёта
+        # Справочники для фильтров, которые придут пакетом с отчётом: [(таблица, заполнение)]
+        self.pending_refs = []
+
         # Фильтры (динамически меняются)
         self.filter_frame = tk.LabelFrame(self, text="Фильтры")
         self.filter_frame.pack(fill="x", padx=10, pady=10)
@@ -789,22 +2170,47 @@ class ReportWindow(tk.Toplevel):
         scrollbar_y = ttk.Scrollbar(table_frame, orient="vertical", command=self.tree.yview)
         scrollbar_y.pack(side="right", fill="y")
         self.tree.configure(yscrollcommand=scrollbar_y.set)
+        self.sync = TreeSync(self.tree)
 
     # Фильтры 
     def clear_filters(self):
         for widget in self.filter_frame.winfo_children():
             widget.destroy()
+        self.pending_refs = []
+
+    def ref_filter(self, box, table, label, order=1):
+        """Список фильтра из справочника с первым пунктом «Все». Справочник,
+        которого ещё нет в памяти, читается тем же пакетом, что и отчёт
+        (run_report); до тех пор в списке только «Все»."""
+        box['values'] = ["Все"]
+        box.current(0)
+
+        def fill():
+            box.config(values=["Все"] + [label(row) for row in self.refs.rows(table, order)])
+
+        if self.refs.batchable(table):
+            self.pending_refs.append((table, fill))
+        else:
+            fill()
+
+    def on_report_select(self, event=None):
+        self.timeout_var.set(self.current_report().timeout)
+
+    def current_report(self):
+        return REPORTS[self.report_names[self.report_type.current()]]
 
     # Построение отчёта 
     def build_report(self):
-        report = self.report_type.get()
+        report = self.report_names[self.report_type.current()]
 
-        if report.startswith("1"):
+        if report == "stock":
             self.report_stock()
-        elif report.startswith("2"):
+        elif report == "profit":
             self.report_profit()
-        elif report.startswith("3"):
+        elif report == "movement":
             self.report_movement()
+        elif report == "stock_as_of":
+            self.report_stock_as_of()
 
 
     #  ОТЧЁТ 1 — Остатки на складе (vw_current_stock)
@@ -812,37 +2218,30 @@ class ReportWindow(tk.Toplevel):
         self.clear_filters()
 
         # Фильтр по складам
-        warehouses = self.db.fetch("SELECT warehouse_id, name FROM warehouses ORDER BY name")
         tk.Label(self.filter_frame, text="Склад:").grid(row=0, column=0)
         self.f_warehouse = ttk.Combobox(self.filter_frame, width=40, state="readonly")
-        self.f_warehouse['values'] = ["Все"] + [f"{w[0]} - {w[1]}" for w in warehouses]
-        self.f_warehouse.current(0)
+        self.ref_filter(self.f_warehouse, "warehouses", warehouse_label)
         self.f_warehouse.grid(row=0, column=1, padx=5)
 
         tk.Button(self.filter_frame, text="Применить", command=self.load_stock).grid(row=1, column=0, columnspan=2, pady=10)
 
+        self.f_summary = tk.Label(self.filter_frame, text="")
+        self.f_summary.grid(row=0, column=2, padx=20)
+
         self.load_stock()
 
     def load_stock(self):
         wh = self.f_warehouse.get()
+        warehouse_id = wh.split(" - ", 1)[0] if wh != "Все" else None
+        # Итог по складам (warehouse_stock_summary, сумма слотов) — тем же пакетом,
+        # что и отчёт
+        query, params = STOCK_SUMMARY.query(warehouse_id=warehouse_id)
+        self.run_report("stock", extra=[(query, params, self.show_stock_summary)],
+                        warehouse_id=warehouse_id)
 
-        query = """
-            SELECT warehouse_name, sku, product_name, unit, qty, price, stock_value, last_updated
-            FROM vw_current_stock
-        """
-        params = []
-
-        if wh != "Все":
-            wh_name = wh.split(" - ", 1)[1]
-            query += " WHERE warehouse_name = %s"
-            params.append(wh_name)
-
-        query += " ORDER BY warehouse_name, product_name"
-
-        rows = self.db.fetch(query, params)
-
-        cols = ["Склад", "SKU", "Товар", "Ед", "Кол-во", "Цена", "Сумма", "Обновлено"]
-        self.update_table(cols, rows)
+    def show_stock_summary(self, rows):
+        count, value = rows[0]
+        self.f_summary.config(text=f"Итого: позиций {count} на сумму {value:.2f}")
 
 
     #  ОТЧЁТ 2 — Прибыль от реализации (outgoing_items + products)
@@ -865,92 +2264,246 @@ class ReportWindow(tk.Toplevel):
         self.load_profit()
 
     def load_profit(self):
-        date_from = self.f_date_from.get()
-        date_to = self.f_date_to.get()
-
-        query = """
-            SELECT 
-                p.name AS product,
-                SUM(oi.quantity) AS qty_sold,
-                AVG(oi.unit_price) AS avg_sell_price,
-                AVG(p.price) AS avg_buy_price,
-                SUM(oi.line_total - oi.quantity * p.price) AS profit
-            FROM outgoing_items oi
-            JOIN outgoing_invoices inv ON inv.outgoing_id = oi.outgoing_id
-            JOIN products p ON p.product_id = oi.product_id
-            WHERE inv.invoice_date BETWEEN %s AND %s
-            GROUP BY p.name
-            ORDER BY profit DESC
-        """
-
-        rows = self.db.fetch(query, (date_from, date_to))
-
-        cols = ["Товар", "Продано", "Цена продажи (ср.)", "Цена закупки (ср.)", "Прибыль"]
-        self.update_table(cols, rows)
+        self.run_report("profit", date_from=self.f_date_from.get(), date_to=self.f_date_to.get())
 
 
     #  ОТЧЁТ 3 — Движение товара (приход + расход)
     def report_movement(self):
         self.clear_filters()
 
-        tk.Label(self.filter_frame, text="SKU:").grid(row=0, column=0)
-        products = self.db.fetch("SELECT sku FROM products ORDER BY sku")
-        self.f_sku = ttk.Combobox(self.filter_frame, values=["Все"] + [p[0] for p in products], width=20)
-        self.f_sku.current(0)
-        self.f_sku.grid(row=0, column=1, padx=5)
+        tk.Label(self.filter_frame, text="Дата с:").grid(row=0, column=0)
+        self.f_mv_from = tk.Entry(self.filter_frame, width=15)
+        self.f_mv_from.insert(0, date.today().replace(month=1, day=1).strftime("%Y-%m-%d"))
+        self.f_mv_from.grid(row=0, column=1)
+
+        tk.Label(self.filter_frame, text="Дата по:").grid(row=0, column=2)
+        self.f_mv_to = tk.Entry(self.filter_frame, width=15)
+        self.f_mv_to.insert(0, date.today().strftime("%Y-%m-%d"))
+        self.f_mv_to.grid(row=0, column=3)
+
+        tk.Label(self.filter_frame, text="Склад:").grid(row=0, column=4)
+        self.f_mv_warehouse = ttk.Combobox(self.filter_frame, width=30, state="readonly")
+        self.ref_filter(self.f_mv_warehouse, "warehouses", warehouse_label)
+        self.f_mv_warehouse.grid(row=0, column=5, padx=5)
+
+        tk.Label(self.filter_frame, text="SKU:").grid(row=0, column=6)
+        self.f_sku = ttk.Combobox(self.filter_frame, width=20)
+        self.ref_filter(self.f_sku, "products", lambda p: p[2], order=2)
+        self.f_sku.grid(row=0, column=7, padx=5)
 
-        tk.Button(self.filter_frame, text="Применить", command=self.load_movement).grid(row=1, column=0, columnspan=2, pady=10)
+        tk.Button(self.filter_frame, text="Применить", command=self.load_movement).grid(row=1, column=0, columnspan=8, pady=10)
 
         self.load_movement()
 
     def load_movement(self):
         sku = self.f_sku.get()
+        wh = self.f_mv_warehouse.get()
+        self.run_report("movement", date_from=self.f_mv_from.get(), date_to=self.f_mv_to.get(),
+                        warehouse_id=wh.split(" - ", 1)[0] if wh != "Все" else None,
+                        sku=sku if sku != "Все" else None)
 
-        params = []
-        where = ""
-
-        if sku != "Все":
-            where = "WHERE p.sku = %s"
-            params = [sku]
-
-        # Приход + Расход
-        query = f"""
-        SELECT 
-            p.sku,
-            p.name,
-            COALESCE(inc_qty, 0) AS incoming_qty,
-            COALESCE(out_qty, 0) AS outgoing_qty,
-            COALESCE(inc_qty, 0) - COALESCE(out_qty, 0) AS balance_change
-        FROM products p
-        LEFT JOIN (
-            SELECT product_id, SUM(quantity) AS inc_qty
-            FROM incoming_items
-            GROUP BY product_id
-        ) i ON i.product_id = p.product_id
-        LEFT JOIN (
-            SELECT product_id, SUM(quantity) AS out_qty
-            FROM outgoing_items
-            GROUP BY product_id
-        ) o ON o.product_id = p.product_id
-        {where}
-        ORDER BY p.sku
-        """
+    #  ОТЧЁТ 4 — Остатки на дату (снимок + движение после него)
+    def report_stock_as_of(self):
+        self.clear_filters()
+
+        tk.Label(self.filter_frame, text="На дату:").grid(row=0, column=0)
+        self.f_as_of = tk.Entry(self.filter_frame, width=15)
+        self.f_as_of.insert(0, date.today().strftime("%Y-%m-%d"))
+        self.f_as_of.grid(row=0, column=1)
+
+        tk.Label(self.filter_frame, text="Склад:").grid(row=0, column=2)
+        self.f_as_of_warehouse = ttk.Combobox(self.filter_frame, width=30, state="readonly")
+        self.ref_filter(self.f_as_of_warehouse, "warehouses", warehouse_label)
+        self.f_as_of_warehouse.grid(row=0, column=3, padx=5)
+
+        tk.Button(self.filter_frame, text="Применить", command=self.load_stock_as_of).grid(row=1, column=0, columnspan=4, pady=10)
 
-        rows = self.db.fetch(query, params)
+        self.load_stock_as_of()
+
+    def load_stock_as_of(self):
+        wh = self.f_as_of_warehouse.get()
+        self.run_report("stock_as_of", as_of=self.f_as_of.get(),
+                        warehouse_id=wh.split(" - ", 1)[0] if wh != "Все" else None)
+
+    # Выполнение отчёта в фоне
+    def run_report(self, name, extra=(), **values):
+        """Отчёт из reports.REPORTS с параметрами из полей окна. Одним пакетом
+        с ним идут справочники для фильтров (ref_filter) и extra — независимые
+        запросы [(запрос, параметры, обработчик строк)]."""
+        report = REPORTS[name]
+        try:
+            query, params = report.query(**values)
+        except ValueError as e:
+            messagebox.showerror("Ошибка отчёта", str(e))
+            return
+        cols, key_len = report.columns, report.key_len
+
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.last_report = (cols, query, params)
+
+        # Справочники остаются в ожидании, пока пакет не выполнен: после
+        # отмены или ошибки они уйдут со следующим отчётом
+        refs = list(self.pending_refs)
+        tables = list(dict.fromkeys(table for table, _ in refs))
+        queries = [(query, params)] + [(self.refs.query(table), None) for table in tables] \
+            + [(q, p) for q, p, _ in extra]
+
+        def done(results):
+            rows = results[0]
+            for table, table_rows in zip(tables, results[1:]):
+                self.refs.fill(table, table_rows)
+            for entry in refs:
+                entry[1]()
+            self.pending_refs = [entry for entry in self.pending_refs if entry not in refs]
+            for (_, _, handler), extra_rows in zip(extra, results[1 + len(tables):]):
+                handler(extra_rows)
+
+            self.cancel_btn.config(state="disabled")
+            self.status.config(text=f"Строк: {len(rows)}, {self.task.elapsed():.1f} с")
+            self.update_table(cols, rows, key_len)
+
+        def failed(e):
+            self.cancel_btn.config(state="disabled")
+            self.status.config(text="Ошибка")
+            messagebox.showerror("Ошибка отчёта", str(e))
 
-        cols = ["SKU", "Товар", "Приход", "Расход", "Изменение остатков"]
-        self.update_table(cols, rows)
+        try:
+            timeout = self.timeout_var.get()
+        except tk.TclError:
+            timeout = report.timeout
+
+        self.status.config(text="Выполняется...")
+        self.cancel_btn.config(state="normal")
+        self.task = BatchTask(self, self.db, queries, on_done=done, on_error=failed,
+                              timeout=timeout, replica=True)
+
+    def cancel_report(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.cancel_btn.config(state="disabled")
+        self.status.config(text="Отменено")
+
+    def export_report(self):
+        """Выгрузить последний построенный отчёт тем же запросом, но потоком в файл"""
+        if self.last_report is None:
+            messagebox.showinfo("Экспорт", "Сначала постройте отчёт")
+            return
+        cols, query, params = self.last_report
+        start_export(self, self.db, "Экспорт отчёта", query, params, cols)
 
     # Обновление таблицы 
-    def update_table(self, cols, rows):
-        self.tree.delete(*self.tree.get_children())
-        self.tree["columns"] = cols
+    def update_table(self, cols, rows, key_len=1):
+        # Другой отчёт — другие колонки, тогда таблица строится заново
+        if list(self.tree["columns"]) != cols:
+            self.sync.clear()
+            self.tree["columns"] = cols
+            for col in cols:
+                self.tree.heading(col, text=col)
+                self.tree.column(col, width=150)
+
+        self.sync.sync(keyed_rows(rows, key_len))
+
+
+# Диагностика: где тратится время
+DIAG_TOP = 30       # сколько самых дорогих запросов показывать
+
+
+class DiagnosticsWindow(tk.Toplevel):
+    """Самые дорогие запросы и отрисовки Treeview по данным STATS:
+    вызовы, время, перцентили, строки, объём и откуда вызывались.
+    По выбранной строке — гистограмма и план медленного запроса."""
+
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+        self.entries = []
+        self.title("Диагностика запросов")
+        self.geometry("1300x700")
+
+        top = tk.Frame(self)
+        top.pack(fill="x", padx=5, pady=5)
+        tk.Label(top, text="Показать:").pack(side="left")
+        self.kind = ttk.Combobox(top, values=["Всё", "Запросы БД", "Отрисовка Tk"], width=15, state="readonly")
+        self.kind.current(0)
+        self.kind.pack(side="left", padx=5)
+        self.kind.bind("<<ComboboxSelected>>", lambda e: self.refresh())
+        tk.Label(top, text="Сортировать по:").pack(side="left")
+        self.order = ttk.Combobox(top, values=["total_ms", "max_ms", "calls", "rows", "bytes"],
+                                  width=10, state="readonly")
+        self.order.current(0)
+        self.order.pack(side="left", padx=5)
+        self.order.bind("<<ComboboxSelected>>", lambda e: self.refresh())
+        tk.Label(top, text="Медленный запрос от, мс:").pack(side="left", padx=5)
+        self.slow_var = tk.IntVar(value=int(STATS.slow_ms))
+        tk.Spinbox(top, from_=1, to=600000, textvariable=self.slow_var, width=8,
+                   command=self.set_slow).pack(side="left")
+        tk.Button(top, text="Обновить", command=self.refresh).pack(side="left", padx=5)
+        tk.Button(top, text="Сбросить", command=self.reset).pack(side="left", padx=5)
+
+        cols = ["Вид", "Запрос", "Вызовов", "Всего, мс", "Среднее", "p50", "p95", "Макс",
+                "Строк", "Байт", "Откуда"]
+        self.tree = ttk.Treeview(self, columns=cols, show="headings", height=15)
         for col in cols:
             self.tree.heading(col, text=col)
-            self.tree.column(col, width=150)
+            self.tree.column(col, width=80)
+        self.tree.column("Запрос", width=380)
+        self.tree.column("Откуда", width=260)
+        self.tree.pack(fill="both", expand=True, padx=5, pady=5)
+        self.tree.bind("<<TreeviewSelect>>", self.show_details)
+
+        self.details = tk.Text(self, height=14, wrap="none")
+        self.details.pack(fill="both", expand=True, padx=5, pady=5)
+
+        self.refresh()
+
+    def set_slow(self):
+        try:
+            STATS.slow_ms = max(1, self.slow_var.get())
+        except tk.TclError:
+            pass
+
+    def reset(self):
+        STATS.reset()
+        self.refresh()
+
+    def refresh(self):
+        self.set_slow()
+        kind = {"Запросы БД": "db", "Отрисовка Tk": "tk"}.get(self.kind.get())
+        self.entries = STATS.top(DIAG_TOP, kind=kind, by=self.order.get())
+        self.tree.delete(*self.tree.get_children())
+        for i, e in enumerate(self.entries):
+            callers = ", ".join(sorted(e["callers"], key=e["callers"].get, reverse=True))
+            self.tree.insert("", "end", iid=str(i), values=(
+                e["kind"], e["query"][:200], e["calls"], f"{e['total_ms']:.0f}",
+                f"{e['total_ms'] / e['calls']:.1f}", f"{e['p50_ms']:.1f}", f"{e['p95_ms']:.1f}",
+                f"{e['max_ms']:.1f}", e["rows"], e["bytes"], callers))
+        self.show_details()
+
+    def show_details(self, event=None):
+        self.details.delete("1.0", tk.END)
+        selected = self.tree.selection()
+        if not selected:
+            # Без выбора — журнал медленных запросов
+            self.details.insert(tk.END, f"Медленные запросы (от {STATS.slow_ms} мс):\n")
+            for at, ms, query, caller in reversed(STATS.slow_log()):
+                stamp = datetime.fromtimestamp(at).strftime("%H:%M:%S")
+                self.details.insert(tk.END, f"{stamp}  {ms:.0f} мс  {caller}  {query[:200]}\n")
+            return
+
+        e = self.entries[int(selected[0])]
+        self.details.insert(tk.END, e["query"] + "\n\n")
+        for caller, count in sorted(e["callers"].items(), key=lambda c: -c[1]):
+            self.details.insert(tk.END, f"{count:>6}  {caller}\n")
 
-        for row in rows:
-            self.tree.insert("", "end", values=row)
+        self.details.insert(tk.END, f"\nПоследние {len(e['recent'])} замеров, мс:\n")
+        peak = max(count for _, count in e["histogram"]) or 1
+        for bound, count in e["histogram"]:
+            label = f"≤ {bound}" if bound is not None else "больше"
+            self.details.insert(tk.END, f"{label:>8}  {count:>6}  {'#' * (40 * count // peak)}\n")
+
+        if e["plan"]:
+            self.details.insert(tk.END, "\nEXPLAIN (ANALYZE, BUFFERS):\n" + e["plan"] + "\n")
 
 
 # Главное окно
@@ -960,7 +2513,18 @@ class MainWindow(tk.Tk):
         self.title("Склад — клиентское приложение")
         self.geometry("400x400")
 
-        self.db = Database()
+        try:
+            self.db = Database()
+        except Exception as e:
+            messagebox.showerror("Ошибка подключения", str(e))
+            raise
+        self.refs = RefCache(self.db)
+
+        # Уведомления об изменениях справочников, накладных и позиций
+        self.listener = ChangeListener(self.db.config, [REF_CHANNEL, INVOICE_CHANNEL])
+        self.listener.start()
+        self.changes = ChangeDispatcher(self, self.listener)
+        self.changes.subscribe(REF_CHANNEL, self.refs.on_changes)
 
         tk.Label(self, text="Управление складом",
                  font=("Arial", 16, "bold")).pack(pady=15)
@@ -979,22 +2543,51 @@ class MainWindow(tk.Tk):
                       command=lambda t=table: self.open_table(t)).pack(pady=5)
 
         tk.Button(self, text="Приход + позиции", width=30,
-                  command=lambda: InvoiceItemsWindow(self.db, "incoming")).pack(pady=5)
+                  command=lambda: InvoiceItemsWindow(self.db, "incoming", self.refs, self.changes)).pack(pady=5)
 
         tk.Button(self, text="Расход + позиции", width=30,
-                  command=lambda: InvoiceItemsWindow(self.db, "outgoing")).pack(pady=5)
+                  command=lambda: InvoiceItemsWindow(self.db, "outgoing", self.refs, self.changes)).pack(pady=5)
 
         tk.Button(self, text="Отчёты", width=30,
-                  command=lambda: ReportWindow(self.db)).pack(pady=10)
+                  command=lambda: ReportWindow(self.db, self.refs)).pack(pady=10)
+
+        tk.Button(self, text="Диагностика", width=30,
+                  command=lambda: DiagnosticsWindow(self.db)).pack(pady=5)
+
+        # Снимок остатков на начало месяца для отчёта «Остатки на дату»:
+        # первый запуск в месяце создаёт его, остальные только проверяют.
+        # Ошибку не показываем: без свежего снимка отчёт просто читает больше движения
+        BackgroundTask(self, self.db, take_snapshots, self.db, on_error=lambda e: None)
+
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    def on_close(self):
+        # Отменяем фоновые запросы, иначе выход будет ждать их завершения
+        self.listener.stop()
+        self.db.close()
+        self.destroy()
 
     def open_table(self, table_name):
-        columns = self.db.get_columns(table_name)
-        if columns:
-            TableManagerWindow(self.db, table_name, columns)
-        else:
-            messagebox.showerror("Ошибка", f"Не удалось открыть таблицу {table_name}")
+        """Колонки и сведения для сортировки — одним пакетом, окно строится,
+        когда они пришли"""
+        queries = [(COLUMN_TYPES_QUERY, (table_name,))] + \
+            [(query, (table_name,)) for query in TABLE_INFO_QUERIES]
+
+        def done(results):
+            column_types = results[0]
+            if not column_types:
+                messagebox.showerror("Ошибка", f"Не удалось открыть таблицу {table_name}")
+                return
+            TableManagerWindow(self.db, table_name, [col for col, _ in column_types],
+                               column_types, table_info(*results[1:]))
+
+        def failed(e):
+            messagebox.showerror("Ошибка", f"Не удалось открыть таблицу {table_name}: {e}")
+
+        BatchTask(self, self.db, queries, on_done=done, on_error=failed, replica=True)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     app = MainWindow()
     app.mainloop()
\ No newline at end of file
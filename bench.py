@@ -0,0 +1,657 @@
+"""Синтетические данные и замеры производительности (без интерфейса).
+
+    python -m bench generate --scale 1 --yes      # ~1 млн позиций на единицу масштаба
+    python -m bench run --output bench.json       # замеры запросов окон, отчётов и триггеров
+    python -m bench compare old.json new.json     # сравнение двух прогонов
+
+Генератор очищает все таблицы склада — запускать только на отдельной базе
+для замеров (параметры подключения — DB_CONFIG, --dbname их переопределяет)."""
+import argparse
+import csv
+import io
+import json
+import math
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import psycopg2
+
+from db import COLUMN_TYPES_QUERY, TABLE_INFO_QUERIES, Database
+from reports import REPORTS
+from tables import (PAGE_SIZE, TABLE_VIEWS, TableQuery, invoice_select, items_select,
+                    search_predicate)
+
+
+# Генератор данных
+# Объём на единицу масштаба; при дробном масштабе не меньше MIN_COUNTS
+SCALE_COUNTS = {
+    "warehouses": 5,
+    "staff": 200,
+    "products": 20000,
+    "invoices": 50000,
+    "items": 1000000,
+}
+MIN_COUNTS = {"warehouses": 2, "staff": 5, "products": 50, "invoices": 50, "items": 500}
+HISTORY_DAYS = 3 * 365      # глубина истории накладных, дней до сегодняшнего
+INCOMING_SHARE = 0.25       # доля приходных накладных
+PRODUCT_SKEW = 1.1          # показатель Ципфа: популярные товары встречаются в разы чаще
+
+CITIES = ["Ижевск", "Можга", "Сарапул", "Глазов", "Воткинск", "Пермь", "Казань", "Киров"]
+SURNAMES = ["Иванов", "Петров", "Смирнов", "Кузнецов", "Попов", "Васильев", "Соколов",
+            "Михайлов", "Новиков", "Фёдоров", "Морозов", "Волков", "Алексеев", "Лебедев"]
+FIRST_NAMES = ["Иван", "Пётр", "Сергей", "Андрей", "Алексей", "Дмитрий", "Михаил",
+               "Ольга", "Анна", "Елена", "Мария", "Наталья", "Татьяна", "Ирина"]
+POSITIONS = ["Кладовщик", "Заведующий складом", "Менеджер по логистике", "Грузчик",
+             "Водитель погрузчика", "Оператор учёта"]
+# Категория товара: префикс SKU, названия, единица
+CATEGORIES = [
+    ("BRG", ["Подшипник", "Втулка", "Сальник"], "шт"),
+    ("MTR", ["Мотор-редуктор", "Электродвигатель", "Редуктор"], "шт"),
+    ("CBL", ["Кабель силовой", "Провод ПВС", "Кабель контрольный"], "м"),
+    ("FST", ["Болт", "Гайка", "Шайба", "Шпилька"], "шт"),
+    ("PMP", ["Насос", "Клапан", "Задвижка"], "шт"),
+    ("OIL", ["Масло индустриальное", "Смазка", "Антифриз"], "л"),
+]
+COMPANIES = ["МеталлСнаб", "ЭлектроТех", "ЛогистикТрейд", "ТехноПоставка", "РемонтСервис",
+             "ЭлектроМонтаж", "СтройКомплект", "МастерПлюс", "ПромРесурс", "УралДеталь"]
+
+
+def scale_counts(scale):
+    return {name: max(MIN_COUNTS[name], int(count * scale)) for name, count in SCALE_COUNTS.items()}
+
+
+def cumulative(weights):
+    total, result = 0.0, []
+    for w in weights:
+        total += w
+        result.append(total)
+    return result
+
+
+class RowStream:
+    """Файлоподобный объект для COPY FROM STDIN: строки генератора в CSV
+    по мере чтения, в памяти — одна порция"""
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator="\n")
+        self.count = 0
+
+    def read(self, size=-1):
+        while size < 0 or self.buffer.tell() < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.writer.writerow(row)
+            self.count += 1
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+
+class DataGenerator:
+    """Данные склада заданного масштаба. Один и тот же seed даёт одни и те же
+    данные. Перекосы как в жизни: товары по закону Ципфа, склады неравные,
+    дни — рост к концу истории, меньше в выходные, пик в декабре."""
+
+    def __init__(self, scale=1.0, seed=1, end=None):
+        self.counts = scale_counts(scale)
+        self.rng = random.Random(seed)
+        self.end = end or date.today()
+        self.start = self.end - timedelta(days=HISTORY_DAYS - 1)
+
+        rng = self.rng
+        n = self.counts["products"]
+        # Популярность не совпадает с порядком id: ранги раздаются вперемешку
+        self.popular = list(range(1, n + 1))
+        rng.shuffle(self.popular)
+        self.product_weights = cumulative(1 / (rank + 1) ** PRODUCT_SKEW for rank in range(n))
+        self.prices = [round(math.exp(rng.gauss(6, 1.2)) + 1, 2) for _ in range(n + 1)]
+
+        days = []
+        for i in range(HISTORY_DAYS):
+            day = self.start + timedelta(days=i)
+            weight = (1 + 2 * i / HISTORY_DAYS) * (0.3 if day.weekday() >= 5 else 1)
+            days.append(weight * (1.5 if day.month == 12 else 1))
+        self.day_weights = cumulative(days)
+        self.warehouse_weights = cumulative(1 / (i + 1) ** 0.8 for i in range(self.counts["warehouses"]))
+
+        # Накладные: (вид, id, склад, дата, строк); строки распределены по экспоненте
+        avg_lines = self.counts["items"] / self.counts["invoices"]
+        self.invoices = []
+        ids = {"incoming": 0, "outgoing": 0}
+        left = self.counts["items"]
+        for i in range(self.counts["invoices"]):
+            kind = "incoming" if rng.random() < INCOMING_SHARE else "outgoing"
+            ids[kind] += 1
+            lines = max(1, int(rng.expovariate(1 / avg_lines)))
+            if i == self.counts["invoices"] - 1:
+                lines = max(1, left)
+            lines = min(lines, max(1, left))
+            left -= lines
+            warehouse = rng.choices(range(1, self.counts["warehouses"] + 1),
+                                    cum_weights=self.warehouse_weights)[0]
+            day = self.start + timedelta(days=rng.choices(range(HISTORY_DAYS),
+                                                          cum_weights=self.day_weights)[0])
+            self.invoices.append((kind, ids[kind], warehouse, day, lines))
+        self.invoice_counts = ids
+
+    def warehouses(self):
+        for i in range(1, self.counts["warehouses"] + 1):
+            city = CITIES[(i - 1) % len(CITIES)]
+            yield (i, f"Склад {i} {city}", self.person(), f"{city}, Складская {i}")
+
+    def positions(self):
+        for i, name in enumerate(POSITIONS, start=1):
+            yield (i, name)
+
+    def staff(self):
+        rng = self.rng
+        for i in range(1, self.counts["staff"] + 1):
+            hired = self.start - timedelta(days=rng.randint(0, 3650))
+            yield (i, rng.randint(1, self.counts["warehouses"]), f"{770000000000 + i}",
+                   self.person(), rng.randint(1, len(POSITIONS)), hired)
+
+    def person(self):
+        return f"{self.rng.choice(SURNAMES)} {self.rng.choice(FIRST_NAMES)}"
+
+    def products(self):
+        rng = self.rng
+        for i in range(1, self.counts["products"] + 1):
+            prefix, names, unit = CATEGORIES[i % len(CATEGORIES)]
+            model = f"{rng.choice('ABCDEKMPT')}{rng.randint(10, 9999)}"
+            yield (i, f"{prefix}-{i:06d}", f"{rng.choice(names)} {model}", unit, self.prices[i])
+
+    def invoice_rows(self, kind):
+        prefix = "IN" if kind == "incoming" else "OUT"
+        for inv_kind, inv_id, warehouse, day, _ in self.invoices:
+            if inv_kind == kind:
+                yield (inv_id, warehouse, f"ООО {self.rng.choice(COMPANIES)}", f"{prefix}-{inv_id:08d}", day)
+
+    def item_rows(self, kind):
+        rng = self.rng
+        n = self.counts["products"]
+        for inv_kind, inv_id, _, day, lines in self.invoices:
+            if inv_kind != kind:
+                continue
+            for rank in rng.choices(range(n), cum_weights=self.product_weights, k=lines):
+                product = self.popular[rank]
+                if kind == "incoming":
+                    qty, price = rng.randint(10, 500), self.prices[product] * rng.uniform(0.7, 0.9)
+                else:
+                    qty, price = rng.randint(1, 40), self.prices[product] * rng.uniform(1.05, 1.35)
+                yield (inv_id, product, qty, round(price, 2), day)
+
+    def load(self, db, log=print):
+        """Очистить таблицы склада и загрузить данные через COPY одной
+        транзакцией. Триггеры на время загрузки выключены (session_replication_role),
+        остатки, суммы, движение, сводка и снимки пересчитываются одним проходом в конце."""
+        with db.transaction() as cur:
+            cur.execute("SET LOCAL session_replication_role = replica")
+            cur.execute("SELECT to_regclass('invoice_numbers') IS NOT NULL")
+            partitioned = cur.fetchone()[0]
+            cur.execute("""
+                TRUNCATE warehouses, positions, staff, products, incoming_invoices, incoming_items,
+                         outgoing_invoices, outgoing_items, stock_balances, stock_movement_daily,
+                         warehouse_stock_summary, stock_snapshot_dates, stock_snapshots, stock_ledger
+                RESTART IDENTITY CASCADE
+            """)
+            if partitioned:
+                # Секционированная схема: секции на всю историю и реестр номеров
+                cur.execute("TRUNCATE invoice_numbers")
+                opening = self.start - timedelta(days=1)
+                month = opening.replace(day=1)
+                while month <= self.end:
+                    for parent in ("incoming_invoices", "incoming_items",
+                                   "outgoing_invoices", "outgoing_items"):
+                        cur.execute("SELECT create_month_partition(%s, %s)", (parent, month))
+                    month = (month + timedelta(days=32)).replace(day=1)
+
+            for table, columns, rows in [
+                ("warehouses", "warehouse_id, name, manager_name, address", self.warehouses()),
+                ("positions", "position_id, name", self.positions()),
+                ("staff", "staff_id, warehouse_id, inn, full_name, position_id, hired_at", self.staff()),
+                ("products", "product_id, sku, name, unit, price", self.products()),
+                ("incoming_invoices", "incoming_id, warehouse_id, supplier, invoice_number, invoice_date",
+                 self.invoice_rows("incoming")),
+                ("outgoing_invoices", "outgoing_id, warehouse_id, customer, invoice_number, invoice_date",
+                 self.invoice_rows("outgoing")),
+                ("incoming_items", "incoming_id, product_id, quantity, unit_price, invoice_date",
+                 self.item_rows("incoming")),
+                ("outgoing_items", "outgoing_id, product_id, quantity, unit_price, invoice_date",
+                 self.item_rows("outgoing")),
+            ]:
+                started = time.perf_counter()
+                stream = RowStream(rows)
+                cur.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", stream)
+                log(f"{table}: {stream.count} строк за {time.perf_counter() - started:.1f} с")
+
+            started = time.perf_counter()
+            params = {"opening_id": self.invoice_counts["incoming"],
+                      "opening": self.start - timedelta(days=1)}
+            for sql in DERIVED_SQL:
+                cur.execute(sql, params)
+            if partitioned:
+                cur.execute("""
+                    INSERT INTO invoice_numbers (kind, warehouse_id, invoice_number)
+                    SELECT 'incoming', warehouse_id, invoice_number FROM incoming_invoices
+                    UNION ALL
+                    SELECT 'outgoing', warehouse_id, invoice_number FROM outgoing_invoices
+                """)
+            for table, column in [("warehouses", "warehouse_id"), ("positions", "position_id"),
+                                  ("staff", "staff_id"), ("products", "product_id"),
+                                  ("incoming_invoices", "incoming_id"), ("outgoing_invoices", "outgoing_id")]:
+                cur.execute(f"SELECT setval(pg_get_serial_sequence(%s, %s), "
+                            f"(SELECT COALESCE(MAX({column}), 0) + 1 FROM {table}), false)",
+                            (table, column))
+            log(f"Остатки, суммы и движение: {time.perf_counter() - started:.1f} с")
+            cur.execute("ANALYZE")
+
+
+# Производные данные после загрузки в обход триггеров
+DERIVED_SQL = [
+    # Расход не может превысить приход: недостающее приходуется накладной
+    # «Ввод остатков» (одна на склад) за день до начала истории
+    """
+    INSERT INTO incoming_invoices (incoming_id, warehouse_id, supplier, invoice_number, invoice_date)
+    SELECT %(opening_id)s + warehouse_id, warehouse_id, 'Ввод остатков', 'OPEN-' || warehouse_id, %(opening)s
+    FROM warehouses
+    """,
+    """
+    INSERT INTO incoming_items (incoming_id, product_id, quantity, unit_price, invoice_date)
+    SELECT %(opening_id)s + d.warehouse_id, d.product_id, d.deficit, p.price, %(opening)s
+    FROM (
+        SELECT warehouse_id, product_id, -SUM(qty) AS deficit
+        FROM (
+            SELECT inv.warehouse_id, it.product_id, it.quantity AS qty
+            FROM incoming_items it
+            JOIN incoming_invoices inv ON inv.incoming_id = it.incoming_id
+            UNION ALL
+            SELECT inv.warehouse_id, it.product_id, -it.quantity
+            FROM outgoing_items it
+            JOIN outgoing_invoices inv ON inv.outgoing_id = it.outgoing_id
+        ) m
+        GROUP BY warehouse_id, product_id
+        HAVING SUM(qty) < 0
+    ) d
+    JOIN products p ON p.product_id = d.product_id
+    """,
+    """
+    UPDATE incoming_invoices i SET total_amount = t.total
+    FROM (SELECT incoming_id, SUM(line_total) AS total FROM incoming_items GROUP BY incoming_id) t
+    WHERE i.incoming_id = t.incoming_id
+    """,
+    """
+    UPDATE outgoing_invoices i SET total_amount = t.total
+    FROM (SELECT outgoing_id, SUM(line_total) AS total FROM outgoing_items GROUP BY outgoing_id) t
+    WHERE i.outgoing_id = t.outgoing_id
+    """,
+    """
+    INSERT INTO stock_balances (warehouse_id, product_id, qty, last_updated)
+    SELECT warehouse_id, product_id, SUM(qty), now()
+    FROM (
+        SELECT inv.warehouse_id, it.product_id, it.quantity AS qty
+        FROM incoming_items it
+        JOIN incoming_invoices inv ON inv.incoming_id = it.incoming_id
+        UNION ALL
+        SELECT inv.warehouse_id, it.product_id, -it.quantity
+        FROM outgoing_items it
+        JOIN outgoing_invoices inv ON inv.outgoing_id = it.outgoing_id
+    ) m
+    GROUP BY warehouse_id, product_id
+    """,
+    "SELECT rebuild_stock_movement_daily()",
+    "SELECT refresh_warehouse_stock_summary()",
+    "SELECT take_monthly_snapshots()",
+]
+
+
+# Замеры
+BENCH_REPEAT = 5            # замеров на случай (после одного прогревочного)
+BULK_LINES = 1000           # строк в накладной для замера триггеров
+REGRESSION_PCT = 10         # медиана выросла больше — отмечается при сравнении
+CLERKS = (1, 4, 16)         # одновременных кладовщиков в замере проведения
+CLERK_SECONDS = 5           # длительность замера на одно число кладовщиков
+CLERK_LINES = 20            # строк в накладной кладовщика
+HOT_PRODUCTS = 50           # популярные товары, которые проводят все кладовщики
+
+
+class Bench:
+    """Повторяемый набор замеров: те же запросы, что у окон (tables.py)
+    и отчётов (reports.py), параметры выбираются из данных с фиксированным
+    seed. Изменяющие замеры откатываются, данные остаются прежними."""
+
+    def __init__(self, db, repeat=BENCH_REPEAT, seed=1, log=print):
+        self.db = db
+        self.repeat = repeat
+        self.rng = random.Random(seed)
+        self.log = log
+        self.results = {}
+
+    def measure(self, name, cases):
+        """cases() -> (запрос, параметры) на каждый прогон; первый — прогрев"""
+        timings, rows = [], 0
+        with self.db.connection() as conn:
+            try:
+                for i in range(self.repeat + 1):
+                    query, params = cases()
+                    with conn.cursor() as cur:
+                        started = time.perf_counter()
+                        cur.execute(query, params)
+                        rows = len(cur.fetchall()) if cur.description else cur.rowcount
+                        elapsed = (time.perf_counter() - started) * 1000
+                    conn.rollback()
+                    if i:
+                        timings.append(elapsed)
+            finally:
+                self.db.rollback(conn)
+        self.record(name, timings, rows)
+
+    def record(self, name, timings, rows, **extra):
+        if not timings:
+            self.log(f"{name:45} нет успешных прогонов {extra}")
+            return
+        timings.sort()
+        self.results[name] = {
+            "runs": len(timings),
+            "rows": rows,
+            "min_ms": round(timings[0], 2),
+            "median_ms": round(statistics.median(timings), 2),
+            "p95_ms": round(timings[min(len(timings) - 1, len(timings) * 95 // 100)], 2),
+            "max_ms": round(timings[-1], 2),
+            **extra,
+        }
+        self.log(f"{name:45} {self.results[name]['median_ms']:>10.1f} мс  строк: {rows}")
+
+    def sample(self, query, params=None, limit=100):
+        """Значения для параметров — из самих данных"""
+        rows = self.db.fetch(query + f" LIMIT {int(limit)}", params)
+        return rows or [(None,)]
+
+    def run(self):
+        self.bench_tables()
+        self.bench_window_open()
+        self.bench_invoices()
+        self.bench_reports()
+        self.bench_triggers()
+        self.bench_clerks()
+        return self.results
+
+    # open_table: сведения о таблице по одному запросу и одним пакетом (fetch_many)
+    def bench_window_open(self):
+        backend = "psycopg3" if self.db.async_backend() else "threads"
+        for table in TABLE_VIEWS:
+            queries = [(COLUMN_TYPES_QUERY, (table,))] + [(q, (table,)) for q in TABLE_INFO_QUERIES]
+            loads = {
+                "sequential": lambda: [self.db.fetch(q, p) for q, p in queries],
+                "batch": lambda: self.db.fetch_many(queries).result(),
+            }
+            for name, load in loads.items():
+                timings = []
+                for i in range(self.repeat + 1):
+                    started = time.perf_counter()
+                    load()
+                    if i:
+                        timings.append((time.perf_counter() - started) * 1000)
+                self.record(f"open_table.{table}.{name}", timings, len(queries), backend=backend)
+
+    # load_data, apply_filter, apply_sort
+    def bench_tables(self):
+        for table, view in TABLE_VIEWS.items():
+            fields = {name: (expr, kind) for name, expr, kind in view["search"]}
+            query = TableQuery(view, fields, self.db.get_table_info(table))
+            self.measure(f"load_data.{table}.first_page", lambda: query.page())
+
+            # Страница из середины: курсор — строка на глубине в несколько страниц
+            first, params = query.page(limit=PAGE_SIZE * 5)
+            rows = self.db.fetch(first, params)
+            if rows:
+                cursor = tuple(rows[-1][:len(query.sort) + len(view["key"])])
+                self.measure(f"load_data.{table}.next_page", lambda: query.page(after=cursor))
+
+            # Поиск: по первому текстовому полю — подстрока из имеющихся значений
+            text_fields = [(name, expr) for name, expr, kind in view["search"] if kind == "text"]
+            if text_fields:
+                name, expr = text_fields[0]
+                values = [row[0] for row in self.sample(f"SELECT {expr} FROM {view['from']}")
+                          if row[0] and len(str(row[0])) >= 4]
+                if values:
+                    def filtered():
+                        value = str(self.rng.choice(values))
+                        start = self.rng.randint(0, len(value) - 3)
+                        query.filters = [search_predicate(expr, "text", value[start:start + 3], name)]
+                        return query.page()
+                    self.measure(f"apply_filter.{table}.{name}", filtered)
+                    query.filters = []
+
+            # Сортировка по последнему полю (обычно дата или число) по убыванию
+            name = view["search"][-1][0]
+            if query.sortable(name):
+                query.sort = [(name, True)]
+                self.measure(f"apply_sort.{table}.{name}", lambda: query.page())
+                query.sort = []
+
+    # load_invoices, load_items
+    def bench_invoices(self):
+        for kind, table, id_col, item_table, item_id_col, cp in [
+            ("incoming", "incoming_invoices", "incoming_id", "incoming_items", "incoming_item_id", "supplier"),
+            ("outgoing", "outgoing_invoices", "outgoing_id", "outgoing_items", "outgoing_item_id", "customer"),
+        ]:
+            select = invoice_select(table, id_col, cp) + """
+                WHERE i.invoice_date BETWEEN %s AND %s
+                ORDER BY i.invoice_date DESC
+            """
+            today = date.today()
+            self.measure(f"load_invoices.{kind}.30_days",
+                         lambda: (select, (today - timedelta(days=30), today)))
+
+            invoices = self.sample(f"SELECT {id_col}, invoice_date FROM {table} ORDER BY random()")
+            items = items_select(item_table, item_id_col) + f"""
+                WHERE it.{id_col} = %s AND it.invoice_date = %s
+                ORDER BY it.{item_id_col}
+            """
+            self.measure(f"load_items.{kind}", lambda: (items, self.rng.choice(invoices)))
+
+    def bench_reports(self):
+        for name, report in REPORTS.items():
+            query, params = report.query()
+            self.measure(f"report.{name}", lambda: (query, params))
+        # Движение за всю историю — худший случай для отчёта о движении
+        query, params = REPORTS["movement"].query(date_from=date.today() - timedelta(days=HISTORY_DAYS))
+        self.measure("report.movement.full_history", lambda: (query, params))
+        # Остатки на дату в середине истории: снимок и движение не больше месяца
+        query, params = REPORTS["stock_as_of"].query(as_of=date.today() - timedelta(days=HISTORY_DAYS // 2))
+        self.measure("report.stock_as_of.mid_history", lambda: (query, params))
+
+    # Массовая вставка позиций через триггеры остатков, сумм и движения
+    def bench_triggers(self):
+        lines = BULK_LINES
+        incoming = f"""
+            WITH inv AS (
+                INSERT INTO incoming_invoices (warehouse_id, supplier, invoice_number, invoice_date)
+                VALUES (1, 'Замер', 'BENCH-' || md5(random()::text), CURRENT_DATE)
+                RETURNING incoming_id, invoice_date
+            )
+            INSERT INTO incoming_items (incoming_id, product_id, quantity, unit_price, invoice_date)
+            SELECT inv.incoming_id, p.product_id, 10, p.price, inv.invoice_date
+            FROM inv, (SELECT product_id, price FROM products ORDER BY random() LIMIT {lines}) p
+        """
+        self.measure(f"insert.incoming_items.{lines}_lines", lambda: (incoming, None))
+
+        # Расход — только товары, которые есть на складе
+        outgoing = f"""
+            WITH inv AS (
+                INSERT INTO outgoing_invoices (warehouse_id, customer, invoice_number, invoice_date)
+                VALUES (1, 'Замер', 'BENCH-' || md5(random()::text), CURRENT_DATE)
+                RETURNING outgoing_id, invoice_date
+            )
+            INSERT INTO outgoing_items (outgoing_id, product_id, quantity, unit_price, invoice_date)
+            SELECT inv.outgoing_id, sb.product_id, 1, p.price, inv.invoice_date
+            FROM inv, (SELECT product_id FROM stock_balances
+                       WHERE warehouse_id = 1 AND qty >= 1 ORDER BY random() LIMIT {lines}) sb
+            JOIN products p ON p.product_id = sb.product_id
+        """
+        self.measure(f"insert.outgoing_items.{lines}_lines", lambda: (outgoing, None))
+
+    # Одновременное проведение расхода по одним и тем же товарам
+    def bench_clerks(self, clerks=CLERKS, seconds=CLERK_SECONDS):
+        """Накладных в секунду при N кладовщиках, которые проводят одни и те же
+        популярные товары в разном порядке строк: прямой режим остатков и режим
+        журнала (SET LOCAL stock.ledger). Транзакции откатываются, блокировки
+        при этом держатся до отката так же, как до фиксации."""
+        hot = [row[0] for row in self.db.fetch("""
+            SELECT product_id FROM stock_balances
+            WHERE warehouse_id = 1
+            ORDER BY qty DESC
+            LIMIT %s
+        """, (HOT_PRODUCTS,))]
+        if not hot:
+            return
+        query = """
+            WITH inv AS (
+                INSERT INTO outgoing_invoices (warehouse_id, customer, invoice_number, invoice_date)
+                VALUES (1, 'Замер', 'BENCH-' || md5(random()::text), CURRENT_DATE)
+                RETURNING outgoing_id, invoice_date
+            )
+            INSERT INTO outgoing_items (outgoing_id, product_id, quantity, unit_price, invoice_date)
+            SELECT inv.outgoing_id, v.product_id, 1, 1, inv.invoice_date
+            FROM inv, unnest(%s::int[]) AS v (product_id)
+        """
+        pool = Database(minconn=0, maxconn=max(clerks), replicas=[], **self.db.config)
+        try:
+            for mode in ("off", "on"):
+                for n in clerks:
+                    self.post_concurrently(pool, f"clerks.ledger_{mode}.{n}", query, hot, mode, n, seconds)
+        finally:
+            pool.close()
+
+    def post_concurrently(self, pool, name, query, hot, mode, clerks, seconds):
+        stop = time.monotonic() + seconds
+        timings, errors = [], {}
+        lock = threading.Lock()
+
+        def clerk(seed):
+            rng = random.Random(seed)
+            with pool.connection() as conn:
+                try:
+                    while time.monotonic() < stop:
+                        lines = rng.sample(hot, min(CLERK_LINES, len(hot)))
+                        started = time.perf_counter()
+                        try:
+                            with conn.cursor() as cur:
+                                cur.execute(f"SET LOCAL stock.ledger = {mode}")
+                                cur.execute(query, (lines,))
+                            conn.rollback()
+                            with lock:
+                                timings.append((time.perf_counter() - started) * 1000)
+                        except psycopg2.Error as e:
+                            conn.rollback()
+                            with lock:
+                                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                finally:
+                    pool.rollback(conn)
+
+        threads = [threading.Thread(target=clerk, args=(self.rng.random(),)) for _ in range(clerks)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.record(name, timings, len(timings), per_second=round(len(timings) / seconds, 1),
+                    errors=errors)
+
+
+def environment(db):
+    """Что было замерено: версия, коммит, объём данных"""
+    counts = {}
+    for table in ("products", "incoming_invoices", "incoming_items", "outgoing_invoices",
+                  "outgoing_items", "stock_balances", "stock_movement_daily"):
+        counts[table] = int(db.fetch("SELECT reltuples FROM pg_class WHERE oid = %s::regclass",
+                                     (table,))[0][0])
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "server": db.fetch("SHOW server_version")[0][0],
+        "python": platform.python_version(),
+        "rows": counts,
+    }
+
+
+def compare(old, new, threshold=REGRESSION_PCT):
+    """Строки сравнения двух прогонов по медиане"""
+    lines = []
+    for name in sorted(set(old["results"]) | set(new["results"])):
+        a = old["results"].get(name, {}).get("median_ms")
+        b = new["results"].get(name, {}).get("median_ms")
+        if a is None or b is None:
+            lines.append(f"{name:45} {a or '—':>10} {b or '—':>10}")
+            continue
+        change = (b - a) / a * 100 if a else 0
+        mark = "  ХУЖЕ" if change > threshold else ("  лучше" if change < -threshold else "")
+        lines.append(f"{name:45} {a:>10.1f} {b:>10.1f} {change:>+7.1f}%{mark}")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Данные и замеры")
+    parser.add_argument("--dbname", help="база для замеров (по умолчанию из DB_CONFIG)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    gen = commands.add_parser("generate", help="заполнить базу синтетическими данными")
+    gen.add_argument("--scale", type=float, default=1.0, help="1 ≈ 1 млн позиций")
+    gen.add_argument("--seed", type=int, default=1)
+    gen.add_argument("--yes", action="store_true", help="подтвердить очистку таблиц")
+    run = commands.add_parser("run", help="выполнить замеры")
+    run.add_argument("--repeat", type=int, default=BENCH_REPEAT)
+    run.add_argument("--seed", type=int, default=1)
+    run.add_argument("--output", "-o", help="JSON с результатами")
+    cmp_ = commands.add_parser("compare", help="сравнить два JSON")
+    cmp_.add_argument("old")
+    cmp_.add_argument("new")
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        with open(args.old, encoding="utf-8") as f:
+            old = json.load(f)
+        with open(args.new, encoding="utf-8") as f:
+            new = json.load(f)
+        print("\n".join(compare(old, new)))
+        return
+
+    if args.command == "generate" and not args.yes:
+        raise SystemExit("Генератор очищает все таблицы склада; добавьте --yes")
+
+    config = {"dbname": args.dbname} if args.dbname else {}
+    db = Database(minconn=0, maxconn=2, **config)
+    try:
+        if args.command == "generate":
+            started = time.perf_counter()
+            generator = DataGenerator(args.scale, args.seed)
+            print("Объём:", generator.counts, file=sys.stderr)
+            generator.load(db, log=lambda text: print(text, file=sys.stderr))
+            print(f"Готово за {time.perf_counter() - started:.0f} с", file=sys.stderr)
+        else:
+            bench = Bench(db, args.repeat, args.seed)
+            result = {"environment": environment(db), "results": bench.run()}
+            if args.output:
+                with open(args.output, "w", encoding="utf-8") as f:
+                    json.dump(result, f, ensure_ascii=False, indent=2)
+            else:
+                json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Отчёты и обслуживание остатков из командной строки, без окон (tkinter не загружается):
+
+    python -m cli report profit --from 2025-01-01 --to 2025-12-31 --format csv
+    python -m cli report stock --warehouse 2 --format xlsx --output stock.xlsx
+    python -m cli report stock_as_of --date 2025-06-30 --warehouse 1
+    python -m cli snapshots       # месячные снимки остатков, например из cron
+    python -m cli ledger on       # режим журнала остатков для одновременных проводок
+    python -m cli compact         # перенос журнала остатков, работает постоянно
+
+CSV без --output пишется в stdout, так что отчёт можно отправить по конвейеру.
+Сервер — --dsn, реплики для отчётов — --replica (можно несколько раз):
+
+    python -m cli --dsn "host=db1" --replica "host=db2" report stock"""
+import argparse
+import logging
+import os
+import sys
+import time
+from datetime import date
+
+from db import Database
+from reports import (LEDGER_BATCH, REPORTS, compact_ledger, export_csv, export_query,
+                     set_ledger_mode, take_snapshots)
+
+COMPACT_INTERVAL = 2       # пауза переноса журнала остатков, с
+
+# Параметр отчёта -> ключ командной строки
+OPTIONS = {
+    "date_from": "--from",
+    "date_to": "--to",
+    "warehouse_id": "--warehouse",
+    "sku": "--sku",
+    "as_of": "--date",
+}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m cli", description="Отчёты склада")
+    parser.add_argument("--dsn", help="основной сервер, строка подключения libpq "
+                                      "(по умолчанию db.DB_CONFIG)")
+    parser.add_argument("--replica", action="append", metavar="DSN",
+                        help="реплика для отчётов (по умолчанию db.DB_REPLICAS)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    report = commands.add_parser("report", help="построить отчёт")
+    names = report.add_subparsers(dest="name", required=True)
+
+    for name, rep in REPORTS.items():
+        sub = names.add_parser(name, help=rep.title)
+        for param in rep.params:
+            hint = "ГГГГ-ММ-ДД" if param.kind is date else None
+            sub.add_argument(OPTIONS[param.name], dest=param.name, metavar=hint,
+                             help=param.label)
+        sub.add_argument("--format", choices=["csv", "xlsx"], default="csv")
+        sub.add_argument("--output", "-o", help="файл (для CSV по умолчанию stdout)")
+        sub.add_argument("--timeout", type=int, default=rep.timeout,
+                         help=f"лимит времени запроса, с (по умолчанию {rep.timeout})")
+    commands.add_parser("snapshots", help="создать недостающие месячные снимки остатков")
+
+    ledger = commands.add_parser("ledger", help="режим журнала остатков")
+    ledger.add_argument("mode", choices=["on", "off"])
+    compact = commands.add_parser("compact", help="переносить журнал остатков в stock_balances")
+    compact.add_argument("--interval", type=float, default=COMPACT_INTERVAL,
+                         help=f"пауза, когда журнал пуст, с (0 — перенести всё и выйти; "
+                              f"по умолчанию {COMPACT_INTERVAL})")
+    compact.add_argument("--batch", type=int, default=LEDGER_BATCH, help="строк журнала за один перенос")
+    return parser
+
+
+def open_db(args, **config):
+    """Одно соединение с сервером из --dsn (и по одному с репликами)"""
+    return Database(minconn=0, maxconn=1, dsn=args.dsn, replicas=args.replica, **config)
+
+
+def run(args):
+    report = REPORTS[args.name]
+    try:
+        query, params = report.query(**{p.name: getattr(args, p.name) for p in report.params})
+    except ValueError as e:
+        raise SystemExit(f"Ошибка: {e}")
+    if args.format == "xlsx" and not args.output:
+        raise SystemExit("Ошибка: для XLSX укажите --output")
+
+    # Одно соединение; лимит времени — на всю выгрузку
+    db = open_db(args, options=f"-c statement_timeout={args.timeout * 1000}")
+    try:
+        progress = {"rows": 0}
+        if args.output:
+            path = args.output
+            if args.format == "xlsx" and not path.lower().endswith(".xlsx"):
+                path += ".xlsx"
+            export_query(db, query, params, report.columns, path, progress, replica=True)
+        else:
+            with db.transaction(replica=True) as cur:
+                export_csv(cur, query, params, report.columns, sys.stdout.buffer, progress)
+            sys.stdout.flush()
+        print(f"Строк: {progress['rows']}", file=sys.stderr)
+    finally:
+        db.close()
+
+
+def snapshots(args):
+    db = open_db(args)
+    try:
+        print(f"Создано снимков: {take_snapshots(db)}", file=sys.stderr)
+    finally:
+        db.close()
+
+
+def ledger(args):
+    db = open_db(args)
+    try:
+        moved = set_ledger_mode(db, args.mode == "on")
+        print(f"Режим журнала: {args.mode}, перенесено строк: {moved}", file=sys.stderr)
+    finally:
+        db.close()
+
+
+def compact(args):
+    """Перенос журнала остатков, пока не прервут (Ctrl+C). Пока строки
+    есть — порция за порцией без пауз, пустой журнал — пауза --interval."""
+    db = open_db(args)
+    try:
+        while True:
+            moved = compact_ledger(db, args.batch)
+            if moved:
+                print(f"Перенесено строк журнала: {moved}", file=sys.stderr)
+                continue
+            if args.interval <= 0:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        db.close()
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    # Сообщения пула (медленные запросы, реплики, ошибки) — в stderr, stdout только для данных
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stderr)
+    if args.command == "report":
+        try:
+            run(args)
+        except BrokenPipeError:
+            # Читатель конвейера закрылся раньше (например head). Остаток
+            # буфера stdout некуда писать — направляем его в devnull,
+            # иначе Python сообщит об ошибке ещё раз при выходе
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            sys.exit(1)
+    elif args.command == "snapshots":
+        snapshots(args)
+    elif args.command == "ledger":
+        ledger(args)
+    elif args.command == "compact":
+        compact(args)
+
+
+if __name__ == "__main__":
+    main()
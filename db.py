@@ -0,0 +1,733 @@
+"""Доступ к базе: пул соединений, подготовленные запросы, транзакции.
+Модуль не зависит от интерфейса — его используют и окна, и командная строка."""
+import itertools
+import logging
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+
+# Параметры подключения к БД
+DB_CONFIG = {
+    "host": "localhost",
+    "port": "5432",
+    "user": "postgres",
+    "password": "1441",
+    "dbname": "for_term_paper",
+    "connect_timeout": 5,
+}
+
+POOL_MIN = 1          # соединений открывается сразу
+POOL_MAX = 5          # больше соединений пул не откроет, остальные ждут
+PING_IDLE = 5         # соединение, простоявшее дольше (с), проверяется SELECT 1
+PREPARED_MAX = 32     # подготовленных запросов на одно соединение (LRU)
+
+# Реплики для чтения (отчёты, списки, справочники): строки подключения libpq
+# или словари поверх DB_CONFIG, например [{"port": "5433"}]
+DB_REPLICAS = []
+REPLICA_MAX_LAG = 5   # реплика, отставшая больше (с), для чтения не используется
+REPLICA_CHECK = 2     # отставание реплики проверяется не чаще (с)
+REPLICA_RETRY = 30    # недоступная реплика пропускается на это время (с)
+
+# Пакеты независимых запросов (fetch_many) — через psycopg 3 (aiodb.py),
+# если он установлен; False — всегда в пуле потоков
+ASYNC_BACKEND = True
+
+# Диагностика пула — в журнал (по умолчанию stderr), не в stdout:
+# командная строка пишет туда данные
+log = logging.getLogger(__name__)
+
+PLACEHOLDER_RE = re.compile(r"%%|%s")
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def fingerprint(query):
+    """Запрос без лишних пробелов: один и тот же запрос с другими отступами
+    и параметрами даёт тот же отпечаток (ключ кэша планов и статистики)"""
+    return WHITESPACE_RE.sub(" ", query).strip()
+
+
+def to_positional(query):
+    """Заменить %s на $1, $2, ... для PREPARE; %% превращается в %"""
+    counter = itertools.count(1)
+
+    def sub(m):
+        return "%" if m.group() == "%%" else f"${next(counter)}"
+
+    text = PLACEHOLDER_RE.sub(sub, query)
+    return text, next(counter) - 1
+
+
+# Замеры запросов
+SLOW_QUERY_MS = 500       # медленнее — запрос попадает в журнал и для него снимается план
+STATS_WINDOW = 500        # последних замеров на запрос для гистограммы и перцентилей
+BYTES_SAMPLE = 1000       # по стольким строкам оценивается объём результата
+EXPLAIN_TIMEOUT = 60      # лимит на EXPLAIN ANALYZE медленного запроса, с
+SLOW_LOG_MAX = 100        # записей в журнале медленных запросов
+# Верхние границы столбцов гистограммы, мс
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+def estimate_bytes(rows):
+    """Примерный объём результата по текстовому виду значений; считается
+    по первым BYTES_SAMPLE строкам и пересчитывается на все"""
+    sample = rows[:BYTES_SAMPLE]
+    if not sample:
+        return 0
+    size = sum(len(str(value)) for row in sample for value in row if value is not None)
+    return size * len(rows) // len(sample)
+
+
+# Эти файлы в месте вызова не показываются: сам пул и обёртка contextmanager
+SKIP_FILES = {__file__, contextmanager.__code__.co_filename}
+
+
+def call_site(skip=()):
+    """Кто вызвал запрос: «Класс.метод ← Класс.метод» для двух ближайших
+    вызовов вне этого модуля. skip — классы-обёртки, которые пропускаются."""
+    frame = sys._getframe(1)
+    names = []
+    while frame is not None and len(names) < 2:
+        owner = frame.f_locals.get("self")
+        if frame.f_code.co_filename not in SKIP_FILES and not isinstance(owner, skip):
+            name = frame.f_code.co_name
+            names.append(f"{type(owner).__name__}.{name}" if owner is not None else name)
+        frame = frame.f_back
+    return " ← ".join(names) or "?"
+
+
+class QueryStats:
+    """Статистика по отпечаткам запросов: число вызовов, время, строки,
+    объём, откуда вызывались и скользящее окно последних замеров.
+    kind — "db" для запросов, "tk" для отрисовки Treeview.
+    Пишут фоновые потоки, читает окно диагностики — всё под блокировкой."""
+
+    def __init__(self, slow_ms=SLOW_QUERY_MS):
+        self.slow_ms = slow_ms
+        self.lock = threading.Lock()
+        self.entries = {}       # (вид, отпечаток) -> dict
+        self.slow = deque(maxlen=SLOW_LOG_MAX)     # (время, мс, отпечаток, откуда)
+
+    def record(self, kind, text, seconds, rows=0, size=0, caller="?"):
+        """Записать замер; True — запрос медленный"""
+        key = (kind, fingerprint(text))
+        ms = seconds * 1000
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = {
+                    "kind": kind, "query": key[1], "calls": 0, "total_ms": 0.0, "max_ms": 0.0,
+                    "rows": 0, "bytes": 0, "callers": {}, "recent": deque(maxlen=STATS_WINDOW),
+                    "plan": None,
+                }
+            entry["calls"] += 1
+            entry["total_ms"] += ms
+            entry["max_ms"] = max(entry["max_ms"], ms)
+            entry["rows"] += rows
+            entry["bytes"] += size
+            entry["callers"][caller] = entry["callers"].get(caller, 0) + 1
+            entry["recent"].append(ms)
+            slow = kind == "db" and ms >= self.slow_ms
+            if slow:
+                self.slow.append((time.time(), ms, key[1], caller))
+        return slow
+
+    def set_plan(self, text, plan):
+        with self.lock:
+            entry = self.entries.get(("db", fingerprint(text)))
+            if entry is not None:
+                entry["plan"] = plan
+
+    def needs_plan(self, text):
+        with self.lock:
+            entry = self.entries.get(("db", fingerprint(text)))
+            return entry is not None and entry["plan"] is None
+
+    def top(self, n=20, kind=None, by="total_ms"):
+        """Снимок n самых дорогих записей: словари с p50/p95 и гистограммой"""
+        with self.lock:
+            entries = [dict(e, callers=dict(e["callers"]), recent=list(e["recent"]))
+                       for e in self.entries.values() if kind is None or e["kind"] == kind]
+        entries.sort(key=lambda e: e[by], reverse=True)
+        for e in entries[:n]:
+            recent = sorted(e["recent"])
+            e["p50_ms"] = recent[len(recent) // 2] if recent else 0
+            e["p95_ms"] = recent[min(len(recent) - 1, len(recent) * 95 // 100)] if recent else 0
+            e["histogram"] = histogram(recent)
+        return entries[:n]
+
+    def slow_log(self):
+        with self.lock:
+            return list(self.slow)
+
+    def reset(self):
+        with self.lock:
+            self.entries.clear()
+            self.slow.clear()
+
+
+def histogram(values):
+    """[(граница мс или None для «больше»), число)] по LATENCY_BUCKETS_MS"""
+    counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    for ms in values:
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+    return list(zip(LATENCY_BUCKETS_MS + (None,), counts))
+
+
+# Общая статистика процесса: в неё пишут и пул, и окна (время отрисовки)
+STATS = QueryStats()
+
+
+def gather(futures):
+    """Один Future на несколько: список результатов в том же порядке или
+    первая ошибка. Отмена общего Future снимает ещё не начатые запросы."""
+    combined = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def child_done(future):
+        with lock:
+            if combined.done() or future.cancelled():
+                return
+            try:
+                if future.exception() is not None:
+                    combined.set_exception(future.exception())
+                    return
+                remaining[0] -= 1
+                if not remaining[0]:
+                    combined.set_result([f.result() for f in futures])
+            except InvalidStateError:
+                pass    # общий Future отменили, пока ждали
+
+    def cancel_children(f):
+        if f.cancelled():
+            for future in futures:
+                future.cancel()
+
+    if not futures:
+        combined.set_result([])
+    combined.add_done_callback(cancel_children)
+    for future in futures:
+        future.add_done_callback(child_done)
+    return combined
+
+
+def parse_config(spec):
+    """Параметры подключения из строки libpq («host=... port=...» или
+    postgresql://...) либо из словаря; None — пустой словарь"""
+    if spec is None:
+        return {}
+    if isinstance(spec, str):
+        return psycopg2.extensions.parse_dsn(spec)
+    return dict(spec)
+
+
+class Pool:
+    """Соединения с одним сервером: открывается не больше maxconn,
+    простоявшие соединения перед выдачей проверяются.
+    on_discard(conn) вызывается, когда соединение закрыто."""
+
+    def __init__(self, config, minconn, maxconn, on_discard=None):
+        self.config = config
+        self.maxconn = maxconn
+        self.on_discard = on_discard
+        self.idle = []          # свободные соединения: (conn, время возврата)
+        self.size = 0           # всего открытых соединений
+        self.closed = False
+        self.cond = threading.Condition()
+        for _ in range(minconn):
+            self.idle.append((self.connect(), time.monotonic()))
+            self.size += 1
+
+    @property
+    def name(self):
+        return f"{self.config.get('host', '')}:{self.config.get('port', '')}"
+
+    def connect(self):
+        return psycopg2.connect(**self.config)
+
+    def getconn(self):
+        """Взять соединение из пула (ждёт, если все заняты)"""
+        while True:
+            with self.cond:
+                while not self.idle and self.size >= self.maxconn:
+                    self.cond.wait()
+                if self.idle:
+                    conn, since = self.idle.pop()
+                else:
+                    conn = None
+                    self.size += 1
+
+            if conn is None:
+                try:
+                    return self.connect()
+                except Exception:
+                    self.discard(None)
+                    raise
+
+            if self.is_alive(conn, since):
+                return conn
+            # Сервер перезапускался или соединение оборвалось — открываем новое
+            log.warning("Соединение потеряно, переподключение")
+            self.discard(conn)
+
+    def putconn(self, conn):
+        """Вернуть соединение в пул; оборванные соединения выбрасываются"""
+        if conn.closed or self.closed:
+            self.discard(conn)
+            return
+        try:
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            self.discard(conn)
+            return
+        with self.cond:
+            self.idle.append((conn, time.monotonic()))
+            self.cond.notify()
+
+    def discard(self, conn):
+        if conn is not None:
+            if self.on_discard:
+                self.on_discard(conn)
+            if not conn.closed:
+                conn.close()
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+    def is_alive(self, conn, since):
+        if conn.closed:
+            return False
+        if time.monotonic() - since < PING_IDLE:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for conn, _ in idle:
+            self.discard(conn)
+
+
+class Replica(Pool):
+    """Пул реплики для чтения. Отставание проверяется не чаще REPLICA_CHECK;
+    отставшая больше REPLICA_MAX_LAG реплика пропускается, а недоступная
+    исключается на REPLICA_RETRY секунд — чтение идёт на основной сервер."""
+
+    # Всё полученное применено — отставания нет, даже если основной сервер
+    # давно ничего не писал; иначе — возраст последней применённой транзакции
+    LAG_QUERY = """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery()
+              OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+        END
+    """
+
+    def __init__(self, config, maxconn, on_discard=None):
+        # Соединения открываются по первому чтению: выключенная реплика
+        # не мешает запуску
+        super().__init__(config, 0, maxconn, on_discard)
+        self.lag = None         # отставание при последней проверке, с (None — неизвестно)
+        self.checked = 0.0      # когда проверялось отставание (monotonic)
+        self.down_until = 0.0   # до этого времени реплика не используется
+
+    def usable(self):
+        """Можно ли сейчас читать с реплики"""
+        if time.monotonic() < self.down_until:
+            return False
+        if time.monotonic() - self.checked >= REPLICA_CHECK:
+            self.check()
+        return self.lag is not None and self.lag <= REPLICA_MAX_LAG \
+            and time.monotonic() >= self.down_until
+
+    def check(self):
+        # Пока идёт проверка, другие потоки берут прежнее значение
+        self.checked = time.monotonic()
+        try:
+            conn = self.getconn()
+        except psycopg2.Error:
+            return
+        try:
+            with conn.cursor() as cur:
+                cur.execute(self.LAG_QUERY)
+                lag = cur.fetchone()[0]
+            conn.rollback()
+        except psycopg2.Error as e:
+            self.fail(e)
+            return
+        finally:
+            self.putconn(conn)
+
+        was_usable = self.lag is not None and self.lag <= REPLICA_MAX_LAG
+        self.lag = None if lag is None else float(lag)
+        if was_usable and (self.lag is None or self.lag > REPLICA_MAX_LAG):
+            log.warning("Реплика %s отстаёт, чтение с основного сервера: %s", self.name, lag)
+
+    def getconn(self):
+        try:
+            return super().getconn()
+        except psycopg2.OperationalError as e:
+            self.fail(e)
+            raise
+
+    def putconn(self, conn):
+        if conn.closed and not self.closed:
+            self.fail("соединение оборвалось")
+        super().putconn(conn)
+
+    def fail(self, reason):
+        log.warning("Реплика %s недоступна, чтение с основного сервера: %s", self.name, reason)
+        self.lag = None
+        self.down_until = time.monotonic() + REPLICA_RETRY
+
+
+class Database:
+    """Пулы соединений: основной сервер и, если заданы, реплики.
+    Каждая операция берёт своё соединение и свой курсор, так что окна
+    и фоновые задачи не мешают друг другу. Чтение с replica=True идёт
+    на реплики по очереди, запись и чтение сразу после записи — на основной.
+    dsn — строка подключения к основному серверу, replicas — к репликам
+    (строки или словари поверх параметров основного; по умолчанию DB_REPLICAS)."""
+
+    def __init__(self, minconn=POOL_MIN, maxconn=POOL_MAX, dsn=None, replicas=None, **config):
+        self.config = {**DB_CONFIG, **parse_config(dsn), **config}
+        self.closed = False
+        # Подготовленные запросы: conn -> (поколение, OrderedDict текст -> имя)
+        self.statements = {}
+        self.generation = 0     # увеличивается после изменения схемы
+        self.names = itertools.count(1)
+        self.stats = STATS
+        # Кто запустил фоновую задачу: поток пула не знает окна, его передаёт задача
+        self.local = threading.local()
+        self.aio = None         # AsyncBackend; False — psycopg 3 не установлен
+        self.aio_lock = threading.Lock()
+
+        try:
+            self.pool = Pool(self.config, minconn, maxconn, self.forget)
+        except Exception as e:
+            log.error("Ошибка подключения: %s", e)
+            raise
+        if replicas is None:
+            replicas = DB_REPLICAS
+        self.replicas = [Replica({**self.config, **parse_config(spec)}, maxconn, self.forget)
+                         for spec in replicas]
+        self.rotation = itertools.cycle(self.replicas)
+
+        workers = maxconn * (1 + len(self.replicas))
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="db")
+
+    # Пулы
+    def forget(self, conn):
+        """Соединение закрыто — его подготовленные запросы больше не нужны"""
+        self.statements.pop(conn, None)
+
+    def read_pool(self):
+        """Пул для чтения: следующая по кругу реплика, доступная и не отставшая;
+        если таких нет — основной сервер"""
+        for _ in range(len(self.replicas)):
+            replica = next(self.rotation)
+            if replica.usable():
+                return replica
+        return self.pool
+
+    @contextmanager
+    def connection(self, replica=False):
+        """Соединение из пула; replica=True — только для чтения, с реплики,
+        если есть подходящая"""
+        pool = self.read_pool() if replica else self.pool
+        try:
+            conn = pool.getconn()
+        except psycopg2.OperationalError:
+            if pool is self.pool:
+                raise
+            pool = self.pool
+            conn = pool.getconn()
+        try:
+            yield conn
+        finally:
+            pool.putconn(conn)
+
+    # Подготовленные запросы
+    def prepared(self, cur, query, params):
+        """Выполнить запрос через PREPARE/EXECUTE. Первый вызов на соединении
+        готовит план, последующие только передают параметры."""
+        conn = cur.connection
+        generation, cache = self.statements.get(conn, (None, None))
+        if generation != self.generation:
+            if cache is not None:
+                cur.execute("DEALLOCATE ALL")
+            cache = OrderedDict()
+            self.statements[conn] = (self.generation, cache)
+
+        key = fingerprint(query)
+        name = cache.get(key)
+        if name is None:
+            text, count = to_positional(query)
+            name = f"stmt_{next(self.names)}"
+            cur.execute(f"PREPARE {name} AS {text}")
+            cache[key] = name
+            if len(cache) > PREPARED_MAX:
+                _, old = cache.popitem(last=False)
+                cur.execute(f"DEALLOCATE {old}")
+        else:
+            cache.move_to_end(key)
+
+        args = list(params or ())
+        if args:
+            cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(args))})", args)
+        else:
+            cur.execute(f"EXECUTE {name}")
+
+    def invalidate_statements(self):
+        """Сбросить подготовленные запросы на всех соединениях (после изменения
+        схемы). Соединения освобождаются от планов при следующем запросе."""
+        self.generation += 1
+
+    # Запросы
+    def fetch(self, query, params=None, timeout=None, on_conn=None, prepare=False, replica=False):
+        """SELECT; timeout — лимит statement_timeout в секундах.
+        on_conn(conn) вызывается перед запросом (нужно для отмены).
+        prepare=True — выполнять через подготовленный запрос (для частых запросов
+        с неизменным текстом: текст, собранный из фильтров, засоряет кэш планов).
+        replica=True — можно читать с реплики (данные могут отставать на
+        REPLICA_MAX_LAG); не для чтения только что записанного.
+        При обрыве соединения запрос повторяется один раз на новом
+        (с реплики — уже на другом сервере)."""
+        for attempt in range(2):
+            with self.connection(replica) as conn:
+                if on_conn:
+                    on_conn(conn)
+                try:
+                    with conn.cursor() as cur:
+                        if timeout:
+                            cur.execute("SET LOCAL statement_timeout = %s", (int(timeout * 1000),))
+                        started = time.perf_counter()
+                        if prepare:
+                            self.prepared(cur, query, params)
+                        else:
+                            cur.execute(query, params)
+                        rows = cur.fetchall()
+                        elapsed = time.perf_counter() - started
+                    conn.commit()
+                    self.measure(query, params, elapsed, len(rows), estimate_bytes(rows), explain=True)
+                    return rows
+                except (psycopg2.errors.FeatureNotSupported,
+                        psycopg2.errors.InvalidSqlStatementName) as e:
+                    # План устарел (изменилась схема) или сервер забыл запрос
+                    self.rollback(conn)
+                    # Сбрасываем поколение, а не кэш: следующий prepared()
+                    # выполнит DEALLOCATE ALL и уберёт старые планы с сервера
+                    self.statements[conn] = (None, OrderedDict())
+                    if not prepare or attempt:
+                        log.error("Ошибка fetch: %s", e)
+                        raise
+                    log.warning("Подготовленный запрос устарел, повтор: %s", e)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                    if not conn.closed or attempt:
+                        log.error("Ошибка fetch: %s", e)
+                        self.rollback(conn)
+                        raise
+                    log.warning("Соединение потеряно, повтор запроса: %s", e)
+                except Exception as e:
+                    log.error("Ошибка fetch: %s", e)
+                    self.rollback(conn)
+                    raise
+
+    def execute(self, query, params=None):
+        """Изменение данных. Не повторяется при обрыве: неизвестно, успел ли
+        сервер выполнить запрос."""
+        with self.connection() as conn:
+            try:
+                with conn.cursor() as cur:
+                    started = time.perf_counter()
+                    cur.execute(query, params)
+                    rows = cur.rowcount
+                conn.commit()
+                self.measure(query, params, time.perf_counter() - started, max(rows, 0))
+            except Exception as e:
+                log.error("Ошибка execute: %s", e)
+                self.rollback(conn)
+                raise
+
+    @contextmanager
+    def transaction(self, on_conn=None, replica=False):
+        """Курсор в одной транзакции: commit при успехе, rollback при ошибке.
+        replica=True — транзакция только для чтения, можно на реплике."""
+        with self.connection(replica) as conn:
+            if on_conn:
+                on_conn(conn)
+            started = time.perf_counter()
+            try:
+                with conn.cursor() as cur:
+                    yield cur
+                conn.commit()
+            except Exception as e:
+                log.error("Ошибка транзакции: %s", e)
+                self.rollback(conn)
+                raise
+            # Отдельные запросы внутри не видны — замеряется транзакция целиком
+            caller = self.caller()
+            self.measure(f"ТРАНЗАКЦИЯ {caller}", None, time.perf_counter() - started)
+
+    # Пакеты запросов
+    def fetch_many(self, queries, timeout=None, replica=False, caller=None):
+        """Независимые SELECT одновременно: queries — [(запрос, параметры)].
+        Возвращает concurrent.futures.Future со списком результатов в том же
+        порядке (окна опрашивают его через after()). Ждать приходится самый
+        долгий запрос, а не сумму. С psycopg 3 пакет выполняется асинхронно
+        (aiodb.py), без него — в пуле потоков. Каждый запрос пакета занимает
+        своё соединение: пакет из N запросов — до N соединений сразу."""
+        caller = caller or self.caller()
+        backend = self.async_backend()
+        if backend is not None:
+            return backend.fetch_many(queries, timeout, replica, caller)
+        return gather([self.executor.submit(self.fetch_for, caller, query, params, timeout, replica)
+                       for query, params in queries])
+
+    def fetch_for(self, caller, query, params, timeout, replica):
+        self.local.caller = caller
+        try:
+            return self.fetch(query, params, timeout, replica=replica)
+        finally:
+            self.local.caller = None
+
+    def async_backend(self):
+        """AsyncBackend из aiodb.py; None — psycopg 3 не установлен или ASYNC_BACKEND выключен"""
+        with self.aio_lock:
+            if self.aio is None and not self.closed:
+                self.aio = False
+                if ASYNC_BACKEND:
+                    try:
+                        from aiodb import AsyncBackend
+                    except ImportError:
+                        log.info("psycopg 3 не установлен, пакеты запросов выполняются в пуле потоков")
+                    else:
+                        self.aio = AsyncBackend(self)
+            return self.aio or None
+
+    # Замеры
+    def caller(self):
+        return getattr(self.local, "caller", None) or call_site()
+
+    def measure(self, query, params, seconds, rows=0, size=0, explain=False, caller=None):
+        """Записать замер; для медленного SELECT один раз снимается план.
+        caller — место вызова, если запрос выполнялся не в потоке задачи."""
+        slow = self.stats.record("db", query, seconds, rows, size, caller or self.caller())
+        if not slow:
+            return
+        log.warning("Медленный запрос (%.0f мс): %s", seconds * 1000, fingerprint(query)[:200])
+        if explain and fingerprint(query).upper().startswith(("SELECT", "WITH")) \
+                and self.stats.needs_plan(query) and not self.closed:
+            self.stats.set_plan(query, "План снимается...")
+            self.executor.submit(self.explain, query, params)
+
+    def explain(self, query, params):
+        """EXPLAIN (ANALYZE, BUFFERS) выполняет запрос ещё раз, поэтому в фоне,
+        с лимитом времени, с откатом в конце и по возможности на реплике"""
+        try:
+            with self.connection(replica=True) as conn:
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute("SET LOCAL statement_timeout = %s", (EXPLAIN_TIMEOUT * 1000,))
+                        cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, params)
+                        plan = "\n".join(row[0] for row in cur.fetchall())
+                finally:
+                    self.rollback(conn)
+        except Exception as e:
+            plan = f"План не получен: {e}"
+        self.stats.set_plan(query, plan)
+
+    def rollback(self, conn):
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+
+    def close(self):
+        with self.aio_lock:
+            self.closed = True
+            if self.aio:
+                self.aio.close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for pool in [self.pool] + self.replicas:
+            pool.close()
+
+    def get_columns(self, table_name):
+        """Получить список колонок таблицы"""
+        return [col for col, _ in self.get_column_types(table_name)]
+
+    def get_table_info(self, table_name):
+        """Сведения для сортировки: колонки, с которых начинается btree-индекс,
+        колонки NOT NULL и оценка числа строк (по статистике, с секциями)"""
+        return table_info(*(self.fetch(query, (table_name,), replica=True)
+                            for query in TABLE_INFO_QUERIES))
+
+    def get_column_types(self, table_name):
+        """Колонки таблицы с типами: [(колонка, data_type)]"""
+        try:
+            return self.fetch(COLUMN_TYPES_QUERY, (table_name,), replica=True)
+        except Exception as e:
+            log.error("Ошибка получения типов колонок для %s: %s", table_name, e)
+            return []
+
+
+# Сведения о таблице для окна. Запросы независимы: окно таблицы читает
+# их одним пакетом (fetch_many), get_* выше — по одному
+COLUMN_TYPES_QUERY = """
+    SELECT column_name, data_type
+    FROM information_schema.columns
+    WHERE table_name = %s
+    ORDER BY ordinal_position
+"""
+
+# Колонки, с которых начинается btree-индекс; колонки NOT NULL; оценка числа строк
+TABLE_INFO_QUERIES = (
+    """
+    SELECT DISTINCT a.attname
+    FROM pg_index i
+    JOIN pg_class ic ON ic.oid = i.indexrelid
+    JOIN pg_am am ON am.oid = ic.relam
+    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+    WHERE i.indrelid = %s::regclass AND am.amname = 'btree'
+    """,
+    """
+    SELECT attname
+    FROM pg_attribute
+    WHERE attrelid = %s::regclass AND attnum > 0 AND attnotnull AND NOT attisdropped
+    """,
+    """
+    SELECT GREATEST(SUM(c.reltuples), 0)
+    FROM pg_partition_tree(%s::regclass) t
+    JOIN pg_class c ON c.oid = t.relid
+    """,
+)
+
+
+def table_info(indexed, not_null, rows):
+    """Сведения для сортировки из результатов TABLE_INFO_QUERIES"""
+    return {
+        "indexed": {row[0] for row in indexed},
+        "not_null": {row[0] for row in not_null},
+        "rows": int(rows[0][0] or 0),
+    }
@@ -1,16 +1,26 @@
 -- Полный скрипт для создания БД склада (исправленная версия)
 -- Просто запусти весь этот код
 
+DROP TABLE IF EXISTS invoice_numbers CASCADE;
+DROP TABLE IF EXISTS stock_ledger CASCADE;
+DROP TABLE IF EXISTS stock_settings CASCADE;
+DROP TABLE IF EXISTS stock_snapshots CASCADE;
+DROP TABLE IF EXISTS stock_snapshot_dates CASCADE;
+DROP TABLE IF EXISTS stock_movement_daily CASCADE;
 DROP TABLE IF EXISTS outgoing_items CASCADE;
 DROP TABLE IF EXISTS outgoing_invoices CASCADE;
 DROP TABLE IF EXISTS incoming_items CASCADE;
 DROP TABLE IF EXISTS incoming_invoices CASCADE;
+DROP TABLE IF EXISTS warehouse_stock_summary CASCADE;
 DROP TABLE IF EXISTS stock_balances CASCADE;
 DROP TABLE IF EXISTS products CASCADE;
 DROP TABLE IF EXISTS staff CASCADE;
 DROP TABLE IF EXISTS positions CASCADE;
 DROP TABLE IF EXISTS warehouses CASCADE;
 
+-- Триграммы для поиска подстроки (ILIKE '%...%') по индексу
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 -- Таблица складов
 CREATE TABLE warehouses (
     warehouse_id SERIAL PRIMARY KEY,
@@ -53,19 +63,25 @@ CREATE TABLE incoming_invoices (
     warehouse_id INTEGER NOT NULL REFERENCES warehouses(warehouse_id),
     supplier TEXT NOT NULL,
     invoice_number TEXT NOT NULL,
-    invoice_date DATE DEFAULT CURRENT_DATE,
+    invoice_date DATE NOT NULL DEFAULT CURRENT_DATE,
     total_amount NUMERIC(12,2) DEFAULT 0 CHECK (total_amount >= 0),
-    UNIQUE (warehouse_id, invoice_number)
+    UNIQUE (warehouse_id, invoice_number),
+    UNIQUE (incoming_id, invoice_date)
 );
 
 -- Таблица позиций прихода
 CREATE TABLE incoming_items (
     incoming_item_id SERIAL PRIMARY KEY,
-    incoming_id INTEGER NOT NULL REFERENCES incoming_invoices(incoming_id) ON DELETE CASCADE,
+    incoming_id INTEGER NOT NULL,
     product_id INTEGER NOT NULL REFERENCES products(product_id),
     quantity NUMERIC(12,3) NOT NULL CHECK (quantity > 0),
     unit_price NUMERIC(10,2) NOT NULL CHECK (unit_price >= 0),
-    line_total NUMERIC(12,2) GENERATED ALWAYS AS (quantity * unit_price) STORED
+    line_total NUMERIC(12,2) GENERATED ALWAYS AS (quantity * unit_price) STORED,
+    -- Дата накладной дублируется в позиции: по ней секционируются позиции
+    -- (см. partition_invoice_tables) и отсекаются ненужные секции в отчётах
+    invoice_date DATE NOT NULL,
+    FOREIGN KEY (incoming_id, invoice_date) REFERENCES incoming_invoices(incoming_id, invoice_date)
+        ON UPDATE CASCADE ON DELETE CASCADE
 );
 
 -- Таблица расходных накладных
@@ -74,19 +90,25 @@ CREATE TABLE outgoing_invoices (
     warehouse_id INTEGER NOT NULL REFERENCES warehouses(warehouse_id),
     customer TEXT NOT NULL,
     invoice_number TEXT NOT NULL,
-    invoice_date DATE DEFAULT CURRENT_DATE,
+    invoice_date DATE NOT NULL DEFAULT CURRENT_DATE,
     total_amount NUMERIC(12,2) DEFAULT 0 CHECK (total_amount >= 0),
-    UNIQUE (warehouse_id, invoice_number)
+    UNIQUE (warehouse_id, invoice_number),
+    UNIQUE (outgoing_id, invoice_date)
 );
 
 -- Таблица позиций расхода
 CREATE TABLE outgoing_items (
     outgoing_item_id SERIAL PRIMARY KEY,
-    outgoing_id INTEGER NOT NULL REFERENCES outgoing_invoices(outgoing_id) ON DELETE CASCADE,
+    outgoing_id INTEGER NOT NULL,
     product_id INTEGER NOT NULL REFERENCES products(product_id),
     quantity NUMERIC(12,3) NOT NULL CHECK (quantity > 0),
     unit_price NUMERIC(10,2) NOT NULL CHECK (unit_price >= 0),
-    line_total NUMERIC(12,2) GENERATED ALWAYS AS (quantity * unit_price) STORED
+    line_total NUMERIC(12,2) GENERATED ALWAYS AS (quantity * unit_price) STORED,
+    -- Дата накладной дублируется в позиции: по ней секционируются позиции
+    -- (см. partition_invoice_tables) и отсекаются ненужные секции в отчётах
+    invoice_date DATE NOT NULL,
+    FOREIGN KEY (outgoing_id, invoice_date) REFERENCES outgoing_invoices(outgoing_id, invoice_date)
+        ON UPDATE CASCADE ON DELETE CASCADE
 );
 
 -- Остатки
@@ -98,6 +120,74 @@ CREATE TABLE stock_balances (
     PRIMARY KEY (warehouse_id, product_id)
 );
 
+-- Журнал изменений остатков и движения (режим журнала, см. stock_settings).
+-- Проводка только добавляет строки; compact_stock_ledger() переносит их
+-- в stock_balances и stock_movement_daily. Текущий остаток — строка
+-- stock_balances плюс строки журнала (vw_stock_balances). Внешних ключей
+-- нет: строки пишут только триггеры из уже проверенных позиций
+CREATE TABLE stock_ledger (
+    entry_id BIGSERIAL PRIMARY KEY,
+    day DATE NOT NULL,
+    warehouse_id INTEGER NOT NULL,
+    product_id INTEGER NOT NULL,
+    qty NUMERIC(14,3) NOT NULL DEFAULT 0,          -- изменение остатка
+    in_qty NUMERIC(14,3) NOT NULL DEFAULT 0,       -- изменение движения за день
+    out_qty NUMERIC(14,3) NOT NULL DEFAULT 0,
+    in_value NUMERIC(16,2) NOT NULL DEFAULT 0,
+    out_value NUMERIC(16,2) NOT NULL DEFAULT 0
+);
+
+-- Настройки учёта остатков (одна строка)
+CREATE TABLE stock_settings (
+    id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+    ledger BOOLEAN NOT NULL DEFAULT false      -- режим журнала, см. record_stock_change
+);
+INSERT INTO stock_settings DEFAULT VALUES;
+
+-- Движение товаров по дням: день × склад × товар.
+-- Поддерживается триггерами позиций и накладных; отчёт о движении за период
+-- читает только строки нужных дней, а не всю историю позиций
+CREATE TABLE stock_movement_daily (
+    day DATE NOT NULL,
+    warehouse_id INTEGER NOT NULL REFERENCES warehouses(warehouse_id) ON DELETE CASCADE,
+    product_id INTEGER NOT NULL REFERENCES products(product_id) ON DELETE CASCADE,
+    in_qty NUMERIC(14,3) NOT NULL DEFAULT 0,
+    out_qty NUMERIC(14,3) NOT NULL DEFAULT 0,
+    in_value NUMERIC(16,2) NOT NULL DEFAULT 0,
+    out_value NUMERIC(16,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, warehouse_id, product_id)
+);
+
+-- Сводка по складам: стоимость запасов и число позиций.
+-- Поддерживается триггерами по дельтам, чтение — O(число складов).
+-- На склад до 16 строк-слотов: транзакция прибавляет дельты к своему слоту
+-- (stock_summary_slot), поэтому одновременные проводки по одному складу
+-- не ждут друг друга. Итог склада — сумма его слотов.
+CREATE TABLE warehouse_stock_summary (
+    warehouse_id INTEGER NOT NULL REFERENCES warehouses(warehouse_id) ON DELETE CASCADE,
+    slot SMALLINT NOT NULL DEFAULT 0,
+    total_value NUMERIC(16,2) NOT NULL DEFAULT 0,
+    product_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (warehouse_id, slot)
+);
+
+-- Снимки остатков на начало месяца: остаток на любую дату = ближайший
+-- снимок ± движение по дням между ним и датой (не вся история позиций).
+-- Снимки создаёт take_monthly_snapshots(), проводки задним числом
+-- поправляет триггер на stock_movement_daily
+CREATE TABLE stock_snapshot_dates (
+    snapshot_date DATE PRIMARY KEY,     -- остатки на начало этого дня
+    taken_at TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE TABLE stock_snapshots (
+    snapshot_date DATE NOT NULL REFERENCES stock_snapshot_dates(snapshot_date) ON DELETE CASCADE,
+    warehouse_id INTEGER NOT NULL REFERENCES warehouses(warehouse_id) ON DELETE CASCADE,
+    product_id INTEGER NOT NULL REFERENCES products(product_id) ON DELETE CASCADE,
+    qty NUMERIC(14,3) NOT NULL,
+    PRIMARY KEY (snapshot_date, warehouse_id, product_id)
+);
+
 -- ==================== ИНДЕКСЫ ====================
 CREATE INDEX idx_products_sku ON products(sku);
 CREATE INDEX idx_incoming_date ON incoming_invoices(invoice_date);
@@ -105,6 +195,24 @@ CREATE INDEX idx_outgoing_date ON outgoing_invoices(invoice_date);
 CREATE INDEX idx_staff_inn ON staff(inn);
 CREATE INDEX idx_stock_warehouse ON stock_balances(warehouse_id);
 CREATE INDEX idx_stock_product ON stock_balances(product_id);
+CREATE INDEX idx_incoming_items_invoice ON incoming_items(incoming_id);
+CREATE INDEX idx_outgoing_items_invoice ON outgoing_items(outgoing_id);
+CREATE INDEX idx_movement_product_day ON stock_movement_daily(product_id, day);
+CREATE INDEX idx_stock_ledger_key ON stock_ledger(warehouse_id, product_id);
+
+-- Поиск в окнах таблиц: подстрока без учёта регистра по триграммам
+CREATE INDEX idx_warehouses_name_trgm ON warehouses USING gin (name gin_trgm_ops);
+CREATE INDEX idx_staff_full_name_trgm ON staff USING gin (full_name gin_trgm_ops);
+CREATE INDEX idx_products_name_trgm ON products USING gin (name gin_trgm_ops);
+CREATE INDEX idx_products_sku_trgm ON products USING gin (sku gin_trgm_ops);
+CREATE INDEX idx_incoming_supplier_trgm ON incoming_invoices USING gin (supplier gin_trgm_ops);
+CREATE INDEX idx_incoming_number_trgm ON incoming_invoices USING gin (invoice_number gin_trgm_ops);
+CREATE INDEX idx_outgoing_customer_trgm ON outgoing_invoices USING gin (customer gin_trgm_ops);
+CREATE INDEX idx_outgoing_number_trgm ON outgoing_invoices USING gin (invoice_number gin_trgm_ops);
+
+-- Подсказки при выборе товара: слова названия и начало SKU
+CREATE INDEX idx_products_name_fts ON products USING gin (to_tsvector('simple', name));
+CREATE INDEX idx_products_sku_prefix ON products (upper(sku) text_pattern_ops);
 
 -- ==================== ПРЕДСТАВЛЕНИЯ ====================
 
@@ -113,6 +221,19 @@ CREATE OR REPLACE VIEW vw_products_info AS
 SELECT product_id, sku, name, unit, price, created_at
 FROM products;
 
+-- Представление: остатки с учётом ещё не перенесённого журнала.
+-- Журнал суммируется для каждой строки отдельно по idx_stock_ledger_key:
+-- условие страницы и LIMIT доходят до stock_balances, и страница читает
+-- журнал только своих позиций, даже если перенос отстал
+CREATE OR REPLACE VIEW vw_stock_balances AS
+SELECT sb.warehouse_id, sb.product_id, sb.qty + COALESCE(l.qty, 0) AS qty, sb.last_updated
+FROM stock_balances sb
+LEFT JOIN LATERAL (
+    SELECT SUM(e.qty) AS qty
+    FROM stock_ledger e
+    WHERE e.warehouse_id = sb.warehouse_id AND e.product_id = sb.product_id
+) l ON true;
+
 -- Представление: текущие остатки 
 CREATE OR REPLACE VIEW vw_current_stock AS
 SELECT
@@ -124,163 +245,1575 @@ SELECT
     sb.qty,
     ROUND(p.price * sb.qty, 2) AS stock_value,
     sb.last_updated
-FROM stock_balances sb
+FROM vw_stock_balances sb
 JOIN warehouses w ON w.warehouse_id = sb.warehouse_id
 JOIN products p ON p.product_id = sb.product_id;
 
--- Представление: общая стоимость запасов по складам (с GROUP BY и HAVING)
+-- Представление: общая стоимость запасов по складам
+-- (читает готовую сводку warehouse_stock_summary, а не все остатки;
+-- склады без запасов — с нулями)
 CREATE OR REPLACE VIEW vw_warehouse_stock_summary AS
 SELECT
     w.name AS warehouse_name,
-    SUM(p.price * sb.qty) AS total_value,
-    COUNT(sb.product_id) AS product_count
-FROM stock_balances sb
-JOIN warehouses w ON w.warehouse_id = sb.warehouse_id
-JOIN products p ON p.product_id = sb.product_id
-GROUP BY w.name
-HAVING SUM(p.price * sb.qty) > 0
+    COALESCE(SUM(s.total_value), 0) AS total_value,
+    COALESCE(SUM(s.product_count), 0) AS product_count
+FROM warehouses w
+LEFT JOIN warehouse_stock_summary s ON s.warehouse_id = w.warehouse_id
+GROUP BY w.warehouse_id, w.name
 ORDER BY total_value DESC;
 
+-- ==================== ЗАПИСЬ ОСТАТКОВ И ДВИЖЕНИЯ ====================
+-- Два режима (stock_settings.ledger):
+--   прямой — проводка сразу меняет stock_balances и stock_movement_daily;
+--   журнал — проводка только добавляет строки в stock_ledger и не ждёт
+--            строк остатка; compact_stock_ledger()
+--            периодически переносит их в stock_balances и stock_movement_daily
+--            (python -m cli compact). Для популярных товаров, которые
+--            одновременно проводят несколько кладовщиков.
+-- Строки stock_balances и блокировки расхода всегда берутся в порядке
+-- (warehouse_id, product_id), поэтому встречные накладные не блокируют друг
+-- друга по кругу.
+-- Режим можно переопределить для сеанса: SET stock.ledger = on / off; строки,
+-- записанные так при выключенном режиме, переносит только python -m cli compact.
+CREATE OR REPLACE FUNCTION stock_ledger_enabled()
+RETURNS BOOLEAN AS $$
+  SELECT COALESCE(NULLIF(current_setting('stock.ledger', true), '')::boolean,
+                  (SELECT ledger FROM stock_settings))
+$$ LANGUAGE sql STABLE;
+
+-- Изменение остатков по (склад, товар), ключи без повторов: недостающие
+-- строки создаются, затем все блокируются по порядку ключа, и строки
+-- меняются одним UPDATE. Уменьшение, после которого база + журнал ушли бы
+-- в минус, отклоняется, в том числе для пары без строки остатка
+CREATE OR REPLACE FUNCTION apply_stock_balances(p_warehouses INTEGER[], p_products INTEGER[],
+                                                p_deltas NUMERIC[])
+RETURNS void AS $$
+DECLARE
+  v_bad RECORD;
+BEGIN
+  INSERT INTO stock_balances (warehouse_id, product_id, qty, last_updated)
+  SELECT d.warehouse_id, d.product_id, 0, now()
+  FROM unnest(p_warehouses, p_products, p_deltas) AS d(warehouse_id, product_id, delta)
+  WHERE d.delta > 0
+  ORDER BY d.warehouse_id, d.product_id
+  ON CONFLICT (warehouse_id, product_id) DO NOTHING;
+
+  PERFORM 1
+  FROM stock_balances sb
+  JOIN unnest(p_warehouses, p_products) AS d(warehouse_id, product_id)
+    ON sb.warehouse_id = d.warehouse_id AND sb.product_id = d.product_id
+  ORDER BY sb.warehouse_id, sb.product_id
+  FOR UPDATE OF sb;
+
+  SELECT d.warehouse_id, d.product_id, COALESCE(sb.qty, 0) + COALESCE(l.qty, 0) + d.delta AS qty
+  INTO v_bad
+  FROM unnest(p_warehouses, p_products, p_deltas) AS d(warehouse_id, product_id, delta)
+  LEFT JOIN stock_balances sb ON sb.warehouse_id = d.warehouse_id AND sb.product_id = d.product_id
+  LEFT JOIN LATERAL (
+    SELECT SUM(e.qty) AS qty
+    FROM stock_ledger e
+    WHERE e.warehouse_id = d.warehouse_id AND e.product_id = d.product_id
+  ) l ON true
+  WHERE d.delta < 0 AND COALESCE(sb.qty, 0) + COALESCE(l.qty, 0) + d.delta < 0
+  LIMIT 1;
+  IF FOUND THEN
+    RAISE EXCEPTION 'Недостаточно товара % на складе %: остаток стал бы %',
+      v_bad.product_id, v_bad.warehouse_id, v_bad.qty
+      USING ERRCODE = 'check_violation';
+  END IF;
+
+  UPDATE stock_balances sb
+  SET qty = sb.qty + d.delta, last_updated = now()
+  FROM unnest(p_warehouses, p_products, p_deltas) AS d(warehouse_id, product_id, delta)
+  WHERE sb.warehouse_id = d.warehouse_id AND sb.product_id = d.product_id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Изменение движения по дням, строки вставляются и блокируются по порядку ключа
+CREATE OR REPLACE FUNCTION apply_movement(p_days DATE[], p_warehouses INTEGER[], p_products INTEGER[],
+                                          p_in_qty NUMERIC[], p_out_qty NUMERIC[],
+                                          p_in_value NUMERIC[], p_out_value NUMERIC[])
+RETURNS void AS $$
+BEGIN
+  INSERT INTO stock_movement_daily AS m (day, warehouse_id, product_id, in_qty, out_qty, in_value, out_value)
+  SELECT d.day, d.warehouse_id, d.product_id,
+         SUM(d.in_qty), SUM(d.out_qty), SUM(d.in_value), SUM(d.out_value)
+  FROM unnest(p_days, p_warehouses, p_products, p_in_qty, p_out_qty, p_in_value, p_out_value)
+       AS d(day, warehouse_id, product_id, in_qty, out_qty, in_value, out_value)
+  GROUP BY d.day, d.warehouse_id, d.product_id
+  ORDER BY d.day, d.warehouse_id, d.product_id
+  ON CONFLICT (day, warehouse_id, product_id) DO UPDATE
+  SET in_qty = m.in_qty + EXCLUDED.in_qty, out_qty = m.out_qty + EXCLUDED.out_qty,
+      in_value = m.in_value + EXCLUDED.in_value, out_value = m.out_value + EXCLUDED.out_value;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Проводка позиций: p_kind — 'incoming' или 'outgoing', массивы — изменение
+-- количества и суммы позиций по (день, склад, товар).
+-- Уменьшение остатка проверяется под рекомендательной блокировкой пары
+-- (склад, товар) до конца транзакции, иначе две накладные продали бы один
+-- и тот же товар. Блокировки берутся в обоих режимах (сеанс может
+-- переопределить режим) по порядку ключа; строки stock_balances в режиме
+-- журнала не блокируются, так что расход ждёт только расход тех же товаров,
+-- а приходы и перенос журнала не ждут никого. Чужой расход проверка видит
+-- после его фиксации, поэтому проводки идут в READ COMMITTED (по умолчанию).
+CREATE OR REPLACE FUNCTION record_stock_change(p_kind TEXT, p_days DATE[], p_warehouses INTEGER[],
+                                               p_products INTEGER[], p_qty NUMERIC[], p_value NUMERIC[])
+RETURNS void AS $$
+DECLARE
+  v_sign INTEGER := CASE p_kind WHEN 'incoming' THEN 1 ELSE -1 END;
+  v_zero NUMERIC[];
+  k_warehouses INTEGER[];
+  k_products INTEGER[];
+  k_deltas NUMERIC[];
+  v_key RECORD;
+  v_bad RECORD;
+BEGIN
+  IF COALESCE(cardinality(p_qty), 0) = 0 THEN
+    RETURN;
+  END IF;
+
+  -- Режим читается под блокировкой журнала, которую ждёт set_stock_ledger:
+  -- иначе проводка, прочитавшая «журнал» до его выключения, добавила бы
+  -- строки уже после последнего переноса
+  LOCK TABLE stock_ledger IN ROW EXCLUSIVE MODE;
+
+  -- Изменение остатка по (склад, товар) в порядке ключа
+  SELECT array_agg(warehouse_id ORDER BY warehouse_id, product_id),
+         array_agg(product_id ORDER BY warehouse_id, product_id),
+         array_agg(delta ORDER BY warehouse_id, product_id)
+  INTO k_warehouses, k_products, k_deltas
+  FROM (
+    SELECT d.warehouse_id, d.product_id, v_sign * SUM(d.qty) AS delta
+    FROM unnest(p_warehouses, p_products, p_qty) AS d(warehouse_id, product_id, qty)
+    GROUP BY d.warehouse_id, d.product_id
+    HAVING SUM(d.qty) <> 0
+  ) k;
+
+  FOR v_key IN
+    SELECT d.warehouse_id, d.product_id
+    FROM unnest(k_warehouses, k_products, k_deltas) AS d(warehouse_id, product_id, delta)
+    WHERE d.delta < 0
+    ORDER BY d.warehouse_id, d.product_id
+  LOOP
+    PERFORM pg_advisory_xact_lock((v_key.warehouse_id::bigint << 32) | v_key.product_id);
+  END LOOP;
+
+  IF NOT stock_ledger_enabled() THEN
+    PERFORM apply_stock_balances(k_warehouses, k_products, k_deltas);
+    v_zero := array_fill(0::numeric, ARRAY[cardinality(p_qty)]);
+    IF v_sign > 0 THEN
+      PERFORM apply_movement(p_days, p_warehouses, p_products, p_qty, v_zero, p_value, v_zero);
+    ELSE
+      PERFORM apply_movement(p_days, p_warehouses, p_products, v_zero, p_qty, v_zero, p_value);
+    END IF;
+    RETURN;
+  END IF;
+
+  -- Новые пары (склад, товар) получают строку остатка; существующие
+  -- строки при этом не блокируются
+  INSERT INTO stock_balances (warehouse_id, product_id, qty, last_updated)
+  SELECT d.warehouse_id, d.product_id, 0, now()
+  FROM unnest(k_warehouses, k_products, k_deltas) AS d(warehouse_id, product_id, delta)
+  WHERE d.delta > 0
+  ORDER BY d.warehouse_id, d.product_id
+  ON CONFLICT (warehouse_id, product_id) DO NOTHING;
+
+  SELECT d.warehouse_id, d.product_id, COALESCE(sb.qty, 0) + COALESCE(l.qty, 0) + d.delta AS qty
+  INTO v_bad
+  FROM unnest(k_warehouses, k_products, k_deltas) AS d(warehouse_id, product_id, delta)
+  LEFT JOIN stock_balances sb ON sb.warehouse_id = d.warehouse_id AND sb.product_id = d.product_id
+  LEFT JOIN LATERAL (
+    SELECT SUM(e.qty) AS qty
+    FROM stock_ledger e
+    WHERE e.warehouse_id = d.warehouse_id AND e.product_id = d.product_id
+  ) l ON true
+  WHERE d.delta < 0 AND COALESCE(sb.qty, 0) + COALESCE(l.qty, 0) + d.delta < 0
+  LIMIT 1;
+  IF FOUND THEN
+    RAISE EXCEPTION 'Недостаточно товара % на складе %: остаток стал бы %',
+      v_bad.product_id, v_bad.warehouse_id, v_bad.qty
+      USING ERRCODE = 'check_violation';
+  END IF;
+
+  INSERT INTO stock_ledger (day, warehouse_id, product_id, qty, in_qty, out_qty, in_value, out_value)
+  SELECT d.day, d.warehouse_id, d.product_id, v_sign * d.qty,
+         CASE WHEN v_sign > 0 THEN d.qty ELSE 0 END, CASE WHEN v_sign < 0 THEN d.qty ELSE 0 END,
+         CASE WHEN v_sign > 0 THEN d.value ELSE 0 END, CASE WHEN v_sign < 0 THEN d.value ELSE 0 END
+  FROM unnest(p_days, p_warehouses, p_products, p_qty, p_value)
+       AS d(day, warehouse_id, product_id, qty, value);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Только движение (смена даты или склада накладной, её удаление):
+-- остатки не меняются
+CREATE OR REPLACE FUNCTION record_movement(p_kind TEXT, p_days DATE[], p_warehouses INTEGER[],
+                                           p_products INTEGER[], p_qty NUMERIC[], p_value NUMERIC[])
+RETURNS void AS $$
+DECLARE
+  v_zero NUMERIC[];
+BEGIN
+  IF COALESCE(cardinality(p_qty), 0) = 0 THEN
+    RETURN;
+  END IF;
+
+  -- Как в record_stock_change: режим — под блокировкой журнала
+  LOCK TABLE stock_ledger IN ROW EXCLUSIVE MODE;
+  IF stock_ledger_enabled() THEN
+    INSERT INTO stock_ledger (day, warehouse_id, product_id, in_qty, out_qty, in_value, out_value)
+    SELECT d.day, d.warehouse_id, d.product_id,
+           CASE WHEN p_kind = 'incoming' THEN d.qty ELSE 0 END,
+           CASE WHEN p_kind = 'incoming' THEN 0 ELSE d.qty END,
+           CASE WHEN p_kind = 'incoming' THEN d.value ELSE 0 END,
+           CASE WHEN p_kind = 'incoming' THEN 0 ELSE d.value END
+    FROM unnest(p_days, p_warehouses, p_products, p_qty, p_value)
+         AS d(day, warehouse_id, product_id, qty, value);
+    RETURN;
+  END IF;
+
+  v_zero := array_fill(0::numeric, ARRAY[cardinality(p_qty)]);
+  IF p_kind = 'incoming' THEN
+    PERFORM apply_movement(p_days, p_warehouses, p_products, p_qty, v_zero, p_value, v_zero);
+  ELSE
+    PERFORM apply_movement(p_days, p_warehouses, p_products, v_zero, p_qty, v_zero, p_value);
+  END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Перенос журнала: товары из p_limit самых старых строк (NULL — весь журнал)
+-- переносятся со всеми своими строками и одним проходом применяются
+-- к stock_balances и stock_movement_daily. Строки товара берутся все сразу:
+-- неотрицательна только сумма базы и всего журнала, а не её часть.
+-- Переносы идут по одному; если уже идёт другой, возвращает 0, иначе —
+-- число перенесённых строк.
+CREATE OR REPLACE FUNCTION compact_stock_ledger(p_limit INTEGER DEFAULT 10000)
+RETURNS INTEGER AS $$
+DECLARE
+  n INTEGER;
+  v_days DATE[];
+  v_warehouses INTEGER[];
+  v_products INTEGER[];
+  v_qty NUMERIC[];
+  v_in_qty NUMERIC[];
+  v_out_qty NUMERIC[];
+  v_in_value NUMERIC[];
+  v_out_value NUMERIC[];
+  k_warehouses INTEGER[];
+  k_products INTEGER[];
+  k_deltas NUMERIC[];
+BEGIN
+  IF NOT pg_try_advisory_xact_lock(hashtext('compact_stock_ledger')) THEN
+    RETURN 0;
+  END IF;
+
+  WITH keys AS (
+    SELECT DISTINCT warehouse_id, product_id
+    FROM (SELECT warehouse_id, product_id FROM stock_ledger ORDER BY entry_id LIMIT p_limit) e
+  ), batch AS (
+    DELETE FROM stock_ledger l
+    USING keys k
+    WHERE l.warehouse_id = k.warehouse_id AND l.product_id = k.product_id
+    RETURNING l.day, l.warehouse_id, l.product_id, l.qty, l.in_qty, l.out_qty, l.in_value, l.out_value
+  ), m AS (
+    SELECT day, warehouse_id, product_id, COUNT(*) AS entries, SUM(qty) AS qty,
+           SUM(in_qty) AS in_qty, SUM(out_qty) AS out_qty,
+           SUM(in_value) AS in_value, SUM(out_value) AS out_value
+    FROM batch
+    GROUP BY day, warehouse_id, product_id
+  )
+  SELECT COALESCE(SUM(entries), 0), array_agg(day), array_agg(warehouse_id), array_agg(product_id),
+         array_agg(qty), array_agg(in_qty), array_agg(out_qty), array_agg(in_value), array_agg(out_value)
+  INTO n, v_days, v_warehouses, v_products, v_qty, v_in_qty, v_out_qty, v_in_value, v_out_value
+  FROM m;
+  IF n = 0 THEN
+    RETURN 0;
+  END IF;
+
+  SELECT array_agg(warehouse_id ORDER BY warehouse_id, product_id),
+         array_agg(product_id ORDER BY warehouse_id, product_id),
+         array_agg(delta ORDER BY warehouse_id, product_id)
+  INTO k_warehouses, k_products, k_deltas
+  FROM (
+    SELECT d.warehouse_id, d.product_id, SUM(d.qty) AS delta
+    FROM unnest(v_warehouses, v_products, v_qty) AS d(warehouse_id, product_id, qty)
+    GROUP BY d.warehouse_id, d.product_id
+    HAVING SUM(d.qty) <> 0
+  ) k;
+
+  PERFORM apply_stock_balances(k_warehouses, k_products, k_deltas);
+  PERFORM apply_movement(v_days, v_warehouses, v_products, v_in_qty, v_out_qty, v_in_value, v_out_value);
+  RETURN n;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Включить или выключить режим журнала. При выключении журнал переносится
+-- целиком; запись в журнал на это время заблокирована. Возвращает число
+-- перенесённых строк.
+CREATE OR REPLACE FUNCTION set_stock_ledger(p_enabled BOOLEAN)
+RETURNS INTEGER AS $$
+BEGIN
+  -- Сначала дождаться идущего переноса, потом закрыть запись в журнал
+  PERFORM pg_advisory_xact_lock(hashtext('compact_stock_ledger'));
+  LOCK TABLE stock_ledger IN EXCLUSIVE MODE;
+  UPDATE stock_settings SET ledger = p_enabled;
+  IF p_enabled THEN
+    RETURN 0;
+  END IF;
+  RETURN compact_stock_ledger(NULL);
+END;
+$$ LANGUAGE plpgsql;
+
 -- ==================== ТРИГГЕРЫ ====================
 
+-- Триггер: дата накладной в позиции прихода, если она не указана
+CREATE OR REPLACE FUNCTION set_incoming_item_date()
+RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'UPDATE' OR NEW.invoice_date IS NULL THEN
+    NEW.invoice_date := (SELECT invoice_date FROM incoming_invoices
+                         WHERE incoming_id = NEW.incoming_id);
+  END IF;
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_incoming_items_date
+BEFORE INSERT OR UPDATE OF incoming_id ON incoming_items
+FOR EACH ROW EXECUTE FUNCTION set_incoming_item_date();
+
+
+-- Триггер: дата накладной в позиции расхода, если она не указана
+CREATE OR REPLACE FUNCTION set_outgoing_item_date()
+RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'UPDATE' OR NEW.invoice_date IS NULL THEN
+    NEW.invoice_date := (SELECT invoice_date FROM outgoing_invoices
+                         WHERE outgoing_id = NEW.outgoing_id);
+  END IF;
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_outgoing_items_date
+BEFORE INSERT OR UPDATE OF outgoing_id ON outgoing_items
+FOR EACH ROW EXECUTE FUNCTION set_outgoing_item_date();
+
+
 -- Триггер: обновление total_amount для приходных накладных
+-- Один раз на оператор: пересчитываются только затронутые накладные,
+-- поэтому массовая вставка позиций не пересчитывает сумму на каждой строке
 CREATE OR REPLACE FUNCTION update_incoming_total()
 RETURNS trigger AS $$
 DECLARE
-    inv_id INTEGER;
+    inv_ids INTEGER[];
 BEGIN
-  -- Определяем ID накладной в зависимости от операции
-  IF TG_OP = 'DELETE' THEN
-    inv_id := OLD.incoming_id;
+  -- Определяем ID накладных в зависимости от операции
+  IF TG_OP = 'INSERT' THEN
+    SELECT array_agg(DISTINCT incoming_id) INTO inv_ids FROM new_items;
+  ELSIF TG_OP = 'UPDATE' THEN
+    SELECT array_agg(DISTINCT id) INTO inv_ids
+    FROM (SELECT incoming_id FROM new_items
+          UNION
+          SELECT incoming_id FROM old_items) x(id);
   ELSE
-    inv_id := NEW.incoming_id;
+    SELECT array_agg(DISTINCT incoming_id) INTO inv_ids FROM old_items;
   END IF;
 
-  -- Обновляем итоговую сумму
-  UPDATE incoming_invoices
+  -- Обновляем итоговые суммы
+  UPDATE incoming_invoices inv
      SET total_amount = (SELECT COALESCE(SUM(line_total),0)
-                         FROM incoming_items WHERE incoming_id = inv_id)
-   WHERE incoming_id = inv_id;
-   
-  IF TG_OP = 'DELETE' THEN
-    RETURN OLD;
-  ELSE
-    RETURN NEW;
-  END IF;
+                         FROM incoming_items it WHERE it.incoming_id = inv.incoming_id)
+   WHERE inv.incoming_id = ANY(inv_ids);
+
+  RETURN NULL;
 END;
 $$ LANGUAGE plpgsql;
 
-CREATE TRIGGER trg_incoming_items_total
-AFTER INSERT OR UPDATE OR DELETE ON incoming_items
-FOR EACH ROW EXECUTE FUNCTION update_incoming_total();
+CREATE TRIGGER trg_incoming_items_total_insert
+AFTER INSERT ON incoming_items
+REFERENCING NEW TABLE AS new_items
+FOR EACH STATEMENT EXECUTE FUNCTION update_incoming_total();
+
+CREATE TRIGGER trg_incoming_items_total_update
+AFTER UPDATE ON incoming_items
+REFERENCING OLD TABLE AS old_items NEW TABLE AS new_items
+FOR EACH STATEMENT EXECUTE FUNCTION update_incoming_total();
 
+CREATE TRIGGER trg_incoming_items_total_delete
+AFTER DELETE ON incoming_items
+REFERENCING OLD TABLE AS old_items
+FOR EACH STATEMENT EXECUTE FUNCTION update_incoming_total();
 
--- Триггер: обновление total_amount для расходных накладных (ИСПРАВЛЕНО)
+
+-- Триггер: обновление total_amount для расходных накладных (так же по оператору)
 CREATE OR REPLACE FUNCTION update_outgoing_total()
 RETURNS trigger AS $$
 DECLARE
-    inv_id INTEGER;
+    inv_ids INTEGER[];
 BEGIN
-  -- Определяем ID накладной в зависимости от операции
-  IF TG_OP = 'DELETE' THEN
-    inv_id := OLD.outgoing_id;
+  -- Определяем ID накладных в зависимости от операции
+  IF TG_OP = 'INSERT' THEN
+    SELECT array_agg(DISTINCT outgoing_id) INTO inv_ids FROM new_items;
+  ELSIF TG_OP = 'UPDATE' THEN
+    SELECT array_agg(DISTINCT id) INTO inv_ids
+    FROM (SELECT outgoing_id FROM new_items
+          UNION
+          SELECT outgoing_id FROM old_items) x(id);
   ELSE
-    inv_id := NEW.outgoing_id;
+    SELECT array_agg(DISTINCT outgoing_id) INTO inv_ids FROM old_items;
   END IF;
 
-  -- Обновляем итоговую сумму
-  UPDATE outgoing_invoices
+  -- Обновляем итоговые суммы
+  UPDATE outgoing_invoices inv
      SET total_amount = (SELECT COALESCE(SUM(line_total),0)
-                         FROM outgoing_items WHERE outgoing_id = inv_id)
-   WHERE outgoing_id = inv_id;
-   
-  IF TG_OP = 'DELETE' THEN
-    RETURN OLD;
-  ELSE
-    RETURN NEW;
-  END IF;
+                         FROM outgoing_items it WHERE it.outgoing_id = inv.outgoing_id)
+   WHERE inv.outgoing_id = ANY(inv_ids);
+
+  RETURN NULL;
 END;
 $$ LANGUAGE plpgsql;
 
-CREATE TRIGGER trg_outgoing_items_total
-AFTER INSERT OR UPDATE OR DELETE ON outgoing_items
-FOR EACH ROW EXECUTE FUNCTION update_outgoing_total();
+CREATE TRIGGER trg_outgoing_items_total_insert
+AFTER INSERT ON outgoing_items
+REFERENCING NEW TABLE AS new_items
+FOR EACH STATEMENT EXECUTE FUNCTION update_outgoing_total();
+
+CREATE TRIGGER trg_outgoing_items_total_update
+AFTER UPDATE ON outgoing_items
+REFERENCING OLD TABLE AS old_items NEW TABLE AS new_items
+FOR EACH STATEMENT EXECUTE FUNCTION update_outgoing_total();
+
+CREATE TRIGGER trg_outgoing_items_total_delete
+AFTER DELETE ON outgoing_items
+REFERENCING OLD TABLE AS old_items
+FOR EACH STATEMENT EXECUTE FUNCTION update_outgoing_total();
 
 
--- Триггер: корректировка остатков при приходе товара
+-- Триггер: корректировка остатков и движения по дням при приходе товара
+-- Срабатывает один раз на оператор: изменения из таблиц переходов
+-- суммируются по (день, склад, товар) и передаются в record_stock_change
+-- одним вызовом, поэтому накладная на 5000 строк стоит O(число разных товаров).
 CREATE OR REPLACE FUNCTION adjust_stock_on_incoming()
 RETURNS trigger AS $$
 DECLARE
-  w_id INT;
-  old_qty NUMERIC(12,3);
-  new_qty NUMERIC(12,3);
+  v_days DATE[];
+  v_warehouses INTEGER[];
+  v_products INTEGER[];
+  v_qty NUMERIC[];
+  v_value NUMERIC[];
 BEGIN
   IF TG_OP = 'INSERT' THEN
-    w_id := (SELECT warehouse_id FROM incoming_invoices WHERE incoming_id = NEW.incoming_id);
-    INSERT INTO stock_balances(warehouse_id, product_id, qty, last_updated)
-    VALUES (w_id, NEW.product_id, NEW.quantity, now())
-    ON CONFLICT (warehouse_id, product_id)
-    DO UPDATE SET qty = stock_balances.qty + EXCLUDED.qty, last_updated = now();
-    RETURN NEW;
-    
+    SELECT array_agg(day), array_agg(warehouse_id), array_agg(product_id), array_agg(qty), array_agg(value)
+    INTO v_days, v_warehouses, v_products, v_qty, v_value
+    FROM (
+      SELECT inv.invoice_date AS day, inv.warehouse_id, n.product_id,
+             SUM(n.quantity) AS qty, SUM(n.line_total) AS value
+      FROM new_items n
+      JOIN incoming_invoices inv ON inv.incoming_id = n.incoming_id
+      GROUP BY inv.invoice_date, inv.warehouse_id, n.product_id
+    ) d;
+
   ELSIF TG_OP = 'UPDATE' THEN
-    w_id := (SELECT warehouse_id FROM incoming_invoices WHERE incoming_id = NEW.incoming_id);
-    old_qty := OLD.quantity;
-    new_qty := NEW.quantity;
-    UPDATE stock_balances 
-    SET qty = qty - old_qty + new_qty, last_updated = now()
-    WHERE warehouse_id = w_id AND product_id = NEW.product_id;
-    RETURN NEW;
-    
+    -- Старые строки вычитаются, новые прибавляются (в т.ч. при смене товара)
+    SELECT array_agg(day), array_agg(warehouse_id), array_agg(product_id), array_agg(qty), array_agg(value)
+    INTO v_days, v_warehouses, v_products, v_qty, v_value
+    FROM (
+      SELECT inv.invoice_date AS day, inv.warehouse_id, x.product_id,
+             SUM(x.qty) AS qty, SUM(x.value) AS value
+      FROM (
+        SELECT incoming_id, product_id, quantity AS qty, line_total AS value FROM new_items
+        UNION ALL
+        SELECT incoming_id, product_id, -quantity, -line_total FROM old_items
+      ) x
+      JOIN incoming_invoices inv ON inv.incoming_id = x.incoming_id
+      GROUP BY inv.invoice_date, inv.warehouse_id, x.product_id
+    ) d;
+
   ELSIF TG_OP = 'DELETE' THEN
-    w_id := (SELECT warehouse_id FROM incoming_invoices WHERE incoming_id = OLD.incoming_id);
-    UPDATE stock_balances SET qty = qty - OLD.quantity, last_updated = now()
-    WHERE warehouse_id = w_id AND product_id = OLD.product_id;
-    RETURN OLD;
+    -- При удалении всей накладной позиции с ней уже не соединяются:
+    -- движение вычел триггер накладной
+    SELECT array_agg(day), array_agg(warehouse_id), array_agg(product_id), array_agg(qty), array_agg(value)
+    INTO v_days, v_warehouses, v_products, v_qty, v_value
+    FROM (
+      SELECT inv.invoice_date AS day, inv.warehouse_id, o.product_id,
+             -SUM(o.quantity) AS qty, -SUM(o.line_total) AS value
+      FROM old_items o
+      JOIN incoming_invoices inv ON inv.incoming_id = o.incoming_id
+      GROUP BY inv.invoice_date, inv.warehouse_id, o.product_id
+    ) d;
   END IF;
+  PERFORM record_stock_change('incoming', v_days, v_warehouses, v_products, v_qty, v_value);
+  RETURN NULL;
 END;
 $$ LANGUAGE plpgsql;
 
-CREATE TRIGGER trg_incoming_stock
-AFTER INSERT OR UPDATE OR DELETE ON incoming_items
-FOR EACH ROW EXECUTE FUNCTION adjust_stock_on_incoming();
+-- Таблицы переходов нельзя объявить у триггера на несколько событий,
+-- поэтому на каждое событие свой триггер
+CREATE TRIGGER trg_incoming_stock_insert
+AFTER INSERT ON incoming_items
+REFERENCING NEW TABLE AS new_items
+FOR EACH STATEMENT EXECUTE FUNCTION adjust_stock_on_incoming();
+
+CREATE TRIGGER trg_incoming_stock_update
+AFTER UPDATE ON incoming_items
+REFERENCING OLD TABLE AS old_items NEW TABLE AS new_items
+FOR EACH STATEMENT EXECUTE FUNCTION adjust_stock_on_incoming();
+
+CREATE TRIGGER trg_incoming_stock_delete
+AFTER DELETE ON incoming_items
+REFERENCING OLD TABLE AS old_items
+FOR EACH STATEMENT EXECUTE FUNCTION adjust_stock_on_incoming();
 
 
--- Триггер: корректировка остатков при расходе товара
+-- Триггер: корректировка остатков и движения при расходе товара (так же по оператору)
 CREATE OR REPLACE FUNCTION adjust_stock_on_outgoing()
 RETURNS trigger AS $$
 DECLARE
-  w_id INT;
-  old_qty NUMERIC(12,3);
-  new_qty NUMERIC(12,3);
+  v_days DATE[];
+  v_warehouses INTEGER[];
+  v_products INTEGER[];
+  v_qty NUMERIC[];
+  v_value NUMERIC[];
 BEGIN
   IF TG_OP = 'INSERT' THEN
-    w_id := (SELECT warehouse_id FROM outgoing_invoices WHERE outgoing_id = NEW.outgoing_id);
-    UPDATE stock_balances SET qty = qty - NEW.quantity, last_updated = now()
-      WHERE warehouse_id = w_id AND product_id = NEW.product_id;
-    RETURN NEW;
-    
+    SELECT array_agg(day), array_agg(warehouse_id), array_agg(product_id), array_agg(qty), array_agg(value)
+    INTO v_days, v_warehouses, v_products, v_qty, v_value
+    FROM (
+      SELECT inv.invoice_date AS day, inv.warehouse_id, n.product_id,
+             SUM(n.quantity) AS qty, SUM(n.line_total) AS value
+      FROM new_items n
+      JOIN outgoing_invoices inv ON inv.outgoing_id = n.outgoing_id
+      GROUP BY inv.invoice_date, inv.warehouse_id, n.product_id
+    ) d;
+
   ELSIF TG_OP = 'UPDATE' THEN
-    w_id := (SELECT warehouse_id FROM outgoing_invoices WHERE outgoing_id = NEW.outgoing_id);
-    old_qty := OLD.quantity;
-    new_qty := NEW.quantity;
-    UPDATE stock_balances 
-    SET qty = qty + old_qty - new_qty, last_updated = now()
-    WHERE warehouse_id = w_id AND product_id = NEW.product_id;
-    RETURN NEW;
-    
+    -- Старые строки вычитаются, новые прибавляются (в т.ч. при смене товара)
+    SELECT array_agg(day), array_agg(warehouse_id), array_agg(product_id), array_agg(qty), array_agg(value)
+    INTO v_days, v_warehouses, v_products, v_qty, v_value
+    FROM (
+      SELECT inv.invoice_date AS day, inv.warehouse_id, x.product_id,
+             SUM(x.qty) AS qty, SUM(x.value) AS value
+      FROM (
+        SELECT outgoing_id, product_id, quantity AS qty, line_total AS value FROM new_items
+        UNION ALL
+        SELECT outgoing_id, product_id, -quantity, -line_total FROM old_items
+      ) x
+      JOIN outgoing_invoices inv ON inv.outgoing_id = x.outgoing_id
+      GROUP BY inv.invoice_date, inv.warehouse_id, x.product_id
+    ) d;
+
   ELSIF TG_OP = 'DELETE' THEN
-    w_id := (SELECT warehouse_id FROM outgoing_invoices WHERE outgoing_id = OLD.outgoing_id);
-    UPDATE stock_balances SET qty = qty + OLD.quantity, last_updated = now()
-      WHERE warehouse_id = w_id AND product_id = OLD.product_id;
+    -- При удалении всей накладной позиции с ней уже не соединяются:
+    -- движение вычел триггер накладной
+    SELECT array_agg(day), array_agg(warehouse_id), array_agg(product_id), array_agg(qty), array_agg(value)
+    INTO v_days, v_warehouses, v_products, v_qty, v_value
+    FROM (
+      SELECT inv.invoice_date AS day, inv.warehouse_id, o.product_id,
+             -SUM(o.quantity) AS qty, -SUM(o.line_total) AS value
+      FROM old_items o
+      JOIN outgoing_invoices inv ON inv.outgoing_id = o.outgoing_id
+      GROUP BY inv.invoice_date, inv.warehouse_id, o.product_id
+    ) d;
+  END IF;
+  PERFORM record_stock_change('outgoing', v_days, v_warehouses, v_products, v_qty, v_value);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_outgoing_stock_insert
+AFTER INSERT ON outgoing_items
+REFERENCING NEW TABLE AS new_items
+FOR EACH STATEMENT EXECUTE FUNCTION adjust_stock_on_outgoing();
+
+CREATE TRIGGER trg_outgoing_stock_update
+AFTER UPDATE ON outgoing_items
+REFERENCING OLD TABLE AS old_items NEW TABLE AS new_items
+FOR EACH STATEMENT EXECUTE FUNCTION adjust_stock_on_outgoing();
+
+CREATE TRIGGER trg_outgoing_stock_delete
+AFTER DELETE ON outgoing_items
+REFERENCING OLD TABLE AS old_items
+FOR EACH STATEMENT EXECUTE FUNCTION adjust_stock_on_outgoing();
+
+
+-- Триггер: перенос движения при смене даты или склада накладной
+CREATE OR REPLACE FUNCTION move_movement_on_incoming_invoice()
+RETURNS trigger AS $$
+DECLARE
+  v_days DATE[];
+  v_warehouses INTEGER[];
+  v_products INTEGER[];
+  v_qty NUMERIC[];
+  v_value NUMERIC[];
+BEGIN
+  SELECT array_agg(day), array_agg(warehouse_id), array_agg(product_id), array_agg(qty), array_agg(value)
+  INTO v_days, v_warehouses, v_products, v_qty, v_value
+  FROM (
+    SELECT d.day, d.warehouse_id, d.product_id, SUM(d.qty) AS qty, SUM(d.value) AS value
+    FROM (
+      SELECT n.invoice_date AS day, n.warehouse_id, it.product_id,
+             it.quantity AS qty, it.line_total AS value
+      FROM new_invoices n
+      JOIN old_invoices o ON o.incoming_id = n.incoming_id
+      JOIN incoming_items it ON it.incoming_id = n.incoming_id
+      WHERE (n.invoice_date, n.warehouse_id) IS DISTINCT FROM (o.invoice_date, o.warehouse_id)
+      UNION ALL
+      SELECT o.invoice_date, o.warehouse_id, it.product_id, -it.quantity, -it.line_total
+      FROM new_invoices n
+      JOIN old_invoices o ON o.incoming_id = n.incoming_id
+      JOIN incoming_items it ON it.incoming_id = n.incoming_id
+      WHERE (n.invoice_date, n.warehouse_id) IS DISTINCT FROM (o.invoice_date, o.warehouse_id)
+    ) d
+    GROUP BY d.day, d.warehouse_id, d.product_id
+  ) m;
+  PERFORM record_movement('incoming', v_days, v_warehouses, v_products, v_qty, v_value);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_incoming_invoice_movement_update
+AFTER UPDATE ON incoming_invoices
+REFERENCING OLD TABLE AS old_invoices NEW TABLE AS new_invoices
+FOR EACH STATEMENT EXECUTE FUNCTION move_movement_on_incoming_invoice();
+
+
+-- Триггер: при удалении накладной вычитаем её позиции, пока они ещё есть
+-- (каскадное удаление позиций произойдёт, когда накладной уже не будет)
+CREATE OR REPLACE FUNCTION remove_movement_on_incoming_invoice()
+RETURNS trigger AS $$
+DECLARE
+  v_days DATE[];
+  v_warehouses INTEGER[];
+  v_products INTEGER[];
+  v_qty NUMERIC[];
+  v_value NUMERIC[];
+BEGIN
+  -- Перенос строки в другую секцию (см. partition_invoice_tables) —
+  -- это UPDATE, движение переносит его триггер
+  IF current_setting('stock.invoice_update', true) = 'on' THEN
+    RETURN OLD;
+  END IF;
+  SELECT array_agg(OLD.invoice_date), array_agg(OLD.warehouse_id), array_agg(product_id),
+         array_agg(-qty), array_agg(-value)
+  INTO v_days, v_warehouses, v_products, v_qty, v_value
+  FROM (
+    SELECT product_id, SUM(quantity) AS qty, SUM(line_total) AS value
+    FROM incoming_items
+    WHERE incoming_id = OLD.incoming_id
+    GROUP BY product_id
+  ) d;
+  PERFORM record_movement('incoming', v_days, v_warehouses, v_products, v_qty, v_value);
+  RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_incoming_invoice_movement_delete
+BEFORE DELETE ON incoming_invoices
+FOR EACH ROW EXECUTE FUNCTION remove_movement_on_incoming_invoice();
+
+
+-- Триггер: перенос движения при смене даты или склада накладной
+CREATE OR REPLACE FUNCTION move_movement_on_outgoing_invoice()
+RETURNS trigger AS $$
+DECLARE
+  v_days DATE[];
+  v_warehouses INTEGER[];
+  v_products INTEGER[];
+  v_qty NUMERIC[];
+  v_value NUMERIC[];
+BEGIN
+  SELECT array_agg(day), array_agg(warehouse_id), array_agg(product_id), array_agg(qty), array_agg(value)
+  INTO v_days, v_warehouses, v_products, v_qty, v_value
+  FROM (
+    SELECT d.day, d.warehouse_id, d.product_id, SUM(d.qty) AS qty, SUM(d.value) AS value
+    FROM (
+      SELECT n.invoice_date AS day, n.warehouse_id, it.product_id,
+             it.quantity AS qty, it.line_total AS value
+      FROM new_invoices n
+      JOIN old_invoices o ON o.outgoing_id = n.outgoing_id
+      JOIN outgoing_items it ON it.outgoing_id = n.outgoing_id
+      WHERE (n.invoice_date, n.warehouse_id) IS DISTINCT FROM (o.invoice_date, o.warehouse_id)
+      UNION ALL
+      SELECT o.invoice_date, o.warehouse_id, it.product_id, -it.quantity, -it.line_total
+      FROM new_invoices n
+      JOIN old_invoices o ON o.outgoing_id = n.outgoing_id
+      JOIN outgoing_items it ON it.outgoing_id = n.outgoing_id
+      WHERE (n.invoice_date, n.warehouse_id) IS DISTINCT FROM (o.invoice_date, o.warehouse_id)
+    ) d
+    GROUP BY d.day, d.warehouse_id, d.product_id
+  ) m;
+  PERFORM record_movement('outgoing', v_days, v_warehouses, v_products, v_qty, v_value);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_outgoing_invoice_movement_update
+AFTER UPDATE ON outgoing_invoices
+REFERENCING OLD TABLE AS old_invoices NEW TABLE AS new_invoices
+FOR EACH STATEMENT EXECUTE FUNCTION move_movement_on_outgoing_invoice();
+
+
+-- Триггер: при удалении накладной вычитаем её позиции, пока они ещё есть
+-- (каскадное удаление позиций произойдёт, когда накладной уже не будет)
+CREATE OR REPLACE FUNCTION remove_movement_on_outgoing_invoice()
+RETURNS trigger AS $$
+DECLARE
+  v_days DATE[];
+  v_warehouses INTEGER[];
+  v_products INTEGER[];
+  v_qty NUMERIC[];
+  v_value NUMERIC[];
+BEGIN
+  -- Перенос строки в другую секцию (см. partition_invoice_tables) —
+  -- это UPDATE, движение переносит его триггер
+  IF current_setting('stock.invoice_update', true) = 'on' THEN
     RETURN OLD;
   END IF;
+  SELECT array_agg(OLD.invoice_date), array_agg(OLD.warehouse_id), array_agg(product_id),
+         array_agg(-qty), array_agg(-value)
+  INTO v_days, v_warehouses, v_products, v_qty, v_value
+  FROM (
+    SELECT product_id, SUM(quantity) AS qty, SUM(line_total) AS value
+    FROM outgoing_items
+    WHERE outgoing_id = OLD.outgoing_id
+    GROUP BY product_id
+  ) d;
+  PERFORM record_movement('outgoing', v_days, v_warehouses, v_products, v_qty, v_value);
+  RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_outgoing_invoice_movement_delete
+BEFORE DELETE ON outgoing_invoices
+FOR EACH ROW EXECUTE FUNCTION remove_movement_on_outgoing_invoice();
+
+
+-- Полный пересчёт движения по дням из позиций накладных
+CREATE OR REPLACE FUNCTION rebuild_stock_movement_daily()
+RETURNS void AS $$
+BEGIN
+  -- Журнал переносится заранее, иначе его движение учлось бы дважды
+  PERFORM pg_advisory_xact_lock(hashtext('compact_stock_ledger'));
+  LOCK TABLE stock_ledger IN EXCLUSIVE MODE;
+  PERFORM compact_stock_ledger(NULL);
+  DELETE FROM stock_movement_daily;
+  INSERT INTO stock_movement_daily (day, warehouse_id, product_id, in_qty, out_qty, in_value, out_value)
+  SELECT day, warehouse_id, product_id,
+         SUM(in_qty), SUM(out_qty), SUM(in_value), SUM(out_value)
+  FROM (
+    SELECT inv.invoice_date AS day, inv.warehouse_id, it.product_id,
+           it.quantity AS in_qty, 0 AS out_qty, it.line_total AS in_value, 0 AS out_value
+    FROM incoming_items it
+    JOIN incoming_invoices inv ON inv.incoming_id = it.incoming_id
+    UNION ALL
+    SELECT inv.invoice_date, inv.warehouse_id, it.product_id,
+           0, it.quantity, 0, it.line_total
+    FROM outgoing_items it
+    JOIN outgoing_invoices inv ON inv.outgoing_id = it.outgoing_id
+  ) x
+  GROUP BY day, warehouse_id, product_id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Слот сводки для текущей транзакции (см. warehouse_stock_summary):
+-- первый свободный, начиная с pg_backend_pid() % 16. Слот закрепляется
+-- за транзакцией рекомендательной блокировкой до её конца, так что
+-- одновременные транзакции пишут в разные слоты, даже если их pid
+-- совпадают по модулю 16. Если заняты все слоты, берётся pid % 16
+-- без блокировки — тогда транзакции ждут друг друга на строке слота.
+CREATE OR REPLACE FUNCTION stock_summary_slot()
+RETURNS SMALLINT AS $$
+DECLARE
+  v_start INTEGER := pg_backend_pid() % 16;
+  v_slot INTEGER := NULLIF(current_setting('stock.summary_slot', true), '')::INTEGER;
+BEGIN
+  IF v_slot IS NOT NULL THEN
+    RETURN v_slot;
+  END IF;
+  v_slot := v_start;
+  FOR i IN 0..15 LOOP
+    IF pg_try_advisory_xact_lock(hashtext('stock_summary_slot'), (v_start + i) % 16) THEN
+      v_slot := (v_start + i) % 16;
+      EXIT;
+    END IF;
+  END LOOP;
+  PERFORM set_config('stock.summary_slot', v_slot::TEXT, true);
+  RETURN v_slot;
 END;
 $$ LANGUAGE plpgsql;
 
-CREATE TRIGGER trg_outgoing_stock
-AFTER INSERT OR UPDATE OR DELETE ON outgoing_items
-FOR EACH ROW EXECUTE FUNCTION adjust_stock_on_outgoing();
+-- Прибавить дельты к слоту сводки. Склады — по порядку warehouse_id,
+-- чтобы операторы по нескольким складам (импорт) не взаимоблокировались
+CREATE OR REPLACE FUNCTION add_stock_summary(p_warehouses INTEGER[], p_values NUMERIC[],
+                                             p_counts INTEGER[])
+RETURNS void AS $$
+DECLARE
+  v_slot SMALLINT := stock_summary_slot();
+BEGIN
+  INSERT INTO warehouse_stock_summary AS s (warehouse_id, slot, total_value, product_count)
+  SELECT d.warehouse_id, v_slot, SUM(d.value), SUM(d.cnt)
+  FROM unnest(p_warehouses, p_values, p_counts) AS d (warehouse_id, value, cnt)
+  JOIN warehouses w ON w.warehouse_id = d.warehouse_id
+  GROUP BY d.warehouse_id
+  ORDER BY d.warehouse_id
+  ON CONFLICT (warehouse_id, slot) DO UPDATE
+  SET total_value = s.total_value + EXCLUDED.total_value,
+      product_count = s.product_count + EXCLUDED.product_count;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Триггер: сводка по складам при изменении остатков
+-- Стоимость старых строк вычитается, новых прибавляется — в слот транзакции
+CREATE OR REPLACE FUNCTION update_stock_summary()
+RETURNS trigger AS $$
+DECLARE
+  v_warehouses INTEGER[];
+  v_values NUMERIC[];
+  v_counts INTEGER[];
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    SELECT array_agg(n.warehouse_id), array_agg(n.qty * COALESCE(p.price, 0)), array_agg(1)
+    INTO v_warehouses, v_values, v_counts
+    FROM new_rows n
+    LEFT JOIN products p ON p.product_id = n.product_id;
+
+  ELSIF TG_OP = 'UPDATE' THEN
+    SELECT array_agg(d.warehouse_id), array_agg(d.value), array_agg(d.cnt)
+    INTO v_warehouses, v_values, v_counts
+    FROM (
+      SELECT n.warehouse_id, n.qty * COALESCE(p.price, 0) AS value, 1 AS cnt
+      FROM new_rows n
+      LEFT JOIN products p ON p.product_id = n.product_id
+      UNION ALL
+      SELECT o.warehouse_id, -o.qty * COALESCE(p.price, 0), -1
+      FROM old_rows o
+      LEFT JOIN products p ON p.product_id = o.product_id
+    ) d;
+
+  ELSIF TG_OP = 'DELETE' THEN
+    -- Если удалён сам товар, его стоимость уже вычел trg_products_summary_delete
+    SELECT array_agg(o.warehouse_id), array_agg(-o.qty * COALESCE(p.price, 0)), array_agg(-1)
+    INTO v_warehouses, v_values, v_counts
+    FROM old_rows o
+    LEFT JOIN products p ON p.product_id = o.product_id;
+  END IF;
+
+  IF v_warehouses IS NOT NULL THEN
+    PERFORM add_stock_summary(v_warehouses, v_values, v_counts);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_stock_summary_insert
+AFTER INSERT ON stock_balances
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION update_stock_summary();
+
+CREATE TRIGGER trg_stock_summary_update
+AFTER UPDATE ON stock_balances
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION update_stock_summary();
+
+CREATE TRIGGER trg_stock_summary_delete
+AFTER DELETE ON stock_balances
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION update_stock_summary();
+
+
+-- Триггер: сводка по складам при изменении цены товара
+-- (у триггера с таблицами переходов нельзя указать UPDATE OF price,
+-- поэтому изменившиеся цены отбираются сравнением старой и новой строки)
+CREATE OR REPLACE FUNCTION update_summary_on_price()
+RETURNS trigger AS $$
+DECLARE
+  v_warehouses INTEGER[];
+  v_values NUMERIC[];
+  v_counts INTEGER[];
+BEGIN
+  SELECT array_agg(sb.warehouse_id), array_agg(sb.qty * (n.price - o.price)), array_agg(0)
+  INTO v_warehouses, v_values, v_counts
+  FROM new_products n
+  JOIN old_products o ON o.product_id = n.product_id
+  JOIN stock_balances sb ON sb.product_id = n.product_id
+  WHERE n.price <> o.price;
+
+  IF v_warehouses IS NOT NULL THEN
+    PERFORM add_stock_summary(v_warehouses, v_values, v_counts);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_products_summary_price
+AFTER UPDATE ON products
+REFERENCING OLD TABLE AS old_products NEW TABLE AS new_products
+FOR EACH STATEMENT EXECUTE FUNCTION update_summary_on_price();
+
+
+-- Триггер: при удалении товара вычитаем его стоимость, пока остатки ещё есть
+-- (каскадное удаление остатков произойдёт позже, когда цены уже не будет)
+CREATE OR REPLACE FUNCTION update_summary_on_product_delete()
+RETURNS trigger AS $$
+DECLARE
+  v_warehouses INTEGER[];
+  v_values NUMERIC[];
+  v_counts INTEGER[];
+BEGIN
+  SELECT array_agg(sb.warehouse_id), array_agg(-sb.qty * OLD.price), array_agg(0)
+  INTO v_warehouses, v_values, v_counts
+  FROM stock_balances sb
+  WHERE sb.product_id = OLD.product_id;
+
+  IF v_warehouses IS NOT NULL THEN
+    PERFORM add_stock_summary(v_warehouses, v_values, v_counts);
+  END IF;
+  RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_products_summary_delete
+BEFORE DELETE ON products
+FOR EACH ROW EXECUTE FUNCTION update_summary_on_product_delete();
+
+
+-- Полный пересчёт сводки (если данные правились в обход триггеров)
+CREATE OR REPLACE FUNCTION refresh_warehouse_stock_summary()
+RETURNS void AS $$
+BEGIN
+  DELETE FROM warehouse_stock_summary;
+  INSERT INTO warehouse_stock_summary (warehouse_id, slot, total_value, product_count)
+  SELECT sb.warehouse_id, 0, SUM(sb.qty * p.price), COUNT(*)
+  FROM stock_balances sb
+  JOIN products p ON p.product_id = sb.product_id
+  GROUP BY sb.warehouse_id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- ==================== ОСТАТКИ НА ДАТУ ====================
+-- Снимок на начало p_date: ближайший более поздний снимок (или текущие
+-- остатки) минус движение между p_date и ним. Проводки на время снимка
+-- блокируются, иначе строка, вставленная параллельно, не попала бы ни
+-- в снимок, ни в поправку триггером. Возвращает число строк снимка.
+CREATE OR REPLACE FUNCTION take_stock_snapshot(p_date DATE)
+RETURNS INTEGER AS $$
+DECLARE
+  v_next DATE;
+  n INTEGER;
+BEGIN
+  LOCK TABLE stock_movement_daily IN SHARE MODE;
+  DELETE FROM stock_snapshot_dates WHERE snapshot_date = p_date;
+  SELECT min(snapshot_date) INTO v_next FROM stock_snapshot_dates WHERE snapshot_date > p_date;
+  INSERT INTO stock_snapshot_dates (snapshot_date) VALUES (p_date);
+
+  IF v_next IS NOT NULL THEN
+    INSERT INTO stock_snapshots (snapshot_date, warehouse_id, product_id, qty)
+    SELECT p_date, x.warehouse_id, x.product_id, SUM(x.qty)
+    FROM (
+      SELECT s.warehouse_id, s.product_id, s.qty
+      FROM stock_snapshots s
+      WHERE s.snapshot_date = v_next
+      UNION ALL
+      SELECT m.warehouse_id, m.product_id, m.out_qty - m.in_qty
+      FROM stock_movement_daily m
+      WHERE m.day >= p_date AND m.day < v_next
+    ) x
+    GROUP BY x.warehouse_id, x.product_id
+    HAVING SUM(x.qty) <> 0;
+  ELSE
+    INSERT INTO stock_snapshots (snapshot_date, warehouse_id, product_id, qty)
+    SELECT p_date, x.warehouse_id, x.product_id, SUM(x.qty)
+    FROM (
+      SELECT sb.warehouse_id, sb.product_id, sb.qty
+      FROM stock_balances sb
+      UNION ALL
+      SELECT m.warehouse_id, m.product_id, m.out_qty - m.in_qty
+      FROM stock_movement_daily m
+      WHERE m.day >= p_date
+    ) x
+    GROUP BY x.warehouse_id, x.product_id
+    HAVING SUM(x.qty) <> 0;
+  END IF;
+  GET DIAGNOSTICS n = ROW_COUNT;
+  RETURN n;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Недостающие снимки на начало каждого месяца с первого движения по текущий.
+-- От новых к старым: каждый снимок строится из следующего и одного месяца
+-- движения. Если снимок текущего месяца уже есть — ничего не делает.
+-- Возвращает число созданных снимков.
+CREATE OR REPLACE FUNCTION take_monthly_snapshots()
+RETURNS INTEGER AS $$
+DECLARE
+  v_first DATE;
+  v_month DATE := date_trunc('month', CURRENT_DATE)::date;
+  n INTEGER := 0;
+BEGIN
+  IF EXISTS (SELECT 1 FROM stock_snapshot_dates WHERE snapshot_date = v_month) THEN
+    RETURN 0;
+  END IF;
+  SELECT date_trunc('month', min(day))::date INTO v_first FROM stock_movement_daily;
+  WHILE v_month >= COALESCE(v_first, v_month) LOOP
+    IF NOT EXISTS (SELECT 1 FROM stock_snapshot_dates WHERE snapshot_date = v_month) THEN
+      PERFORM take_stock_snapshot(v_month);
+      n := n + 1;
+    END IF;
+    v_month := (v_month - INTERVAL '1 month')::date;
+  END LOOP;
+  RETURN n;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Триггер: проводка задним числом (день раньше снимка) меняет все более
+-- поздние снимки. Обычная проводка текущим днём позже всех снимков
+-- и не находит ни одного. Все пути изменения движения (позиции, смена даты
+-- или склада накладной, удаление) проходят через stock_movement_daily.
+CREATE OR REPLACE FUNCTION adjust_snapshots_on_movement()
+RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    INSERT INTO stock_snapshots AS s (snapshot_date, warehouse_id, product_id, qty)
+    SELECT sd.snapshot_date, n.warehouse_id, n.product_id, SUM(n.in_qty - n.out_qty)
+    FROM new_rows n
+    JOIN stock_snapshot_dates sd ON sd.snapshot_date > n.day
+    GROUP BY sd.snapshot_date, n.warehouse_id, n.product_id
+    HAVING SUM(n.in_qty - n.out_qty) <> 0
+    ON CONFLICT (snapshot_date, warehouse_id, product_id) DO UPDATE
+    SET qty = s.qty + EXCLUDED.qty;
+
+  ELSIF TG_OP = 'UPDATE' THEN
+    INSERT INTO stock_snapshots AS s (snapshot_date, warehouse_id, product_id, qty)
+    SELECT sd.snapshot_date, d.warehouse_id, d.product_id, SUM(d.qty)
+    FROM (
+      SELECT day, warehouse_id, product_id, in_qty - out_qty AS qty FROM new_rows
+      UNION ALL
+      SELECT day, warehouse_id, product_id, out_qty - in_qty FROM old_rows
+    ) d
+    JOIN stock_snapshot_dates sd ON sd.snapshot_date > d.day
+    GROUP BY sd.snapshot_date, d.warehouse_id, d.product_id
+    HAVING SUM(d.qty) <> 0
+    ON CONFLICT (snapshot_date, warehouse_id, product_id) DO UPDATE
+    SET qty = s.qty + EXCLUDED.qty;
+
+  ELSIF TG_OP = 'DELETE' THEN
+    UPDATE stock_snapshots s
+    SET qty = s.qty - d.qty
+    FROM (
+      SELECT sd.snapshot_date, o.warehouse_id, o.product_id, SUM(o.in_qty - o.out_qty) AS qty
+      FROM old_rows o
+      JOIN stock_snapshot_dates sd ON sd.snapshot_date > o.day
+      GROUP BY sd.snapshot_date, o.warehouse_id, o.product_id
+    ) d
+    WHERE s.snapshot_date = d.snapshot_date
+      AND s.warehouse_id = d.warehouse_id AND s.product_id = d.product_id;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_movement_snapshots_insert
+AFTER INSERT ON stock_movement_daily
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION adjust_snapshots_on_movement();
+
+CREATE TRIGGER trg_movement_snapshots_update
+AFTER UPDATE ON stock_movement_daily
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION adjust_snapshots_on_movement();
+
+CREATE TRIGGER trg_movement_snapshots_delete
+AFTER DELETE ON stock_movement_daily
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION adjust_snapshots_on_movement();
+
+-- Остатки на конец дня p_date: ближайший к дате снимок плюс движение после
+-- него до даты (или минус движение от даты до снимка, если ближе более
+-- поздний). При месячных снимках читается один снимок и не больше
+-- полумесяца движения, сколько бы ни было истории. Без снимков —
+-- текущие остатки минус движение после даты. Строки журнала остатков
+-- (режим журнала) учитываются после переноса compact_stock_ledger().
+CREATE OR REPLACE FUNCTION stock_as_of(p_date DATE, p_warehouse_id INTEGER DEFAULT NULL)
+RETURNS TABLE (warehouse_id INTEGER, product_id INTEGER, qty NUMERIC) AS $$
+#variable_conflict use_column
+DECLARE
+  v_day DATE := p_date + 1;     -- снимок хранит остатки на начало дня
+  v_before DATE;
+  v_after DATE;
+BEGIN
+  SELECT max(snapshot_date) INTO v_before FROM stock_snapshot_dates WHERE snapshot_date <= v_day;
+  SELECT min(snapshot_date) INTO v_after FROM stock_snapshot_dates WHERE snapshot_date > v_day;
+
+  IF v_before IS NOT NULL AND (v_after IS NULL OR v_day - v_before <= v_after - v_day) THEN
+    RETURN QUERY
+    SELECT x.warehouse_id, x.product_id, SUM(x.qty)
+    FROM (
+      SELECT s.warehouse_id, s.product_id, s.qty
+      FROM stock_snapshots s
+      WHERE s.snapshot_date = v_before
+        AND (p_warehouse_id IS NULL OR s.warehouse_id = p_warehouse_id)
+      UNION ALL
+      SELECT m.warehouse_id, m.product_id, m.in_qty - m.out_qty
+      FROM stock_movement_daily m
+      WHERE m.day >= v_before AND m.day < v_day
+        AND (p_warehouse_id IS NULL OR m.warehouse_id = p_warehouse_id)
+    ) x
+    GROUP BY x.warehouse_id, x.product_id
+    HAVING SUM(x.qty) <> 0;
+
+  ELSIF v_after IS NOT NULL THEN
+    RETURN QUERY
+    SELECT x.warehouse_id, x.product_id, SUM(x.qty)
+    FROM (
+      SELECT s.warehouse_id, s.product_id, s.qty
+      FROM stock_snapshots s
+      WHERE s.snapshot_date = v_after
+        AND (p_warehouse_id IS NULL OR s.warehouse_id = p_warehouse_id)
+      UNION ALL
+      SELECT m.warehouse_id, m.product_id, m.out_qty - m.in_qty
+      FROM stock_movement_daily m
+      WHERE m.day >= v_day AND m.day < v_after
+        AND (p_warehouse_id IS NULL OR m.warehouse_id = p_warehouse_id)
+    ) x
+    GROUP BY x.warehouse_id, x.product_id
+    HAVING SUM(x.qty) <> 0;
+
+  ELSE
+    RETURN QUERY
+    SELECT x.warehouse_id, x.product_id, SUM(x.qty)
+    FROM (
+      SELECT sb.warehouse_id, sb.product_id, sb.qty
+      FROM stock_balances sb
+      WHERE p_warehouse_id IS NULL OR sb.warehouse_id = p_warehouse_id
+      UNION ALL
+      SELECT m.warehouse_id, m.product_id, m.out_qty - m.in_qty
+      FROM stock_movement_daily m
+      WHERE m.day >= v_day
+        AND (p_warehouse_id IS NULL OR m.warehouse_id = p_warehouse_id)
+    ) x
+    GROUP BY x.warehouse_id, x.product_id
+    HAVING SUM(x.qty) <> 0;
+  END IF;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+-- ==================== УВЕДОМЛЕНИЯ ОБ ИЗМЕНЕНИЯХ ====================
+-- Клиент держит справочники (склады, товары, должности) в памяти и слушает
+-- канал ref_changes. На каждую изменённую строку приходит
+-- {"table", "op", "row"}; если строк в операторе больше TG_ARGV[0] —
+-- одно {"table", "op": "RELOAD"}, и клиент перечитывает таблицу целиком.
+CREATE OR REPLACE FUNCTION notify_ref_change()
+RETURNS trigger AS $$
+DECLARE
+    n INTEGER;
+    r JSONB;
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    SELECT count(*) INTO n FROM old_rows;
+  ELSE
+    SELECT count(*) INTO n FROM new_rows;
+  END IF;
+
+  IF n > TG_ARGV[0]::INTEGER THEN
+    PERFORM pg_notify('ref_changes',
+        jsonb_build_object('table', TG_TABLE_NAME, 'op', 'RELOAD')::text);
+  ELSIF TG_OP = 'DELETE' THEN
+    FOR r IN SELECT to_jsonb(o) FROM old_rows o LOOP
+      PERFORM pg_notify('ref_changes',
+          jsonb_build_object('table', TG_TABLE_NAME, 'op', TG_OP, 'row', r)::text);
+    END LOOP;
+  ELSE
+    FOR r IN SELECT to_jsonb(x) FROM new_rows x LOOP
+      PERFORM pg_notify('ref_changes',
+          jsonb_build_object('table', TG_TABLE_NAME, 'op', TG_OP, 'row', r)::text);
+    END LOOP;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_warehouses_notify_insert
+AFTER INSERT ON warehouses
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_ref_change(100);
+
+CREATE TRIGGER trg_warehouses_notify_update
+AFTER UPDATE ON warehouses
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_ref_change(100);
+
+CREATE TRIGGER trg_warehouses_notify_delete
+AFTER DELETE ON warehouses
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_ref_change(100);
+
+CREATE TRIGGER trg_positions_notify_insert
+AFTER INSERT ON positions
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_ref_change(100);
+
+CREATE TRIGGER trg_positions_notify_update
+AFTER UPDATE ON positions
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_ref_change(100);
+
+CREATE TRIGGER trg_positions_notify_delete
+AFTER DELETE ON positions
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_ref_change(100);
+
+CREATE TRIGGER trg_products_notify_insert
+AFTER INSERT ON products
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_ref_change(100);
+
+CREATE TRIGGER trg_products_notify_update
+AFTER UPDATE ON products
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_ref_change(100);
+
+CREATE TRIGGER trg_products_notify_delete
+AFTER DELETE ON products
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_ref_change(100);
+
+-- Накладные и позиции: канал invoice_changes, по уведомлению на строку
+-- {"table", "op", "id", "invoice_id"} (TG_ARGV: колонка ключа, колонка
+-- накладной, предел строк). Открытые окна обновляют только эти строки.
+-- Пересчёт total_amount сам вызывает UPDATE накладной и её уведомление.
+CREATE OR REPLACE FUNCTION notify_invoice_change()
+RETURNS trigger AS $$
+DECLARE
+    n INTEGER;
+    r JSONB;
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    SELECT count(*) INTO n FROM old_rows;
+  ELSE
+    SELECT count(*) INTO n FROM new_rows;
+  END IF;
+
+  IF n > TG_ARGV[2]::INTEGER THEN
+    PERFORM pg_notify('invoice_changes',
+        jsonb_build_object('table', TG_TABLE_NAME, 'op', 'RELOAD')::text);
+    RETURN NULL;
+  END IF;
+
+  -- Таблица переходов есть только своя: у DELETE — old_rows, иначе new_rows
+  IF TG_OP = 'DELETE' THEN
+    FOR r IN SELECT to_jsonb(o) FROM old_rows o LOOP
+      PERFORM pg_notify('invoice_changes',
+          jsonb_build_object('table', TG_TABLE_NAME, 'op', TG_OP,
+                             'id', r -> TG_ARGV[0], 'invoice_id', r -> TG_ARGV[1])::text);
+    END LOOP;
+  ELSE
+    FOR r IN SELECT to_jsonb(x) FROM new_rows x LOOP
+      PERFORM pg_notify('invoice_changes',
+          jsonb_build_object('table', TG_TABLE_NAME, 'op', TG_OP,
+                             'id', r -> TG_ARGV[0], 'invoice_id', r -> TG_ARGV[1])::text);
+    END LOOP;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_incoming_invoices_notify_insert
+AFTER INSERT ON incoming_invoices
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_invoice_change('incoming_id', 'incoming_id', 500);
+
+CREATE TRIGGER trg_incoming_invoices_notify_update
+AFTER UPDATE ON incoming_invoices
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_invoice_change('incoming_id', 'incoming_id', 500);
+
+CREATE TRIGGER trg_incoming_invoices_notify_delete
+AFTER DELETE ON incoming_invoices
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_invoice_change('incoming_id', 'incoming_id', 500);
+
+CREATE TRIGGER trg_incoming_items_notify_insert
+AFTER INSERT ON incoming_items
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_invoice_change('incoming_item_id', 'incoming_id', 500);
+
+CREATE TRIGGER trg_incoming_items_notify_update
+AFTER UPDATE ON incoming_items
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_invoice_change('incoming_item_id', 'incoming_id', 500);
+
+CREATE TRIGGER trg_incoming_items_notify_delete
+AFTER DELETE ON incoming_items
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_invoice_change('incoming_item_id', 'incoming_id', 500);
+
+CREATE TRIGGER trg_outgoing_invoices_notify_insert
+AFTER INSERT ON outgoing_invoices
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_invoice_change('outgoing_id', 'outgoing_id', 500);
+
+CREATE TRIGGER trg_outgoing_invoices_notify_update
+AFTER UPDATE ON outgoing_invoices
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_invoice_change('outgoing_id', 'outgoing_id', 500);
+
+CREATE TRIGGER trg_outgoing_invoices_notify_delete
+AFTER DELETE ON outgoing_invoices
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_invoice_change('outgoing_id', 'outgoing_id', 500);
+
+CREATE TRIGGER trg_outgoing_items_notify_insert
+AFTER INSERT ON outgoing_items
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_invoice_change('outgoing_item_id', 'outgoing_id', 500);
+
+CREATE TRIGGER trg_outgoing_items_notify_update
+AFTER UPDATE ON outgoing_items
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_invoice_change('outgoing_item_id', 'outgoing_id', 500);
+
+CREATE TRIGGER trg_outgoing_items_notify_delete
+AFTER DELETE ON outgoing_items
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_invoice_change('outgoing_item_id', 'outgoing_id', 500);
+
+-- ==================== СЕКЦИОНИРОВАНИЕ (вариант схемы) ====================
+-- Для больших баз накладные и позиции можно перевести на помесячные
+-- секции по дате накладной (нужен PostgreSQL 15+: в 13 и 14 смена invoice_date
+-- с переносом накладной в секцию другого месяца выполняется как DELETE + INSERT,
+-- и ON DELETE CASCADE молча удаляет её позиции):
+--
+--   CALL partition_invoice_tables();                 -- один раз, переносит данные
+--   SELECT * FROM manage_invoice_partitions(3, 36);  -- периодически (например, из cron)
+--
+-- Запросы с условием на invoice_date (в т.ч. по позициям) читают только
+-- нужные секции. Триггеры переносятся на новые таблицы как есть.
+-- Уникальность (warehouse_id, invoice_number) не может быть индексом
+-- секционированной таблицы (в нём нет даты), поэтому её держит
+-- таблица invoice_numbers. Позиции в секционированной схеме нужно
+-- вставлять с указанной invoice_date: триггер не может перенести строку
+-- в другую секцию.
+
+-- Секция одного месяца; ничего не делает, если она уже есть
+CREATE OR REPLACE FUNCTION create_month_partition(p_parent TEXT, p_month DATE)
+RETURNS TEXT AS $$
+DECLARE
+  month_start DATE := date_trunc('month', p_month)::date;
+  part TEXT := p_parent || '_' || to_char(month_start, 'YYYY_MM');
+BEGIN
+  IF to_regclass(part) IS NULL THEN
+    EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                   part, p_parent, month_start, (month_start + INTERVAL '1 month')::date);
+    RETURN part;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Реестр номеров накладных вместо UNIQUE (warehouse_id, invoice_number)
+CREATE OR REPLACE FUNCTION register_invoice_number()
+RETURNS trigger AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    DELETE FROM invoice_numbers
+    WHERE kind = TG_ARGV[0] AND warehouse_id = OLD.warehouse_id
+      AND invoice_number = OLD.invoice_number;
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    BEGIN
+      INSERT INTO invoice_numbers (kind, warehouse_id, invoice_number)
+      VALUES (TG_ARGV[0], NEW.warehouse_id, NEW.invoice_number);
+    EXCEPTION WHEN unique_violation THEN
+      RAISE EXCEPTION 'Накладная % уже есть на складе %', NEW.invoice_number, NEW.warehouse_id
+        USING ERRCODE = 'unique_violation';
+    END;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Отметка «идёт UPDATE накладных» на время оператора: при смене даты
+-- строка секционированной таблицы удаляется из старой секции, и
+-- срабатывают триггеры удаления
+CREATE OR REPLACE FUNCTION mark_invoice_update()
+RETURNS trigger AS $$
+BEGIN
+  PERFORM set_config('stock.invoice_update', CASE TG_WHEN WHEN 'BEFORE' THEN 'on' ELSE '' END, true);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Перевод накладных и позиций на помесячные секции
+CREATE OR REPLACE PROCEDURE partition_invoice_tables(p_months_ahead INTEGER DEFAULT 3)
+LANGUAGE plpgsql AS $$
+DECLARE
+  k TEXT;
+  inv TEXT;
+  items TEXT;
+  id_col TEXT;
+  item_id_col TEXT;
+  cp TEXT;
+  m DATE;
+  last_month DATE;
+  t TEXT;
+  trg RECORD;
+BEGIN
+  IF current_setting('server_version_num')::INTEGER < 150000 THEN
+    RAISE EXCEPTION 'Секционирование накладных требует PostgreSQL 15+, сервер: %',
+      current_setting('server_version')
+      USING ERRCODE = 'feature_not_supported';
+  END IF;
+
+  CREATE TABLE IF NOT EXISTS invoice_numbers (
+      kind TEXT NOT NULL,
+      warehouse_id INTEGER NOT NULL,
+      invoice_number TEXT NOT NULL,
+      PRIMARY KEY (kind, warehouse_id, invoice_number)
+  );
+
+  FOREACH k IN ARRAY ARRAY['incoming', 'outgoing'] LOOP
+    inv := k || '_invoices';
+    items := k || '_items';
+    id_col := k || '_id';
+    item_id_col := k || '_item_id';
+    cp := CASE k WHEN 'incoming' THEN 'supplier' ELSE 'customer' END;
+
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(inv)) THEN
+      RAISE NOTICE 'Таблица % уже секционирована', inv;
+      CONTINUE;
+    END IF;
+
+    -- Старые таблицы остаются до конца переноса
+    EXECUTE format('ALTER TABLE %I RENAME TO %I', items, items || '_old');
+    EXECUTE format('ALTER TABLE %I RENAME TO %I', inv, inv || '_old');
+
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+                    PARTITION BY RANGE (invoice_date)', inv, inv || '_old');
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED)
+                    PARTITION BY RANGE (invoice_date)', items, items || '_old');
+
+    -- Секции: от первого месяца с данными до p_months_ahead месяцев вперёд
+    EXECUTE format('SELECT date_trunc(''month'', COALESCE(MIN(invoice_date), CURRENT_DATE))::date FROM %I',
+                   inv || '_old') INTO m;
+    last_month := (date_trunc('month', CURRENT_DATE) + make_interval(months => p_months_ahead))::date;
+    WHILE m <= last_month LOOP
+      PERFORM create_month_partition(inv, m);
+      PERFORM create_month_partition(items, m);
+      m := (m + INTERVAL '1 month')::date;
+    END LOOP;
+    FOREACH t IN ARRAY ARRAY[inv, items] LOOP
+      EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', t || '_default', t);
+    END LOOP;
+
+    -- Перенос данных (до создания триггеров, чтобы остатки не изменились)
+    EXECUTE format('INSERT INTO %I (%I, warehouse_id, %I, invoice_number, invoice_date, total_amount)
+                    SELECT %I, warehouse_id, %I, invoice_number, invoice_date, total_amount FROM %I',
+                   inv, id_col, cp, id_col, cp, inv || '_old');
+    EXECUTE format('INSERT INTO %I (%I, %I, product_id, quantity, unit_price, invoice_date)
+                    SELECT %I, %I, product_id, quantity, unit_price, invoice_date FROM %I',
+                   items, item_id_col, id_col, item_id_col, id_col, items || '_old');
+    EXECUTE format('INSERT INTO invoice_numbers (kind, warehouse_id, invoice_number)
+                    SELECT %L, warehouse_id, invoice_number FROM %I', k, inv);
+
+    -- Пользовательские триггеры переносятся со старых таблиц
+    FOREACH t IN ARRAY ARRAY[inv, items] LOOP
+      FOR trg IN
+        SELECT pg_get_triggerdef(oid) AS def
+        FROM pg_trigger
+        WHERE tgrelid = to_regclass(t || '_old') AND NOT tgisinternal
+      LOOP
+        EXECUTE regexp_replace(trg.def, ' ON (\S+\.)?' || t || '_old ', ' ON ' || t || ' ');
+      END LOOP;
+    END LOOP;
+    EXECUTE format('CREATE TRIGGER trg_%s_invoice_number
+                    AFTER INSERT OR DELETE OR UPDATE OF warehouse_id, invoice_number ON %I
+                    FOR EACH ROW EXECUTE FUNCTION register_invoice_number(%L)', k, inv, k);
+    EXECUTE format('CREATE TRIGGER trg_%s_invoice_update_begin BEFORE UPDATE ON %I
+                    FOR EACH STATEMENT EXECUTE FUNCTION mark_invoice_update()', k, inv);
+    EXECUTE format('CREATE TRIGGER trg_%s_invoice_update_end AFTER UPDATE ON %I
+                    FOR EACH STATEMENT EXECUTE FUNCTION mark_invoice_update()', k, inv);
+
+    -- Последовательности SERIAL переходят к новым таблицам
+    EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.%I',
+                   pg_get_serial_sequence(inv || '_old', id_col), inv, id_col);
+    EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.%I',
+                   pg_get_serial_sequence(items || '_old', item_id_col), items, item_id_col);
+
+    EXECUTE format('DROP TABLE %I', items || '_old');
+    EXECUTE format('DROP TABLE %I', inv || '_old');
+
+    -- Ключи секционированной таблицы обязаны включать дату
+    EXECUTE format('ALTER TABLE %I ADD PRIMARY KEY (%I, invoice_date)', inv, id_col);
+    EXECUTE format('ALTER TABLE %I ADD FOREIGN KEY (warehouse_id) REFERENCES warehouses(warehouse_id)', inv);
+    EXECUTE format('CREATE INDEX ON %I (invoice_date)', inv);
+    EXECUTE format('CREATE INDEX ON %I (warehouse_id, invoice_number)', inv);
+    EXECUTE format('CREATE INDEX ON %I USING gin (%I gin_trgm_ops)', inv, cp);
+    EXECUTE format('CREATE INDEX ON %I USING gin (invoice_number gin_trgm_ops)', inv);
+
+    EXECUTE format('ALTER TABLE %I ADD PRIMARY KEY (%I, invoice_date)', items, item_id_col);
+    EXECUTE format('ALTER TABLE %I ADD FOREIGN KEY (%I, invoice_date) REFERENCES %I (%I, invoice_date)
+                    ON UPDATE CASCADE ON DELETE CASCADE', items, id_col, inv, id_col);
+    EXECUTE format('ALTER TABLE %I ADD FOREIGN KEY (product_id) REFERENCES products(product_id)', items);
+    EXECUTE format('CREATE INDEX ON %I (%I)', items, id_col);
+    EXECUTE format('CREATE INDEX ON %I (%I)', items, item_id_col);
+  END LOOP;
+END;
+$$;
+
+
+-- Обслуживание секций: создать секции на p_months_ahead месяцев вперёд
+-- и отсоединить (в архив) секции старше p_keep_months месяцев.
+-- Отсоединённые таблицы остаются в базе, их можно выгрузить или удалить.
+CREATE OR REPLACE FUNCTION manage_invoice_partitions(p_months_ahead INTEGER DEFAULT 3,
+                                                     p_keep_months INTEGER DEFAULT NULL)
+RETURNS TABLE (action TEXT, partition_name TEXT) AS $$
+DECLARE
+  parent TEXT;
+  part RECORD;
+  created TEXT;
+  cutoff DATE;
+BEGIN
+  -- Позиции раньше накладных: секцию накладных нельзя отсоединить,
+  -- пока на неё ссылаются позиции
+  FOREACH parent IN ARRAY ARRAY['incoming_items', 'incoming_invoices',
+                                'outgoing_items', 'outgoing_invoices'] LOOP
+    IF NOT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(parent)) THEN
+      CONTINUE;
+    END IF;
+
+    FOR i IN 0..p_months_ahead LOOP
+      created := create_month_partition(parent,
+                   (date_trunc('month', CURRENT_DATE) + make_interval(months => i))::date);
+      IF created IS NOT NULL THEN
+        action := 'создана';
+        partition_name := created;
+        RETURN NEXT;
+      END IF;
+    END LOOP;
+
+    IF p_keep_months IS NOT NULL THEN
+      cutoff := (date_trunc('month', CURRENT_DATE) - make_interval(months => p_keep_months))::date;
+      FOR part IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(parent)
+          AND c.relname ~ ('^' || parent || '_\d{4}_\d{2}$')
+          AND to_date(right(c.relname, 7), 'YYYY_MM') < cutoff
+        ORDER BY c.relname
+      LOOP
+        EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', parent, part.relname);
+        action := 'отсоединена';
+        partition_name := part.relname;
+        RETURN NEXT;
+      END LOOP;
+    END IF;
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
 
 -- ==================== ТЕСТОВЫЕ ДАННЫЕ ====================
 
@@ -337,6 +1870,10 @@ INSERT INTO outgoing_items (outgoing_id, product_id, quantity, unit_price) VALUE
 (4, 2, 3, 4500.00),
 (4, 4, 5, 3200.00);
 
+-- Снимки остатков на начало месяцев (отчёт «Остатки на дату»);
+-- дальше их создаёт приложение при запуске или python -m cli snapshots
+SELECT take_monthly_snapshots();
+
 -- Проверка представлений
 SELECT * FROM vw_products_info;
 SELECT * FROM vw_current_stock;
@@ -0,0 +1,325 @@
+"""Отчёты без интерфейса: SQL, колонки и типизированные параметры, выгрузка
+в CSV/XLSX. Общие для окна отчётов (app.py) и командной строки (cli.py),
+поэтому здесь нет tkinter."""
+import csv
+import io
+import os
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+
+
+def parse_date(value):
+    for fmt in ("%Y-%m-%d", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError(f"неверная дата: {value!r}")
+
+
+def parse_decimal(value, name):
+    try:
+        return Decimal(value.replace(" ", "").replace(",", "."))
+    except InvalidOperation:
+        raise ValueError(f"неверное значение поля «{name}»: {value!r}")
+
+
+# Параметры отчётов
+class Param:
+    """Параметр отчёта: тип (date, int или str) и значение по умолчанию —
+    готовое или функция, которая его вычисляет. None — фильтр не задан."""
+
+    def __init__(self, name, kind, default=None, label=""):
+        self.name = name
+        self.kind = kind
+        self.default = default
+        self.label = label
+
+    def parse(self, value):
+        """Значение из строки (поле окна, аргумент командной строки) или готовое"""
+        if value is None or value == "":
+            return self.default() if callable(self.default) else self.default
+        if not isinstance(value, str):
+            return value
+        if self.kind is date:
+            return parse_date(value.strip())
+        if self.kind is int:
+            try:
+                return int(value)
+            except ValueError:
+                raise ValueError(f"неверное значение «{self.label or self.name}»: {value!r}")
+        return value.strip()
+
+
+class Report:
+    """Отчёт: колонки, параметры и построение запроса build(**значения) ->
+    (запрос, параметры). key_len — сколько первых колонок задают строку,
+    timeout — лимит statement_timeout по умолчанию, секунды."""
+
+    def __init__(self, title, columns, params, build, key_len=1, timeout=30):
+        self.title = title
+        self.columns = columns
+        self.params = params
+        self.build = build
+        self.key_len = key_len
+        self.timeout = timeout
+
+    def query(self, **values):
+        """(запрос, параметры) по значениям параметров; ValueError — неверный ввод"""
+        unknown = set(values) - {p.name for p in self.params}
+        if unknown:
+            raise ValueError(f"неизвестные параметры: {', '.join(sorted(unknown))}")
+        return self.build(**{p.name: p.parse(values.get(p.name)) for p in self.params})
+
+
+def start_of_year():
+    return date.today().replace(month=1, day=1)
+
+
+#  ОТЧЁТ 1 — Остатки на складе (vw_current_stock)
+def stock_query(warehouse_id):
+    query = """
+        SELECT warehouse_name, sku, product_name, unit, qty, price, stock_value, last_updated
+        FROM vw_current_stock
+    """
+    params = []
+    if warehouse_id is not None:
+        query += " WHERE warehouse_name = (SELECT name FROM warehouses WHERE warehouse_id = %s)"
+        params.append(warehouse_id)
+    query += " ORDER BY warehouse_name, product_name"
+    return query, params
+
+
+def stock_summary_query(warehouse_id):
+    """Итог по складам из warehouse_stock_summary — сумма слотов складов"""
+    query = """
+        SELECT COALESCE(SUM(product_count), 0), COALESCE(SUM(total_value), 0)
+        FROM warehouse_stock_summary
+    """
+    params = []
+    if warehouse_id is not None:
+        query += " WHERE warehouse_id = %s"
+        params.append(warehouse_id)
+    return query, params
+
+
+#  ОТЧЁТ 2 — Прибыль от реализации (outgoing_items + products)
+def profit_query(date_from, date_to):
+    query = """
+        SELECT
+            p.name AS product,
+            SUM(oi.quantity) AS qty_sold,
+            AVG(oi.unit_price) AS avg_sell_price,
+            AVG(p.price) AS avg_buy_price,
+            SUM(oi.line_total - oi.quantity * p.price) AS profit
+        FROM outgoing_items oi
+        JOIN outgoing_invoices inv
+          ON inv.outgoing_id = oi.outgoing_id AND inv.invoice_date = oi.invoice_date
+        JOIN products p ON p.product_id = oi.product_id
+        WHERE inv.invoice_date BETWEEN %s AND %s
+          AND oi.invoice_date BETWEEN %s AND %s
+        GROUP BY p.name
+        ORDER BY profit DESC
+    """
+    return query, [date_from, date_to, date_from, date_to]
+
+
+#  ОТЧЁТ 3 — Движение товара (приход + расход)
+def movement_query(date_from, date_to, warehouse_id, sku):
+    # Период и склад — в условии соединения, чтобы товары без движения
+    # тоже попали в отчёт
+    join_cond = "m.product_id = p.product_id AND m.day BETWEEN %s AND %s"
+    params = [date_from, date_to]
+    where = ""
+
+    if warehouse_id is not None:
+        join_cond += " AND m.warehouse_id = %s"
+        params.append(warehouse_id)
+
+    if sku is not None:
+        where = "WHERE p.sku = %s"
+        params.append(sku)
+
+    # Приход + Расход из движения по дням (stock_movement_daily)
+    query = f"""
+    SELECT
+        p.sku,
+        p.name,
+        COALESCE(SUM(m.in_qty), 0) AS incoming_qty,
+        COALESCE(SUM(m.out_qty), 0) AS outgoing_qty,
+        COALESCE(SUM(m.in_qty), 0) - COALESCE(SUM(m.out_qty), 0) AS balance_change,
+        COALESCE(SUM(m.in_value), 0) AS incoming_value,
+        COALESCE(SUM(m.out_value), 0) AS outgoing_value
+    FROM products p
+    LEFT JOIN stock_movement_daily m ON {join_cond}
+    {where}
+    GROUP BY p.product_id, p.sku, p.name
+    ORDER BY p.sku
+    """
+    return query, params
+
+
+#  ОТЧЁТ 4 — Остатки на дату (снимок stock_snapshots + движение после него)
+def stock_as_of_query(as_of, warehouse_id):
+    # Сумма — по текущей цене товара
+    query = """
+        SELECT w.name, p.sku, p.name, p.unit, s.qty, p.price, ROUND(s.qty * p.price, 2)
+        FROM stock_as_of(%s, %s) s
+        JOIN warehouses w ON w.warehouse_id = s.warehouse_id
+        JOIN products p ON p.product_id = s.product_id
+        ORDER BY w.name, p.name
+    """
+    return query, [as_of, warehouse_id]
+
+
+# Отчёты по именам; порядок — порядок в окне отчётов
+REPORTS = {
+    "stock": Report(
+        "Остатки на складе",
+        ["Склад", "SKU", "Товар", "Ед", "Кол-во", "Цена", "Сумма", "Обновлено"],
+        [Param("warehouse_id", int, label="склад")],
+        stock_query, key_len=2, timeout=30),
+    "profit": Report(
+        "Прибыль от реализации",
+        ["Товар", "Продано", "Цена продажи (ср.)", "Цена закупки (ср.)", "Прибыль"],
+        [Param("date_from", date, start_of_year, "дата с"),
+         Param("date_to", date, date.today, "дата по")],
+        profit_query, timeout=120),
+    "movement": Report(
+        "Движение товара",
+        ["SKU", "Товар", "Приход", "Расход", "Изменение остатков", "Сумма прихода", "Сумма расхода"],
+        [Param("date_from", date, start_of_year, "дата с"),
+         Param("date_to", date, date.today, "дата по"),
+         Param("warehouse_id", int, label="склад"),
+         Param("sku", str, label="SKU")],
+        movement_query, timeout=120),
+    "stock_as_of": Report(
+        "Остатки на дату",
+        ["Склад", "SKU", "Товар", "Ед", "Кол-во", "Цена", "Сумма"],
+        [Param("as_of", date, date.today, "на дату"),
+         Param("warehouse_id", int, label="склад")],
+        stock_as_of_query, key_len=2, timeout=30),
+}
+
+# Итог к отчёту об остатках: в окне показывается над таблицей
+STOCK_SUMMARY = Report(
+    "Итог остатков по складам",
+    ["Позиций", "Сумма"],
+    [Param("warehouse_id", int, label="склад")],
+    stock_summary_query)
+
+
+def run_report(db, name, timeout=None, **values):
+    """Выполнить отчёт: (колонки, строки). Отчёты читаются с реплики, если она есть."""
+    report = REPORTS[name]
+    query, params = report.query(**values)
+    return report.columns, db.fetch(query, params, timeout=timeout or report.timeout, replica=True)
+
+
+# Обслуживание остатков
+LEDGER_BATCH = 10000        # строк журнала остатков за один перенос
+
+
+def take_snapshots(db, on_conn=None):
+    """Создать недостающие месячные снимки остатков (до текущего месяца).
+    Возвращает число созданных снимков; если снимок месяца есть — 0."""
+    with db.transaction(on_conn) as cur:
+        cur.execute("SELECT take_monthly_snapshots()")
+        return cur.fetchone()[0]
+
+
+def compact_ledger(db, batch=LEDGER_BATCH, on_conn=None):
+    """Перенести журнал остатков (stock_ledger) в stock_balances и движение
+    по дням. Возвращает число перенесённых строк; 0 — журнал пуст или
+    перенос уже идёт в другом соединении."""
+    with db.transaction(on_conn) as cur:
+        cur.execute("SELECT compact_stock_ledger(%s)", (batch,))
+        return cur.fetchone()[0]
+
+
+def set_ledger_mode(db, enabled):
+    """Включить или выключить режим журнала остатков; при выключении журнал
+    переносится целиком. Возвращает число перенесённых строк."""
+    with db.transaction() as cur:
+        cur.execute("SELECT set_stock_ledger(%s)", (enabled,))
+        return cur.fetchone()[0]
+
+
+# Выгрузка в CSV/XLSX
+EXPORT_ITERSIZE = 5000      # строк за одно чтение именованного курсора (XLSX)
+XLSX_MAX_ROWS = 1048575     # строк данных на листе Excel (без заголовка)
+
+
+class CopyCounter:
+    """Файл для COPY TO STDOUT: пишет в файл и примерно считает строки для
+    показа хода выгрузки (перевод строки внутри поля посчитается лишний раз)"""
+
+    def __init__(self, f, progress):
+        self.f = f
+        self.progress = progress
+
+    def write(self, data):
+        self.f.write(data)
+        self.progress["rows"] += data.count(b"\n")
+
+
+def export_csv(cur, query, params, header, f, progress):
+    """CSV через COPY (запрос) TO STDOUT: строки идут с сервера прямо в
+    двоичный файл f"""
+    sql = cur.mogrify(query, params).decode().strip().rstrip(";")
+    line = io.StringIO()
+    csv.writer(line, delimiter=";", lineterminator="\n").writerow(header)
+    # BOM — чтобы Excel открыл файл в UTF-8
+    f.write(("\ufeff" + line.getvalue()).encode())
+    cur.copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, DELIMITER ';', ENCODING 'UTF8')",
+                    CopyCounter(f, progress))
+    # Точное число строк — от сервера
+    progress["rows"] = cur.rowcount
+
+
+def export_xlsx(cur, query, params, header, path, progress):
+    """XLSX именованным (серверным) курсором: в памяти одна порция строк,
+    книга openpyxl в режиме write_only пишет листы во временные файлы"""
+    try:
+        import openpyxl
+    except ImportError:
+        raise RuntimeError("Для выгрузки в XLSX нужен пакет openpyxl")
+
+    book = openpyxl.Workbook(write_only=True)
+    sheet, sheet_rows = None, XLSX_MAX_ROWS
+    with cur.connection.cursor(name="export") as named:
+        named.itersize = EXPORT_ITERSIZE
+        named.execute(query, params)
+        for row in named:
+            if sheet_rows == XLSX_MAX_ROWS:
+                # Лист Excel ограничен по строкам — продолжаем на следующем
+                sheet = book.create_sheet(f"Лист{len(book.worksheets) + 1}")
+                sheet.append(header)
+                sheet_rows = 0
+            # Excel не хранит часовой пояс
+            sheet.append([value.replace(tzinfo=None) if isinstance(value, datetime) else value
+                          for value in row])
+            sheet_rows += 1
+            progress["rows"] += 1
+    if sheet is None:
+        book.create_sheet("Лист1").append(header)
+    book.save(path)
+
+
+def export_query(db, query, params, header, path, progress, on_conn=None, replica=False):
+    """Выгрузка результата запроса в файл без загрузки всех строк в память.
+    Формат — по расширению (.xlsx, иначе CSV); progress["rows"] растёт по ходу.
+    replica=True — читать с реплики, если она есть.
+    При ошибке или отмене недописанный файл удаляется. Возвращает число строк."""
+    try:
+        with db.transaction(on_conn, replica=replica) as cur:
+            if path.lower().endswith(".xlsx"):
+                export_xlsx(cur, query, params, header, path, progress)
+            else:
+                with open(path, "wb") as f:
+                    export_csv(cur, query, params, header, f, progress)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return progress["rows"]
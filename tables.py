@@ -0,0 +1,384 @@
+"""Запросы окон таблиц без интерфейса: представления с JOIN-ами, поиск
+с учётом типа поля, сортировка и keyset-пагинация, запросы накладных.
+Используются окнами (app.py) и замерами (bench.py)."""
+from datetime import timedelta
+
+from reports import parse_date, parse_decimal
+
+
+# Постраничная загрузка таблиц
+PAGE_SIZE = 200        # строк в одной странице
+
+# Представления таблиц: выводимые колонки, FROM с JOIN-ами и ключ,
+# по которому идёт keyset-пагинация (должен совпадать с индексом)
+TABLE_VIEWS = {
+    "staff": {
+        "columns": """
+            s.staff_id,
+            w.name AS warehouse,
+            s.full_name,
+            p.name AS position,
+            s.inn,
+            s.hired_at""",
+        "from": """
+            staff s
+            JOIN warehouses w ON w.warehouse_id = s.warehouse_id
+            JOIN positions p ON p.position_id = s.position_id""",
+        "key": ["s.staff_id"],
+        "search": [
+            ("staff_id", "s.staff_id", "number"),
+            ("warehouse", "w.name", "text"),
+            ("full_name", "s.full_name", "text"),
+            ("position", "p.name", "text"),
+            ("inn", "s.inn", "text"),
+            ("hired_at", "s.hired_at", "date"),
+        ],
+    },
+    "incoming_invoices": {
+        "columns": """
+            i.incoming_id,
+            w.name AS warehouse,
+            i.supplier,
+            i.invoice_number,
+            i.invoice_date,
+            i.total_amount""",
+        "from": """
+            incoming_invoices i
+            JOIN warehouses w ON w.warehouse_id = i.warehouse_id""",
+        "key": ["i.incoming_id"],
+        "search": [
+            ("incoming_id", "i.incoming_id", "number"),
+            ("warehouse", "w.name", "text"),
+            ("supplier", "i.supplier", "text"),
+            ("invoice_number", "i.invoice_number", "text"),
+            ("invoice_date", "i.invoice_date", "date"),
+            ("total_amount", "i.total_amount", "number"),
+        ],
+    },
+    "incoming_items": {
+        "columns": """
+            it.incoming_item_id,
+            inv.invoice_number AS invoice,
+            p.name AS product,
+            it.quantity,
+            it.unit_price,
+            it.line_total""",
+        "from": """
+            incoming_items it
+            JOIN incoming_invoices inv ON inv.incoming_id = it.incoming_id
+            JOIN products p ON p.product_id = it.product_id""",
+        "key": ["it.incoming_item_id"],
+        "search": [
+            ("incoming_item_id", "it.incoming_item_id", "number"),
+            ("invoice", "inv.invoice_number", "text"),
+            ("product", "p.name", "text"),
+            ("quantity", "it.quantity", "number"),
+            ("unit_price", "it.unit_price", "number"),
+            ("line_total", "it.line_total", "number"),
+        ],
+    },
+    "outgoing_invoices": {
+        "columns": """
+            o.outgoing_id,
+            w.name AS warehouse,
+            o.customer,
+            o.invoice_number,
+            o.invoice_date,
+            o.total_amount""",
+        "from": """
+            outgoing_invoices o
+            JOIN warehouses w ON w.warehouse_id = o.warehouse_id""",
+        "key": ["o.outgoing_id"],
+        "search": [
+            ("outgoing_id", "o.outgoing_id", "number"),
+            ("warehouse", "w.name", "text"),
+            ("customer", "o.customer", "text"),
+            ("invoice_number", "o.invoice_number", "text"),
+            ("invoice_date", "o.invoice_date", "date"),
+            ("total_amount", "o.total_amount", "number"),
+        ],
+    },
+    "outgoing_items": {
+        "columns": """
+            ot.outgoing_item_id,
+            inv.invoice_number AS invoice,
+            p.name AS product,
+            ot.quantity,
+            ot.unit_price,
+            ot.line_total""",
+        "from": """
+            outgoing_items ot
+            JOIN outgoing_invoices inv ON inv.outgoing_id = ot.outgoing_id
+            JOIN products p ON p.product_id = ot.product_id""",
+        "key": ["ot.outgoing_item_id"],
+        "search": [
+            ("outgoing_item_id", "ot.outgoing_item_id", "number"),
+            ("invoice", "inv.invoice_number", "text"),
+            ("product", "p.name", "text"),
+            ("quantity", "ot.quantity", "number"),
+            ("unit_price", "ot.unit_price", "number"),
+            ("line_total", "ot.line_total", "number"),
+        ],
+    },
+    # Сортировка по первичному ключу (а не по названиям), чтобы страница
+    # читалась по индексу, а не сортировкой всей таблицы. Количество —
+    # с учётом ещё не перенесённого журнала остатков (vw_stock_balances)
+    "stock_balances": {
+        "columns": """
+            w.name AS warehouse,
+            p.sku,
+            p.name AS product,
+            sb.qty,
+            sb.last_updated""",
+        "from": """
+            vw_stock_balances sb
+            JOIN warehouses w ON w.warehouse_id = sb.warehouse_id
+            JOIN products p ON p.product_id = sb.product_id""",
+        "key": ["sb.warehouse_id", "sb.product_id"],
+        "search": [
+            ("warehouse", "w.name", "text"),
+            ("sku", "p.sku", "text"),
+            ("product", "p.name", "text"),
+            ("qty", "sb.qty", "number"),
+            ("last_updated", "sb.last_updated", "date"),
+        ],
+    },
+    "products": {
+        "columns": "product_id, sku, name, unit, price, created_at",
+        "from": "products",
+        "key": ["product_id"],
+        "search": [
+            ("product_id", "product_id", "number"),
+            ("sku", "sku", "text"),
+            ("name", "name", "text"),
+            ("unit", "unit", "text"),
+            ("price", "price", "number"),
+            ("created_at", "created_at", "date"),
+        ],
+    },
+}
+
+
+def table_view(table_name, columns):
+    """Представление таблицы; для остальных таблиц — SELECT * по первой колонке.
+    "search" — поля поиска (название, выражение, вид: text/number/date);
+    если не заданы, окно строит их по типам колонок таблицы."""
+    if table_name in TABLE_VIEWS:
+        return TABLE_VIEWS[table_name]
+    return {"columns": "*", "from": table_name, "key": [columns[0]], "search": None}
+
+
+# Поиск в таблицах
+NUMBER_TYPES = {"smallint", "integer", "bigint", "numeric", "real", "double precision"}
+DATE_TYPES = {"date", "timestamp without time zone", "timestamp with time zone"}
+
+
+def like_escape(text):
+    """Экранировать спецсимволы LIKE (\\, %, _) в пользовательском вводе"""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def column_kind(data_type):
+    if data_type in NUMBER_TYPES:
+        return "number"
+    if data_type in DATE_TYPES:
+        return "date"
+    return "text"
+
+
+def search_predicate(expr, kind, text, name):
+    """Условие поиска с учётом типа поля: (sql, params).
+    Текст — подстрока без учёта регистра (ILIKE по индексу pg_trgm);
+    число и дата — значение, диапазон «a..b» или сравнение «>a», «<=b».
+    Дата сравнивается полуинтервалом, так что подходит и для timestamp."""
+    if kind == "text":
+        return f"{expr} ILIKE %s", [f"%{like_escape(text)}%"]
+
+    if kind == "date":
+        parse = parse_date
+    else:
+        parse = lambda value: parse_decimal(value, name)
+
+    if ".." in text:
+        low, high = (parse(v.strip()) for v in text.split("..", 1))
+        if kind == "date":
+            return f"{expr} >= %s AND {expr} < %s", [low, high + timedelta(days=1)]
+        return f"{expr} BETWEEN %s AND %s", [low, high]
+
+    op = "="
+    for candidate in (">=", "<=", ">", "<", "="):
+        if text.startswith(candidate):
+            op, text = candidate, text[len(candidate):].strip()
+            break
+    value = parse(text)
+
+    if kind == "number":
+        return f"{expr} {op} %s", [value]
+
+    next_day = value + timedelta(days=1)
+    if op == "=":
+        return f"{expr} >= %s AND {expr} < %s", [value, next_day]
+    if op == ">":
+        return f"{expr} >= %s", [next_day]
+    if op == "<=":
+        return f"{expr} < %s", [next_day]
+    return f"{expr} {op} %s", [value]
+
+
+# Запрос страницы таблицы
+SORT_SERVER_MAX = 100000   # больше строк — сортировка без индекса только на клиенте
+
+
+def keyset_condition(order, cursor, not_null):
+    """Условие «строго после cursor» для ORDER BY order [(выражение, desc)].
+    NULL считается больше любого значения, как в ORDER BY по умолчанию.
+    Если направления одинаковые и NULL невозможен — сравнение строк целиком,
+    его PostgreSQL использует как условие индекса."""
+    if (len({desc for _, desc in order}) == 1
+            and all(value is not None for value in cursor)
+            and all(expr in not_null for expr, _ in order)):
+        exprs = ", ".join(expr for expr, _ in order)
+        placeholders = ", ".join(["%s"] * len(order))
+        op = "<" if order[0][1] else ">"
+        return f"({exprs}) {op} ({placeholders})", list(cursor)
+
+    terms, params = [], []
+    equal, equal_params = [], []
+    for (expr, desc), value in zip(order, cursor):
+        if value is None:
+            after, after_params = (f"{expr} IS NOT NULL" if desc else "FALSE"), []
+        elif desc or expr in not_null:
+            after, after_params = f"{expr} {'<' if desc else '>'} %s", [value]
+        else:
+            after, after_params = f"({expr} > %s OR {expr} IS NULL)", [value]
+        terms.append(" AND ".join(equal + [after]))
+        params.extend(equal_params + after_params)
+
+        if value is None:
+            equal.append(f"{expr} IS NULL")
+        else:
+            equal.append(f"{expr} = %s")
+            equal_params.append(value)
+    return "(" + " OR ".join(f"({term})" for term in terms) + ")", params
+
+
+class TableQuery:
+    """Один шаблон запроса для окна таблицы: соединения из TABLE_VIEWS,
+    условия поиска, сортировка по нескольким полям и курсор по ключу.
+    Строка результата: значения сортировки, ключ, затем колонки таблицы;
+    курсор страницы — значения сортировки и ключа последней строки."""
+
+    def __init__(self, view, fields, info):
+        self.view = view
+        self.fields = fields        # название -> (выражение, вид), в порядке колонок
+        self.filters = []           # [(условие, параметры)]
+        self.sort = []              # [(название, desc)]
+
+        # Основная таблица и её псевдоним: «staff s JOIN ...» -> s
+        words = view["from"].split()
+        self.alias = words[1] if len(words) > 1 and words[1].upper() != "JOIN" else None
+        self.indexed = info["indexed"]
+        self.rows = info["rows"]
+        self.not_null = {self.expr_of(col) for col in info["not_null"]} | set(view["key"])
+
+    def expr_of(self, column):
+        return f"{self.alias}.{column}" if self.alias else column
+
+    def column_of(self, expr):
+        """Колонка основной таблицы для выражения поля (None — другая таблица)"""
+        if self.alias is None:
+            return None if "." in expr else expr
+        alias, _, column = expr.partition(".")
+        return column if alias == self.alias else None
+
+    def sortable(self, name):
+        """Можно ли сортировать на сервере: по индексу или таблица небольшая"""
+        return self.column_of(self.fields[name][0]) in self.indexed or self.rows <= SORT_SERVER_MAX
+
+    def order(self):
+        return ([(self.fields[name][0], desc) for name, desc in self.sort]
+                + [(key, False) for key in self.view["key"]])
+
+    def conditions(self):
+        conditions, params = [], []
+        for sql, values in self.filters:
+            conditions.append(sql)
+            params.extend(values)
+        return conditions, params
+
+    def page(self, after=None, before=None, limit=PAGE_SIZE):
+        """Запрос страницы после/до курсора: (запрос, параметры)"""
+        order = self.order()
+        conditions, params = self.conditions()
+
+        if before is not None:
+            # Предыдущая страница — тот же порядок наоборот
+            order = [(expr, not desc) for expr, desc in order]
+        cursor = after if after is not None else before
+        if cursor is not None:
+            sql, values = keyset_condition(order, cursor, self.not_null)
+            conditions.append(sql)
+            params.extend(values)
+
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        order_by = ", ".join(f"{expr} DESC" if desc else expr for expr, desc in order)
+        select = ", ".join([expr for expr, _ in self.order()] + [self.view["columns"]])
+        query = f"""
+            SELECT {select}
+            FROM {self.view["from"]}
+            {where}
+            ORDER BY {order_by}
+            LIMIT %s
+        """
+        params.append(limit)
+        return query, params
+
+    def export(self):
+        """Все строки с текущим поиском и сортировкой, только колонки таблицы"""
+        conditions, params = self.conditions()
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        order_by = ", ".join(f"{expr} DESC" if desc else expr for expr, desc in self.order())
+        query = f"""
+            SELECT {self.view["columns"]}
+            FROM {self.view["from"]}
+            {where}
+            ORDER BY {order_by}
+        """
+        return query, params
+
+    def split(self, rows):
+        """Строки результата -> (пары (iid, колонки), {iid: курсор})"""
+        n_sort, n_key = len(self.sort), len(self.view["key"])
+        items, cursors = [], {}
+        for row in rows:
+            iid = "|".join(str(k) for k in row[n_sort:n_sort + n_key])
+            items.append((iid, tuple(row[n_sort + n_key:])))
+            cursors[iid] = tuple(row[:n_sort + n_key])
+        return items, cursors
+
+
+# Накладные и их позиции: общая часть запросов, условия добавляются по месту
+def invoice_select(invoice_table, invoice_id_col, counterparty_col):
+    return f"""
+        SELECT i.{invoice_id_col},
+               w.name AS warehouse,
+               i.{counterparty_col} AS counterparty,
+               i.invoice_number,
+               i.invoice_date,
+               i.total_amount
+        FROM {invoice_table} i
+        JOIN warehouses w ON w.warehouse_id = i.warehouse_id
+    """
+
+
+def items_select(items_table, item_id_col):
+    return f"""
+        SELECT it.{item_id_col},
+               p.name AS product,
+               p.sku,
+               it.quantity,
+               it.unit_price,
+               it.line_total
+        FROM {items_table} it
+        JOIN products p ON p.product_id = it.product_id
+    """
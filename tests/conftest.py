@@ -0,0 +1,50 @@
+import os
+
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+from db import Database
+
+# Проверки SQL (db_1.sql) идут на отдельной базе: перед каждой проверкой
+# схема public в ней удаляется и создаётся скриптом заново, например
+#   WAREHOUSE_TEST_DSN="dbname=warehouse_test" python -m pytest
+# Без переменной они пропускаются.
+TEST_DSN = os.environ.get("WAREHOUSE_TEST_DSN")
+
+
+@pytest.fixture
+def dsn(request):
+    """Строка подключения к тестовой базе с только что созданной схемой"""
+    if not TEST_DSN:
+        pytest.skip("WAREHOUSE_TEST_DSN не задан")
+    script = (request.config.rootpath / "db_1.sql").read_text(encoding="utf-8")
+    conn = psycopg2.connect(TEST_DSN)
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public")
+            cur.execute(script)
+    finally:
+        conn.close()
+    return TEST_DSN
+
+
+@pytest.fixture
+def cur(dsn):
+    """Курсор тестовой базы; изменения проверки откатываются"""
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            yield cur
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+@pytest.fixture
+def db(dsn):
+    """Пул соединений к тестовой базе"""
+    db = Database(minconn=0, maxconn=2, **psycopg2.extensions.parse_dsn(dsn))
+    yield db
+    db.close()
@@ -0,0 +1,34 @@
+import pytest
+
+pytest.importorskip("psycopg")
+
+from aiodb import AsyncBackend, expand_tuples  # noqa: E402
+
+
+def test_expand_tuples():
+    assert expand_tuples("SELECT * FROM t WHERE id IN %s AND name LIKE 'a%%' AND n > %s",
+                         [(1, 2, 3), 5]) == (
+        "SELECT * FROM t WHERE id IN (%s, %s, %s) AND name LIKE 'a%%' AND n > %s", [1, 2, 3, 5])
+    # Составной ключ: кортеж кортежей
+    assert expand_tuples("SELECT * FROM t WHERE (a, b) IN %s", [((1, "x"), (2, "y"))]) == (
+        "SELECT * FROM t WHERE (a, b) IN ((%s, %s), (%s, %s))", [1, "x", 2, "y"])
+    # Без кортежей запрос и параметры не меняются, списки остаются массивами
+    params = [[1, 2], "a"]
+    assert expand_tuples("SELECT %s::int[], %s", params) == ("SELECT %s::int[], %s", params)
+    assert expand_tuples("SELECT %(a)s", {"a": (1, 2)}) == ("SELECT %(a)s", {"a": (1, 2)})
+
+
+@pytest.mark.parametrize("backend", [True, False])
+def test_fetch_many(db, monkeypatch, backend):
+    monkeypatch.setattr("db.ASYNC_BACKEND", backend)
+    queries = [
+        ("SELECT sku FROM products WHERE product_id IN %s ORDER BY 1", ((1, 2),)),
+        ("SELECT warehouse_id, product_id FROM stock_balances "
+         "WHERE (warehouse_id, product_id) IN %s ORDER BY 1, 2", (((1, 1), (2, 3)),)),
+        ("SELECT count(*) FROM products WHERE product_id = ANY(%s)", ([1, 2, 3],)),
+    ]
+    results = db.fetch_many(queries, timeout=5).result(10)
+    assert isinstance(db.async_backend(), AsyncBackend) == backend
+    assert [len(rows) for rows in results[:2]] == [2, 2]
+    assert results[1] == [(1, 1), (2, 3)]
+    assert results[2] == [(3,)]
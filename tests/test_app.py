@@ -0,0 +1,236 @@
+import io
+from datetime import date
+from decimal import Decimal
+
+import psycopg2
+import pytest
+
+from app import (CsvCopyStream, InvoiceImportError, TreeSync, batch_delete, batch_update,
+                 import_invoices_csv, increasing_subsequence, key_condition, post_invoice)
+
+
+def test_csv_copy_stream():
+    data = ("invoice_number;invoice_date;counterparty;sku;quantity;unit_price\n"
+            "N-1;01.02.2025;ООО \"Ромашка\";SKU-1;2;10,50\n"
+            ";;;;;\n"
+            "N-1;2025-02-01;Ромашка;SKU-2;0;1\n"
+            "N-2;2025-02-03;\"Склад;Юг\";SKU-3;1 000;0\n"
+            "N-3;вчера;Х;SKU-4;1;1\n"
+            "N-4;2025-02-03;Х;SKU-5\n")
+    stream = CsvCopyStream(io.StringIO(data), ";")
+    out = stream.read()
+    assert out == ("2,N-1,2025-02-01,\"ООО \"\"Ромашка\"\"\",SKU-1,2,10.50\n"
+                   "5,N-2,2025-02-03,Склад;Юг,SKU-3,1000,0\n")
+    assert stream.read() == ""
+    assert stream.lines == 2
+    assert [line for line, _ in stream.errors] == [4, 6, 7]
+
+
+def test_csv_copy_stream_chunks():
+    data = "h\n" + "".join(f"N-{i};2025-01-01;Х;S{i};1;{i}\n" for i in range(100))
+    stream = CsvCopyStream(io.StringIO(data), ";")
+    chunks = []
+    while True:
+        chunk = stream.read(64)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    assert len(chunks) > 1
+    assert "".join(chunks).count("\n") == stream.lines == 100
+    assert Decimal(chunks[-1].split(",")[-1]) == 99
+
+def write_csv(tmp_path, lines):
+    path = tmp_path / "import.csv"
+    path.write_text("номер;дата;контрагент;sku;количество;цена\n" + "\n".join(lines) + "\n",
+                    encoding="utf-8")
+    return str(path)
+
+
+def test_import_invoices(db, tmp_path):
+    path = write_csv(tmp_path, ["IMP-1;2025-10-01;ООО Тест;SKU-001;5;100",
+                                "IMP-1;2025-10-01;ООО Тест;SKU-005;2,5;40",
+                                "IMP-2;02.10.2025;ООО Другой;SKU-001;1;100"])
+    assert import_invoices_csv(db, "incoming", 3, path) == (2, 3)
+    rows = db.fetch("""
+        SELECT i.invoice_number, i.total_amount, SUM(it.quantity)
+        FROM incoming_invoices i
+        JOIN incoming_items it ON it.incoming_id = i.incoming_id
+        WHERE i.warehouse_id = 3 AND i.invoice_number LIKE 'IMP-%%'
+        GROUP BY i.invoice_number, i.total_amount
+        ORDER BY i.invoice_number
+    """)
+    assert rows == [("IMP-1", Decimal("600.00"), Decimal("7.500")),
+                    ("IMP-2", Decimal("100.00"), Decimal("1.000"))]
+
+
+def test_import_invoices_errors(db, tmp_path):
+    path = write_csv(tmp_path, ["IMP-1;2025-10-01;ООО Тест;SKU-001;5;100",
+                                "IMP-1;2025-10-02;ООО Тест;SKU-001;1;100",
+                                "IMP-2;2025-10-01;ООО Тест;НЕТ-ТАКОГО;1;100",
+                                "IMP-3;2025-10-01;ООО Тест;SKU-001;-1;100"])
+    with pytest.raises(InvoiceImportError) as e:
+        import_invoices_csv(db, "incoming", 3, path)
+    assert [line for line, _ in e.value.errors] == [3, 4, 5]
+    # Ничего не записано
+    assert db.fetch("SELECT COUNT(*) FROM incoming_invoices WHERE invoice_number LIKE 'IMP-%%'") == [(0,)]
+
+def test_increasing_subsequence():
+    assert increasing_subsequence([]) == set()
+    assert increasing_subsequence([0, 1, 2]) == {0, 1, 2}
+    assert increasing_subsequence([2, 1, 0]) in ({0}, {1}, {2})
+    assert increasing_subsequence([3, 0, 1, 4, 2, 5]) in ({0, 1, 2, 5}, {0, 1, 4, 5})
+
+
+class FakeTree:
+    """Treeview в памяти: порядок строк, отсоединённые строки и счётчик операций"""
+
+    def __init__(self):
+        self.children = []
+        self.values = {}
+        self.selected = ()
+        self.idle = []
+        self.calls = {"insert": 0, "move": 0, "item": 0, "delete": 0}
+
+    def winfo_toplevel(self):
+        return self
+
+    def get_children(self):
+        return tuple(self.children)
+
+    def selection(self):
+        return self.selected
+
+    def selection_set(self, iids):
+        self.selected = tuple(iids)
+
+    def exists(self, iid):
+        return iid in self.values
+
+    def insert(self, parent, index, iid, values):
+        self.calls["insert"] += 1
+        self.values[iid] = values
+        self.children.insert(len(self.children) if index == "end" else index, iid)
+
+    def move(self, iid, parent, index):
+        self.calls["move"] += 1
+        if iid in self.children:
+            self.children.remove(iid)
+        self.children.insert(index, iid)
+
+    def item(self, iid, values):
+        self.calls["item"] += 1
+        self.values[iid] = values
+
+    def delete(self, *iids):
+        self.calls["delete"] += len(iids)
+        for iid in iids:
+            del self.values[iid]
+            if iid in self.children:
+                self.children.remove(iid)
+
+    def detach(self, *iids):
+        for iid in iids:
+            self.children.remove(iid)
+
+    def after_idle(self, func):
+        self.idle.append(func)
+        return len(self.idle)
+
+    def after_cancel(self, job):
+        pass
+
+    def run_idle(self):
+        while self.idle:
+            self.idle.pop(0)()
+
+
+def rows(*keys):
+    return [(str(k), (k, f"v{k}")) for k in keys]
+
+
+def test_tree_sync():
+    tree = FakeTree()
+    sync = TreeSync(tree)
+    sync.sync(rows(1, 2, 3, 4, 5))
+    assert tree.children == ["1", "2", "3", "4", "5"]
+    assert tree.calls["insert"] == 5
+
+    # 5 переехала в начало, 3 удалена, 6 добавлена, у 2 новое значение
+    tree.selection_set(("2",))
+    tree.calls = dict.fromkeys(tree.calls, 0)
+    items = rows(5, 1, 2, 4, 6)
+    items[2] = ("2", (2, "новое"))
+    done = []
+    sync.sync(items, on_done=lambda: done.append(True))
+    assert tree.children == ["5", "1", "2", "4", "6"]
+    assert tree.values["2"] == (2, "новое")
+    assert tree.calls == {"insert": 1, "move": 1, "item": 1, "delete": 1}
+    assert tree.selected == ("2",)
+    assert done == [True]
+
+
+def test_tree_sync_chunks(monkeypatch):
+    # Лимит шага — значение по умолчанию, подставленное при определении метода
+    monkeypatch.setattr(TreeSync.step, "__defaults__", (3,))
+    tree = FakeTree()
+    sync = TreeSync(tree)
+    sync.sync(rows(*range(10)))
+    assert len(tree.children) == 3 and tree.idle
+    tree.run_idle()
+    assert tree.children == [str(k) for k in range(10)]
+
+    # Повторяющиеся ключи различаются суффиксом
+    sync.sync([("1", (1,)), ("1", (1,)), ("2", (2,))])
+    tree.run_idle()
+    assert tree.children == ["1", "1#1", "2"]
+
+
+def test_key_condition():
+    assert key_condition(["id"], [(1,), (2,)]) == ("id = ANY(%s)", [[1, 2]])
+    assert key_condition(["a", "b"], [(1, 2), (3, 4)]) == ("(a, b) IN %s", [((1, 2), (3, 4))])
+
+
+def test_batch_update(db):
+    keys = [(1, 1), (1, 3)]
+    assert batch_update(db, "stock_balances", ["warehouse_id", "product_id"], "qty", 5, keys) == {}
+    rows = db.fetch("SELECT qty FROM stock_balances WHERE (warehouse_id, product_id) IN %s",
+                    (tuple(keys),))
+    assert [qty for qty, in rows] == [5, 5]
+
+
+def test_batch_delete_errors(db):
+    with db.transaction() as cur:
+        cur.execute("INSERT INTO products (sku, name, price) VALUES ('T-1', 'Тест', 1) "
+                    "RETURNING product_id")
+        new_id = cur.fetchone()[0]
+    # На товар 1 ссылаются позиции накладных: пакет откатывается целиком,
+    # а в ошибках остаётся только он
+    errors = batch_delete(db, "products", ["product_id"], [(new_id,), (1,)])
+    assert list(errors) == [(1,)]
+    assert db.fetch("SELECT COUNT(*) FROM products WHERE product_id = %s", (new_id,)) == [(1,)]
+
+
+def stock_qty(db, warehouse_id, product_id):
+    rows = db.fetch("SELECT qty FROM stock_balances WHERE warehouse_id = %s AND product_id = %s",
+                    (warehouse_id, product_id))
+    return rows[0][0] if rows else Decimal(0)
+
+
+def test_post_invoice(db):
+    before = stock_qty(db, 2, 1)
+    invoice_id = post_invoice(db, "incoming", 2, "ООО «100%»", "G-1", date(2025, 10, 5),
+                              [(1, Decimal(3), Decimal("2.50")), (1, Decimal(1), Decimal(4))])
+    rows = db.fetch("SELECT supplier, invoice_number, total_amount FROM incoming_invoices "
+                    "WHERE incoming_id = %s", (invoice_id,))
+    assert rows == [("ООО «100%»", "G-1", Decimal("11.50"))]
+    assert stock_qty(db, 2, 1) == before + 4
+
+
+def test_post_invoice_rollback(db):
+    before = stock_qty(db, 1, 1)
+    # Расход больше остатка: не записываются ни строки, ни шапка
+    with pytest.raises(psycopg2.Error):
+        post_invoice(db, "outgoing", 1, "Покупатель", "G-2", date(2025, 10, 5),
+                     [(1, Decimal(1), Decimal(1)), (1, before + 1, Decimal(1))])
+    assert db.fetch("SELECT COUNT(*) FROM outgoing_invoices WHERE invoice_number = 'G-2'") == [(0,)]
+    assert stock_qty(db, 1, 1) == before
@@ -0,0 +1,120 @@
+from contextlib import contextmanager
+from datetime import date
+
+import pytest
+
+import cli
+
+
+class FakeCursor:
+    """Курсор без сервера: COPY отдаёт заранее заданные строки CSV"""
+
+    def __init__(self, db):
+        self.db = db
+        self.rowcount = -1
+
+    def mogrify(self, query, params):
+        self.db.params = params
+        return query.encode()
+
+    def execute(self, query, params=None):
+        self.db.executed.append(query)
+
+    def fetchone(self):
+        return (3,)
+
+    def copy_expert(self, sql, f):
+        self.db.copy_sql = sql
+        f.write(self.db.csv)
+        self.rowcount = self.db.csv.count(b"\n")
+
+
+class FakeDatabase:
+    instances = []
+
+    def __init__(self, **config):
+        self.config = config
+        self.closed = False
+        self.csv = "Подшипник;1\nМотор;2\n".encode()
+        self.executed = []
+        self.replica = None
+        FakeDatabase.instances.append(self)
+
+    @contextmanager
+    def transaction(self, on_conn=None, replica=False):
+        self.replica = replica
+        yield FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    FakeDatabase.instances = []
+    monkeypatch.setattr(cli, "Database", FakeDatabase)
+    return FakeDatabase.instances
+
+
+def test_parser():
+    args = cli.build_parser().parse_args(
+        ["report", "movement", "--from", "2025-01-01", "--warehouse", "2", "-o", "m.csv"])
+    assert (args.command, args.name, args.format, args.output) == ("report", "movement", "csv", "m.csv")
+    assert (args.date_from, args.date_to, args.warehouse_id, args.sku) == ("2025-01-01", None, "2", None)
+    assert args.timeout == cli.REPORTS["movement"].timeout
+
+
+@pytest.mark.parametrize("argv", [
+    ["report"],
+    ["report", "nope"],
+    ["report", "stock", "--from", "2025-01-01"],
+    ["report", "stock", "--format", "pdf"],
+])
+def test_parser_rejects(argv):
+    with pytest.raises(SystemExit):
+        cli.build_parser().parse_args(argv)
+
+
+def test_run_stdout(fake_db, capsysbinary):
+    cli.main(["--dsn", "host=db1", "--replica", "host=db2", "--replica", "host=db3",
+              "report", "profit", "--from", "2025-01-01", "--to", "2025-03-31", "--timeout", "5"])
+    out, err = capsysbinary.readouterr()
+    header = ";".join(cli.REPORTS["profit"].columns)
+    assert out.decode() == "\ufeff" + header + "\nПодшипник;1\nМотор;2\n"
+    assert err.decode().strip() == "Строк: 2"
+
+    db, = fake_db
+    assert db.config["options"] == "-c statement_timeout=5000"
+    # Отчёт читается с реплик
+    assert (db.config["dsn"], db.config["replicas"], db.replica) == (
+        "host=db1", ["host=db2", "host=db3"], True)
+    assert db.params == [date(2025, 1, 1), date(2025, 3, 31)] * 2
+    assert db.copy_sql.startswith("COPY (") and db.closed
+
+
+def test_run_output(fake_db, tmp_path, capsys):
+    path = tmp_path / "stock.csv"
+    cli.main(["report", "stock", "--warehouse", "2", "--output", str(path)])
+    assert path.read_bytes().endswith("Подшипник;1\nМотор;2\n".encode())
+    assert fake_db[0].params == [2]
+    assert (fake_db[0].config["dsn"], fake_db[0].config["replicas"]) == (None, None)
+    assert capsys.readouterr().err.strip() == "Строк: 2"
+
+
+@pytest.mark.parametrize("argv, message", [
+    (["report", "profit", "--from", "вчера"], "неверная дата"),
+    (["report", "stock", "--warehouse", "второй"], "неверное значение «склад»"),
+    (["report", "stock", "--format", "xlsx"], "укажите --output"),
+])
+def test_run_errors(fake_db, argv, message):
+    with pytest.raises(SystemExit, match=message):
+        cli.main(argv)
+    # До подключения к базе дело не доходит
+    assert fake_db == []
+
+
+def test_snapshots(fake_db, capsys):
+    cli.main(["snapshots"])
+    assert fake_db[0].executed == ["SELECT take_monthly_snapshots()"]
+    assert fake_db[0].replica is False
+    assert capsys.readouterr().err.strip() == "Создано снимков: 3"
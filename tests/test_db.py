@@ -0,0 +1,212 @@
+import itertools
+import time
+
+import psycopg2
+
+from db import (REPLICA_MAX_LAG, Database, QueryStats, Replica, estimate_bytes, fingerprint,
+                histogram, to_positional)
+
+
+def test_to_positional():
+    assert to_positional("SELECT * FROM t WHERE a = %s AND b > %s") == (
+        "SELECT * FROM t WHERE a = $1 AND b > $2", 2)
+
+
+def test_to_positional_percent():
+    assert to_positional("SELECT name FROM t WHERE name LIKE 'a%%' AND id = %s") == (
+        "SELECT name FROM t WHERE name LIKE 'a%' AND id = $1", 1)
+    assert to_positional("SELECT 1") == ("SELECT 1", 0)
+
+
+class FakeCursor:
+    """Курсор без сервера: запоминает выполненные команды"""
+
+    def __init__(self):
+        self.connection = object()
+        self.sql = []
+
+    def execute(self, query, params=None):
+        self.sql.append(query)
+
+
+def test_prepared_key_ignores_whitespace():
+    db = Database(minconn=0)
+    cur = FakeCursor()
+    db.prepared(cur, "SELECT * FROM t\n  WHERE a = %s", (1,))
+    db.prepared(cur, "SELECT * FROM t WHERE a = %s", (2,))
+    assert fingerprint("SELECT *\n\tFROM t ") == "SELECT * FROM t"
+    assert [q for q in cur.sql if q.startswith("PREPARE")] == [
+        "PREPARE stmt_1 AS SELECT * FROM t\n  WHERE a = $1"]
+    assert cur.sql.count("EXECUTE stmt_1 (%s)") == 2
+
+
+def test_prepared_lru_deallocates(monkeypatch):
+    monkeypatch.setattr("db.PREPARED_MAX", 2)
+    db = Database(minconn=0)
+    cur = FakeCursor()
+    for query in ("SELECT 1", "SELECT 2", "SELECT 1", "SELECT 3"):
+        db.prepared(cur, query, ())
+    # SELECT 2 использовался раньше всех, его план и удаляется
+    assert cur.sql[-2:] == ["DEALLOCATE stmt_2", "EXECUTE stmt_3"]
+    _, cache = db.statements[cur.connection]
+    assert list(cache) == ["SELECT 1", "SELECT 3"]
+
+    # После изменения схемы планы соединения сбрасываются целиком
+    db.invalidate_statements()
+    db.prepared(cur, "SELECT 1", ())
+    assert cur.sql[-3:] == ["DEALLOCATE ALL", "PREPARE stmt_4 AS SELECT 1", "EXECUTE stmt_4"]
+
+
+def test_query_stats():
+    stats = QueryStats(slow_ms=100)
+    assert not stats.record("db", "SELECT *\n  FROM t WHERE id = %s", 0.010, rows=1, caller="A.a")
+    assert stats.record("db", "SELECT * FROM t WHERE id = %s", 0.200, rows=2, caller="B.b")
+    assert not stats.record("tk", "Таблица", 0.300)
+    for ms in range(1, 19):
+        stats.record("db", "SELECT 1", ms / 1000)
+
+    first, second = stats.top(kind="db")
+    assert first["query"] == "SELECT * FROM t WHERE id = %s"
+    assert (first["calls"], first["rows"], first["max_ms"]) == (2, 3, 200)
+    assert first["callers"] == {"A.a": 1, "B.b": 1}
+    assert (second["p50_ms"], second["p95_ms"]) == (10, 18)
+    assert [(t, q, c) for _, t, q, c in stats.slow_log()] == [
+        (200, "SELECT * FROM t WHERE id = %s", "B.b")]
+    assert [e["kind"] for e in stats.top(by="max_ms")] == ["tk", "db", "db"]
+
+    stats.reset()
+    assert stats.top() == [] and stats.slow_log() == []
+
+
+def test_histogram():
+    counts = dict(histogram([0.5, 1, 3, 3, 7000]))
+    assert (counts[1], counts[5], counts[None]) == (2, 2, 1)
+    assert sum(counts.values()) == 5
+
+
+def test_estimate_bytes():
+    assert estimate_bytes([]) == 0
+    assert estimate_bytes([("abc", None, 12)] * 3000) == 5 * 3000
+
+
+def test_slow_query_plan(db):
+    db.stats = QueryStats(slow_ms=0)
+    assert db.fetch("SELECT %s::int + 1", (1,)) == [(2,)]
+    entry, = db.stats.top(kind="db")
+    assert entry["query"] == "SELECT %s::int + 1" and entry["rows"] == 1
+    # План снимается в фоне один раз
+    deadline = time.monotonic() + 5
+    while entry["plan"] in (None, "План снимается...") and time.monotonic() < deadline:
+        time.sleep(0.05)
+        entry, = db.stats.top(kind="db")
+    assert "actual time" in entry["plan"]
+
+
+class FakePool:
+    """Пул без сервера: usable — можно ли читать, down — getconn падает"""
+
+    def __init__(self, name, usable=True, down=False):
+        self.name = name
+        self.ok = usable
+        self.down = down
+        self.taken = []
+
+    def usable(self):
+        return self.ok
+
+    def getconn(self):
+        if self.down:
+            raise psycopg2.OperationalError("нет связи")
+        conn = f"{self.name}-conn"
+        self.taken.append(conn)
+        return conn
+
+    def putconn(self, conn):
+        self.taken.remove(conn)
+
+
+def with_pools(primary, *replicas):
+    db = Database(minconn=0, replicas=[])
+    db.pool = primary
+    db.replicas = list(replicas)
+    db.rotation = itertools.cycle(db.replicas)
+    return db
+
+
+def test_read_pool_rotation():
+    primary, first, lagging, second = (FakePool("primary"), FakePool("first"),
+                                       FakePool("lagging", usable=False), FakePool("second"))
+    db = with_pools(primary, first, lagging, second)
+    assert [db.read_pool().name for _ in range(4)] == ["first", "second", "first", "second"]
+
+    first.ok = second.ok = False
+    assert db.read_pool() is primary
+    assert with_pools(primary).read_pool() is primary
+
+
+def test_connection_replica_fallback():
+    primary, replica = FakePool("primary"), FakePool("replica", down=True)
+    db = with_pools(primary, replica)
+    with db.connection(replica=True) as conn:
+        assert conn == "primary-conn"
+    assert primary.taken == []
+
+    # Запись и чтение без replica=True — всегда основной сервер
+    replica.down = False
+    with db.connection() as conn:
+        assert conn == "primary-conn"
+    with db.connection(replica=True) as conn:
+        assert conn == "replica-conn"
+
+
+class LagConnection:
+    closed = False
+
+    def __init__(self, lag):
+        self.lag = lag
+
+    def cursor(self):
+        lag = self.lag
+
+        class Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def execute(self, query):
+                if isinstance(lag, Exception):
+                    raise lag
+
+            def fetchone(self):
+                return (lag,)
+
+        return Cursor()
+
+    def rollback(self):
+        pass
+
+
+def test_replica_lag(monkeypatch):
+    replica = Replica({"host": "replica"}, maxconn=1)
+    conn = LagConnection(1.5)
+    monkeypatch.setattr(replica, "getconn", lambda: conn)
+    monkeypatch.setattr(replica, "putconn", lambda c: None)
+    assert replica.usable() and replica.lag == 1.5
+
+    # Отставание проверяется не чаще REPLICA_CHECK: до следующей проверки — прежнее
+    conn.lag = REPLICA_MAX_LAG + 1
+    assert replica.usable()
+    replica.checked = 0
+    assert not replica.usable()
+
+    # Ошибка проверки исключает реплику на REPLICA_RETRY
+    conn.lag = psycopg2.OperationalError("нет связи")
+    replica.checked = 0
+    assert not replica.usable() and replica.lag is None
+    conn.lag = 0
+    replica.checked = 0
+    assert not replica.usable()
+    replica.down_until = 0
+    assert replica.usable()
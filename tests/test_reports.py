@@ -0,0 +1,82 @@
+import csv
+from datetime import date
+
+import psycopg2
+import pytest
+
+from reports import REPORTS, STOCK_SUMMARY, Param, export_query, run_report, start_of_year
+
+
+def test_report_defaults():
+    query, params = REPORTS["profit"].query()
+    assert params == [start_of_year(), date.today()] * 2
+    query, params = REPORTS["stock"].query(warehouse_id=None)
+    assert "WHERE" not in query and params == []
+
+
+def test_report_parses_strings():
+    _, params = REPORTS["movement"].query(date_from="01.02.2025", date_to=" 2025-02-28 ",
+                                          warehouse_id="2", sku="SKU-1")
+    assert params == [date(2025, 2, 1), date(2025, 2, 28), 2, "SKU-1"]
+    # Готовые значения не разбираются заново
+    _, params = STOCK_SUMMARY.query(warehouse_id=3)
+    assert params == [3]
+
+
+@pytest.mark.parametrize("name, values, message", [
+    ("profit", {"date_from": "2025-13-01"}, "неверная дата"),
+    ("stock", {"warehouse_id": "второй"}, "неверное значение «склад»"),
+    ("stock", {"sku": "SKU-1"}, "неизвестные параметры: sku"),
+])
+def test_report_invalid(name, values, message):
+    with pytest.raises(ValueError, match=message):
+        REPORTS[name].query(**values)
+
+
+def test_param_default_callable():
+    param = Param("d", date, date.today)
+    assert param.parse("") == date.today()
+    assert Param("n", int).parse(None) is None
+
+
+def test_run_report(db):
+    columns, rows = run_report(db, "movement", date_from="2025-01-01", date_to="2025-12-31",
+                               sku="SKU-001")
+    assert columns == REPORTS["movement"].columns
+    assert len(rows) == 1 and rows[0][0] == "SKU-001"
+
+
+def test_stock_as_of_report(db):
+    columns, rows = run_report(db, "stock_as_of", as_of="2025-09-02", warehouse_id=1)
+    assert len(columns) == 7
+    # До 02.09 на склад 1 пришла только накладная INV-001
+    assert [(row[1], row[4]) for row in rows] == [("SKU-003", 50), ("SKU-001", 100)]
+
+
+def test_export_csv(db, tmp_path):
+    path = str(tmp_path / "out.csv")
+    query = "SELECT n, %s || chr(10) || n AS name FROM generate_series(1, 3) n ORDER BY n"
+    progress = {"rows": 0}
+    # Перевод строки внутри поля не добавляет строк в счёт
+    assert export_query(db, query, ("100%;",), ["N", "Название"], path, progress) == 3
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        rows = list(csv.reader(f, delimiter=";"))
+    assert rows == [["N", "Название"], ["1", "100%;\n1"], ["2", "100%;\n2"], ["3", "100%;\n3"]]
+
+
+def test_export_xlsx(db, tmp_path):
+    openpyxl = pytest.importorskip("openpyxl")
+    path = str(tmp_path / "out.xlsx")
+    progress = {"rows": 0}
+    assert export_query(db, "SELECT n FROM generate_series(1, 3) n", None, ["N"], path,
+                        progress) == 3
+    sheet = openpyxl.load_workbook(path).worksheets[0]
+    assert [row[0] for row in sheet.iter_rows(values_only=True)] == ["N", 1, 2, 3]
+
+
+def test_export_removes_partial_file(db, tmp_path):
+    path = tmp_path / "out.csv"
+    with pytest.raises(psycopg2.Error):
+        export_query(db, "SELECT 1 / (3 - n) FROM generate_series(1, 5) n", None, ["x"],
+                     str(path), {"rows": 0})
+    assert not path.exists()
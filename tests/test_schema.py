@@ -0,0 +1,403 @@
+"""Триггеры и функции db_1.sql на тестовой базе (см. conftest.py)"""
+
+from datetime import date
+
+import psycopg2
+import psycopg2.errors
+import pytest
+
+
+def stock(cur, warehouse_id, product_id):
+    cur.execute("SELECT qty FROM stock_balances WHERE warehouse_id = %s AND product_id = %s",
+                (warehouse_id, product_id))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def new_invoice(cur, kind, warehouse_id, number, day="2025-10-01"):
+    counterparty = "supplier" if kind == "incoming" else "customer"
+    cur.execute(f"""
+        INSERT INTO {kind}_invoices (warehouse_id, {counterparty}, invoice_number, invoice_date)
+        VALUES (%s, 'Тест', %s, %s)
+        RETURNING {kind}_id
+    """, (warehouse_id, number, day))
+    return cur.fetchone()[0]
+
+
+def add_items(cur, kind, invoice_id, lines):
+    """Позиции накладной одним оператором: lines — [(товар, количество)]"""
+    values = ", ".join(["(%s, %s, %s, 1)"] * len(lines))
+    params = [value for product_id, qty in lines for value in (invoice_id, product_id, qty)]
+    cur.execute(f"INSERT INTO {kind}_items ({kind}_id, product_id, quantity, unit_price) "
+                f"VALUES {values}", params)
+
+
+def test_incoming_statement(cur):
+    before = stock(cur, 1, 1)
+    assert stock(cur, 1, 5) is None
+    invoice = new_invoice(cur, "incoming", 1, "T-1")
+
+    # Повторяющиеся товары суммируются, новая пара (склад, товар) получает строку
+    add_items(cur, "incoming", invoice, [(1, 5), (1, 7), (5, 3)])
+    assert stock(cur, 1, 1) == before + 12
+    assert stock(cur, 1, 5) == 3
+
+    cur.execute("UPDATE incoming_items SET quantity = quantity + 1 WHERE incoming_id = %s",
+                (invoice,))
+    assert stock(cur, 1, 1) == before + 14
+    assert stock(cur, 1, 5) == 4
+
+    cur.execute("DELETE FROM incoming_items WHERE incoming_id = %s", (invoice,))
+    assert stock(cur, 1, 1) == before
+    assert stock(cur, 1, 5) == 0
+
+
+def test_outgoing_statement(cur):
+    before = {product_id: stock(cur, 1, product_id) for product_id in (1, 3, 4)}
+    invoice = new_invoice(cur, "outgoing", 1, "T-2")
+    add_items(cur, "outgoing", invoice, [(1, 10), (3, 5)])
+    assert stock(cur, 1, 1) == before[1] - 10
+    assert stock(cur, 1, 3) == before[3] - 5
+
+    # Смена товара переносит количество со старого товара на новый
+    cur.execute("UPDATE outgoing_items SET product_id = 4 WHERE outgoing_id = %s AND product_id = 3",
+                (invoice,))
+    assert stock(cur, 1, 3) == before[3]
+    assert stock(cur, 1, 4) == before[4] - 5
+
+    cur.execute("DELETE FROM outgoing_items WHERE outgoing_id = %s", (invoice,))
+    assert {product_id: stock(cur, 1, product_id) for product_id in (1, 3, 4)} == before
+
+
+def summary(cur):
+    cur.execute("SELECT warehouse_name, total_value, product_count FROM vw_warehouse_stock_summary "
+                "ORDER BY warehouse_name")
+    return cur.fetchall()
+
+
+def summary_from_balances(cur):
+    cur.execute("""
+        SELECT w.name, COALESCE(SUM(sb.qty * p.price), 0), COUNT(sb.product_id)
+        FROM warehouses w
+        LEFT JOIN stock_balances sb ON sb.warehouse_id = w.warehouse_id
+        LEFT JOIN products p ON p.product_id = sb.product_id
+        GROUP BY w.warehouse_id, w.name
+        ORDER BY w.name
+    """)
+    return cur.fetchall()
+
+
+def test_stock_summary(cur):
+    assert summary(cur) == summary_from_balances(cur)
+
+    invoice = new_invoice(cur, "incoming", 2, "T-3")
+    add_items(cur, "incoming", invoice, [(1, 5), (2, 1)])
+    cur.execute("UPDATE products SET price = price * 2 WHERE product_id = 2")
+    invoice = new_invoice(cur, "outgoing", 1, "T-4")
+    add_items(cur, "outgoing", invoice, [(1, 3)])
+    assert summary(cur) == summary_from_balances(cur)
+
+    # Удаление товара вычитает его стоимость до каскадного удаления остатков
+    cur.execute("INSERT INTO products (sku, name, unit, price) VALUES ('T-1', 'Т', 'шт', 10) "
+                "RETURNING product_id")
+    product_id = cur.fetchone()[0]
+    cur.execute("INSERT INTO stock_balances (warehouse_id, product_id, qty) VALUES (3, %s, 4)",
+                (product_id,))
+    assert summary(cur) == summary_from_balances(cur)
+    cur.execute("DELETE FROM products WHERE product_id = %s", (product_id,))
+    assert summary(cur) == summary_from_balances(cur)
+
+
+def test_stock_summary_empty_warehouse(cur):
+    cur.execute("INSERT INTO warehouses (name, manager_name, address) VALUES ('Пустой', 'Т', 'Т')")
+    assert ("Пустой", 0, 0) in summary(cur)
+
+
+def test_stock_summary_slots(dsn):
+    """Одновременные проводки по одному складу пишут в разные слоты и не ждут друг друга"""
+    conns = [psycopg2.connect(dsn) for _ in range(3)]
+    try:
+        slots = []
+        for number, conn in enumerate(conns):
+            with conn.cursor() as cur:
+                cur.execute("SET statement_timeout = '2s'")
+                invoice = new_invoice(cur, "incoming", 1, f"S-{number}")
+                add_items(cur, "incoming", invoice, [(number + 1, 1)])
+                cur.execute("SELECT current_setting('stock.summary_slot')")
+                slots.append(cur.fetchone()[0])
+        assert len(set(slots)) == len(conns)
+        for conn in conns:
+            conn.commit()
+
+        with conns[0].cursor() as cur:
+            assert summary(cur) == summary_from_balances(cur)
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def test_stock_summary_slot_taken(dsn):
+    """Слот pid % 16 занят другой транзакцией (совпали pid) — берётся следующий"""
+    first, second = psycopg2.connect(dsn), psycopg2.connect(dsn)
+    try:
+        with first.cursor() as a, second.cursor() as b:
+            b.execute("SELECT pg_backend_pid() % 16")
+            start = b.fetchone()[0]
+            a.execute("SELECT pg_advisory_xact_lock(hashtext('stock_summary_slot'), %s)", (start,))
+            b.execute("SET statement_timeout = '2s'")
+            add_items(b, "incoming", new_invoice(b, "incoming", 1, "S-1"), [(1, 1)])
+            b.execute("SELECT current_setting('stock.summary_slot')::int")
+            assert b.fetchone()[0] == (start + 1) % 16
+    finally:
+        first.close()
+        second.close()
+
+
+def movement(cur):
+    """Ненулевые строки движения по дням"""
+    cur.execute("""
+        SELECT day, warehouse_id, product_id, in_qty, out_qty, in_value, out_value
+        FROM stock_movement_daily
+        WHERE (in_qty, out_qty, in_value, out_value) <> (0, 0, 0, 0)
+        ORDER BY 1, 2, 3
+    """)
+    return cur.fetchall()
+
+
+def movement_from_items(cur):
+    cur.execute("""
+        SELECT day, warehouse_id, product_id,
+               SUM(in_qty), SUM(out_qty), SUM(in_value), SUM(out_value)
+        FROM (
+            SELECT inv.invoice_date AS day, inv.warehouse_id, it.product_id,
+                   it.quantity AS in_qty, 0 AS out_qty, it.line_total AS in_value, 0 AS out_value
+            FROM incoming_items it
+            JOIN incoming_invoices inv ON inv.incoming_id = it.incoming_id
+            UNION ALL
+            SELECT inv.invoice_date, inv.warehouse_id, it.product_id, 0, it.quantity, 0, it.line_total
+            FROM outgoing_items it
+            JOIN outgoing_invoices inv ON inv.outgoing_id = it.outgoing_id
+        ) x
+        GROUP BY 1, 2, 3
+        ORDER BY 1, 2, 3
+    """)
+    return cur.fetchall()
+
+
+def test_movement_daily(cur):
+    assert movement(cur) == movement_from_items(cur)
+
+    incoming = new_invoice(cur, "incoming", 1, "T-5", "2025-10-02")
+    add_items(cur, "incoming", incoming, [(1, 5), (2, 1), (1, 2)])
+    outgoing = new_invoice(cur, "outgoing", 1, "T-6", "2025-10-02")
+    add_items(cur, "outgoing", outgoing, [(1, 4)])
+    assert movement(cur) == movement_from_items(cur)
+
+    cur.execute("UPDATE incoming_items SET quantity = quantity * 2 WHERE incoming_id = %s",
+                (incoming,))
+    cur.execute("UPDATE incoming_invoices SET invoice_date = '2025-10-05' WHERE incoming_id = %s",
+                (incoming,))
+    cur.execute("UPDATE outgoing_invoices SET invoice_date = '2025-10-05', warehouse_id = 2 "
+                "WHERE outgoing_id = %s", (outgoing,))
+    assert movement(cur) == movement_from_items(cur)
+
+    cur.execute("DELETE FROM outgoing_invoices WHERE outgoing_id = %s", (outgoing,))
+    cur.execute("DELETE FROM incoming_items WHERE incoming_id = %s AND product_id = 2", (incoming,))
+    assert movement(cur) == movement_from_items(cur)
+
+    cur.execute("SELECT rebuild_stock_movement_daily()")
+    assert movement(cur) == movement_from_items(cur)
+
+
+def test_partitioned_invoices(cur):
+    cur.execute("SHOW server_version_num")
+    if int(cur.fetchone()[0]) < 150000:
+        pytest.skip("секционирование накладных требует PostgreSQL 15+")
+    cur.execute("SELECT warehouse_id, product_id, qty FROM stock_balances ORDER BY 1, 2")
+    balances = cur.fetchall()
+    before = movement_from_items(cur)
+
+    cur.execute("CALL partition_invoice_tables()")
+    cur.execute("SELECT COUNT(*) FROM pg_partitioned_table "
+                "WHERE partrelid IN ('incoming_items'::regclass, 'outgoing_invoices'::regclass)")
+    assert cur.fetchone()[0] == 2
+    assert movement_from_items(cur) == before
+    cur.execute("SELECT warehouse_id, product_id, qty FROM stock_balances ORDER BY 1, 2")
+    assert cur.fetchall() == balances
+
+    # Перенос накладной в другой месяц (другую секцию) сохраняет её позиции
+    cur.execute("SELECT COUNT(*) FROM incoming_items WHERE incoming_id = 1")
+    lines = cur.fetchone()[0]
+    cur.execute("UPDATE incoming_invoices SET invoice_date = '2025-11-15' WHERE incoming_id = 1")
+    cur.execute("SELECT COUNT(*), MIN(invoice_date) FROM incoming_items WHERE incoming_id = 1")
+    assert cur.fetchone() == (lines, date(2025, 11, 15))
+    assert movement(cur) == movement_from_items(cur)
+    cur.execute("SELECT warehouse_id, product_id, qty FROM stock_balances ORDER BY 1, 2")
+    assert cur.fetchall() == balances
+    cur.execute("DELETE FROM outgoing_invoices WHERE outgoing_id = 1")
+    assert movement(cur) == movement_from_items(cur)
+
+    # Запрос за месяц читает только его секцию
+    cur.execute("EXPLAIN SELECT * FROM incoming_items WHERE invoice_date BETWEEN '2025-11-01' AND '2025-11-30'")
+    plan = "\n".join(row[0] for row in cur.fetchall())
+    assert "incoming_items_2025_11" in plan and "incoming_items_2025_09" not in plan
+
+    # Номер накладной по-прежнему уникален на складе
+    new_invoice(cur, "incoming", 1, "P-1", "2025-10-01")
+    with pytest.raises(psycopg2.errors.UniqueViolation):
+        new_invoice(cur, "incoming", 1, "P-1", "2025-11-01")
+
+
+def stock_as_of(cur, day):
+    cur.execute("SELECT warehouse_id, product_id, qty FROM stock_as_of(%s) ORDER BY 1, 2", (day,))
+    return cur.fetchall()
+
+
+def stock_as_of_from_items(cur, day):
+    """Текущие остатки минус всё, что проведено после day, — по позициям"""
+    cur.execute("""
+        SELECT warehouse_id, product_id, SUM(qty)
+        FROM (
+            SELECT warehouse_id, product_id, qty FROM stock_balances
+            UNION ALL
+            SELECT inv.warehouse_id, it.product_id, -it.quantity
+            FROM incoming_items it
+            JOIN incoming_invoices inv ON inv.incoming_id = it.incoming_id
+            WHERE inv.invoice_date > %(day)s
+            UNION ALL
+            SELECT inv.warehouse_id, it.product_id, it.quantity
+            FROM outgoing_items it
+            JOIN outgoing_invoices inv ON inv.outgoing_id = it.outgoing_id
+            WHERE inv.invoice_date > %(day)s
+        ) x
+        GROUP BY 1, 2
+        HAVING SUM(qty) <> 0
+        ORDER BY 1, 2
+    """, {"day": day})
+    return cur.fetchall()
+
+
+DAYS = ["2025-08-31", "2025-09-01", "2025-09-10", "2025-09-30", "2025-10-01", "2025-10-20",
+        date.today()]
+
+
+def test_stock_as_of(cur):
+    # Скрипт схемы уже снял месячные снимки; повторный вызов ничего не делает
+    cur.execute("SELECT count(*) FROM stock_snapshot_dates")
+    assert cur.fetchone()[0] > 1
+    cur.execute("SELECT take_monthly_snapshots()")
+    assert cur.fetchone()[0] == 0
+    for day in DAYS:
+        assert stock_as_of(cur, day) == stock_as_of_from_items(cur, day), day
+
+    # Проводки задним числом поправляют все более поздние снимки
+    invoice = new_invoice(cur, "incoming", 2, "T-8", "2025-09-15")
+    add_items(cur, "incoming", invoice, [(1, 5), (4, 2)])
+    invoice = new_invoice(cur, "outgoing", 1, "T-9", "2025-09-20")
+    add_items(cur, "outgoing", invoice, [(1, 3)])
+    cur.execute("UPDATE incoming_invoices SET invoice_date = '2025-10-05' WHERE incoming_id = 1")
+    cur.execute("DELETE FROM outgoing_items WHERE outgoing_id = 1")
+    for day in DAYS:
+        assert stock_as_of(cur, day) == stock_as_of_from_items(cur, day), day
+
+    # Снимок на произвольную дату строится от соседнего
+    cur.execute("SELECT take_stock_snapshot('2025-09-16')")
+    for day in DAYS:
+        assert stock_as_of(cur, day) == stock_as_of_from_items(cur, day), day
+
+
+@pytest.mark.parametrize("mode", ["off", "on"])
+def test_shortage(cur, mode):
+    """Расход сверх остатка, в том числе по паре без строки остатка,
+    отклоняется одинаково в прямом режиме и в режиме журнала"""
+    cur.execute(f"SET stock.ledger = {mode}")
+    assert stock(cur, 2, 1) is None
+    for product_id, qty in ((1, 1), (3, stock(cur, 2, 3) + 1)):
+        invoice = new_invoice(cur, "outgoing", 2, f"T-{product_id}")
+        cur.execute("SAVEPOINT s")
+        with pytest.raises(psycopg2.errors.CheckViolation, match="Недостаточно товара"):
+            add_items(cur, "outgoing", invoice, [(product_id, qty)])
+        cur.execute("ROLLBACK TO SAVEPOINT s")
+    assert stock(cur, 2, 1) is None
+
+
+def test_ledger(cur):
+    balances = "SELECT warehouse_id, product_id, qty FROM {} ORDER BY 1, 2"
+    cur.execute(balances.format("stock_balances"))
+    before = cur.fetchall()
+    cur.execute("SET stock.ledger = on")
+
+    incoming = new_invoice(cur, "incoming", 1, "T-10")
+    add_items(cur, "incoming", incoming, [(1, 5), (5, 3)])
+    outgoing = new_invoice(cur, "outgoing", 1, "T-11", "2025-10-02")
+    add_items(cur, "outgoing", outgoing, [(1, 2), (5, 3)])
+    cur.execute("UPDATE outgoing_invoices SET invoice_date = '2025-10-03' WHERE outgoing_id = %s",
+                (outgoing,))
+
+    # Строки остатка не меняются (кроме новой пары), представление видит журнал
+    cur.execute(balances.format("stock_balances"))
+    assert [row for row in cur.fetchall() if row[:2] != (1, 5)] == before
+    cur.execute(balances.format("vw_stock_balances"))
+    expected = cur.fetchall()
+
+    cur.execute("SELECT compact_stock_ledger(NULL)")
+    assert cur.fetchone()[0] > 0
+    cur.execute("SELECT count(*) FROM stock_ledger")
+    assert cur.fetchone()[0] == 0
+    cur.execute(balances.format("stock_balances"))
+    assert cur.fetchall() == expected
+    assert stock(cur, 1, 5) == 0
+    assert movement(cur) == movement_from_items(cur)
+    assert summary(cur) == summary_from_balances(cur)
+
+
+def test_ledger_locks(dsn):
+    """Расход в режиме журнала не блокирует строку остатка: приход и перенос
+    журнала не ждут незафиксированный расход того же товара, а расход ждёт"""
+    first, second = psycopg2.connect(dsn), psycopg2.connect(dsn)
+    try:
+        with first.cursor() as a, second.cursor() as b:
+            for cur in (a, b):
+                cur.execute("SET stock.ledger = on; SET lock_timeout = '1s'")
+            add_items(a, "outgoing", new_invoice(a, "outgoing", 1, "T-12"), [(1, 1)])
+
+            b.execute("SELECT qty FROM stock_balances WHERE warehouse_id = 1 AND product_id = 1 "
+                      "FOR UPDATE NOWAIT")
+            b.execute("SELECT compact_stock_ledger(NULL)")
+            add_items(b, "incoming", new_invoice(b, "incoming", 1, "T-13"), [(1, 1)])
+            add_items(b, "outgoing", new_invoice(b, "outgoing", 1, "T-14"), [(3, 1)])
+            with pytest.raises(psycopg2.errors.LockNotAvailable):
+                add_items(b, "outgoing", new_invoice(b, "outgoing", 1, "T-15"), [(1, 1)])
+    finally:
+        first.close()
+        second.close()
+
+
+def test_set_stock_ledger(dsn):
+    """Выключение режима журнала ждёт начатые проводки и переносит весь журнал"""
+    first, second = psycopg2.connect(dsn), psycopg2.connect(dsn)
+    try:
+        with first.cursor() as a, second.cursor() as b:
+            a.execute("SELECT set_stock_ledger(true)")
+            first.commit()
+            add_items(a, "incoming", new_invoice(a, "incoming", 1, "T-16"), [(1, 1)])
+
+            b.execute("SET lock_timeout = '1s'")
+            with pytest.raises(psycopg2.errors.LockNotAvailable):
+                b.execute("SELECT set_stock_ledger(false)")
+            second.rollback()
+
+            first.commit()
+            b.execute("SELECT set_stock_ledger(false)")
+            assert b.fetchone()[0] == 1
+            second.commit()
+            b.execute("SELECT count(*) FROM stock_ledger")
+            assert b.fetchone()[0] == 0
+            add_items(b, "incoming", new_invoice(b, "incoming", 1, "T-17"), [(1, 1)])
+            b.execute("SELECT count(*) FROM stock_ledger")
+            assert b.fetchone()[0] == 0
+    finally:
+        first.rollback()
+        second.rollback()
+        first.close()
+        second.close()
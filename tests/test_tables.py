@@ -0,0 +1,136 @@
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from tables import TableQuery, keyset_condition, like_escape, search_predicate
+
+
+def test_like_escape():
+    assert like_escape("50%_a\\b") == "50\\%\\_a\\\\b"
+    assert like_escape("обычный текст") == "обычный текст"
+
+
+def test_search_text():
+    assert search_predicate("p.name", "text", "10%", "Название") == (
+        "p.name ILIKE %s", ["%10\\%%"])
+
+
+def test_search_number():
+    assert search_predicate("qty", "number", "5..20", "Кол-во") == (
+        "qty BETWEEN %s AND %s", [Decimal(5), Decimal(20)])
+    assert search_predicate("qty", "number", ">= 1 000,5", "Кол-во") == (
+        "qty >= %s", [Decimal("1000.5")])
+    assert search_predicate("qty", "number", "7", "Кол-во") == ("qty = %s", [Decimal(7)])
+
+
+def test_search_date():
+    assert search_predicate("d", "date", ">=2025-01-01", "Дата") == (
+        "d >= %s", [date(2025, 1, 1)])
+    # Дата и timestamp сравниваются полуинтервалом
+    assert search_predicate("d", "date", "01.02.2025", "Дата") == (
+        "d >= %s AND d < %s", [date(2025, 2, 1), date(2025, 2, 2)])
+    assert search_predicate("d", "date", ">2025-01-31", "Дата") == (
+        "d >= %s", [date(2025, 2, 1)])
+    assert search_predicate("d", "date", "<=2025-01-31", "Дата") == (
+        "d < %s", [date(2025, 2, 1)])
+    assert search_predicate("d", "date", "2025-01-01..2025-01-31", "Дата") == (
+        "d >= %s AND d < %s", [date(2025, 1, 1), date(2025, 2, 1)])
+
+
+@pytest.mark.parametrize("kind, text", [
+    ("number", "abc"), ("number", "1..x"), ("date", "2025-13-01"), ("date", ">вчера"),
+])
+def test_search_invalid(kind, text):
+    with pytest.raises(ValueError):
+        search_predicate("x", kind, text, "Поле")
+
+
+def test_keyset_row_comparison():
+    # Одно направление и без NULL — сравнение строк целиком
+    assert keyset_condition([("a", False), ("id", False)], (1, 2), {"a", "id"}) == (
+        "(a, id) > (%s, %s)", [1, 2])
+    assert keyset_condition([("a", True), ("id", True)], (1, 2), {"a", "id"}) == (
+        "(a, id) < (%s, %s)", [1, 2])
+
+
+def test_keyset_mixed_directions():
+    assert keyset_condition([("a", True), ("id", False)], (5, 2), {"a", "id"}) == (
+        "((a < %s) OR (a = %s AND id > %s))", [5, 5, 2])
+
+
+def test_keyset_nullable():
+    # NULL больше любого значения: после 5 по возрастанию идут и NULL
+    assert keyset_condition([("a", False), ("id", False)], (5, 2), {"id"}) == (
+        "(((a > %s OR a IS NULL)) OR (a = %s AND id > %s))", [5, 5, 2])
+
+
+def test_keyset_null_cursor():
+    # По возрастанию после NULL остаются только строки с тем же NULL
+    assert keyset_condition([("a", False), ("id", False)], (None, 2), {"id"}) == (
+        "((FALSE) OR (a IS NULL AND id > %s))", [2])
+    # По убыванию NULL идут первыми, после них — все остальные значения
+    assert keyset_condition([("a", True), ("id", False)], (None, 2), {"id"}) == (
+        "((a IS NOT NULL) OR (a IS NULL AND id > %s))", [2])
+
+
+VIEW = {"from": "staff s JOIN departments d ON d.department_id = s.department_id",
+        "columns": "s.staff_id, s.name, d.name", "key": ["s.staff_id"]}
+FIELDS = {"Имя": ("s.name", "text"), "Отдел": ("d.name", "text")}
+
+
+def make_query(rows=10):
+    return TableQuery(VIEW, FIELDS, {"indexed": {"name"}, "not_null": ["name"], "rows": rows})
+
+
+def squash(query):
+    return " ".join(query.split())
+
+
+def test_page_first():
+    query, params = make_query().page(limit=50)
+    assert squash(query) == (
+        "SELECT s.staff_id, s.staff_id, s.name, d.name "
+        "FROM staff s JOIN departments d ON d.department_id = s.department_id "
+        "ORDER BY s.staff_id LIMIT %s")
+    assert params == [50]
+
+
+def test_page_after_with_filter():
+    table = make_query()
+    table.sort = [("Имя", True)]
+    table.filters = [("s.name ILIKE %s", ["%ив%"])]
+    query, params = table.page(after=("Иван", 3), limit=10)
+    assert squash(query) == (
+        "SELECT s.name, s.staff_id, s.staff_id, s.name, d.name "
+        "FROM staff s JOIN departments d ON d.department_id = s.department_id "
+        "WHERE s.name ILIKE %s AND ((s.name < %s) OR (s.name = %s AND s.staff_id > %s)) "
+        "ORDER BY s.name DESC, s.staff_id LIMIT %s")
+    assert params == ["%ив%", "Иван", "Иван", 3, 10]
+
+
+def test_page_before_reverses_order():
+    table = make_query()
+    table.sort = [("Имя", False)]
+    query, params = table.page(before=("Иван", 3), limit=10)
+    # Колонки сортировки в SELECT остаются в исходном порядке
+    assert squash(query) == (
+        "SELECT s.name, s.staff_id, s.staff_id, s.name, d.name "
+        "FROM staff s JOIN departments d ON d.department_id = s.department_id "
+        "WHERE (s.name, s.staff_id) < (%s, %s) "
+        "ORDER BY s.name DESC, s.staff_id DESC LIMIT %s")
+    assert params == ["Иван", 3, 10]
+
+
+def test_sortable():
+    assert make_query(rows=10**6).sortable("Имя")
+    assert not make_query(rows=10**6).sortable("Отдел")
+    assert make_query(rows=10).sortable("Отдел")
+
+
+def test_split():
+    table = make_query()
+    table.sort = [("Имя", False)]
+    items, cursors = table.split([("Анна", 1, 1, "Анна", "Склад")])
+    assert items == [("1", (1, "Анна", "Склад"))]
+    assert cursors == {"1": ("Анна", 1)}